@@ -10,6 +10,8 @@ For the full list of settings and their values, see
 https://docs.djangoproject.com/en/5.2/ref/settings/
 """
 
+import os
+from importlib.util import find_spec
 from pathlib import Path
 
 # Build paths inside the project like this: BASE_DIR / 'subdir'.
@@ -43,11 +45,118 @@ REST_FRAMEWORK = {
     'DEFAULT_AUTHENTICATION_CLASSES': [
         'rest_framework.authentication.SessionAuthentication',   
     ],
+    'DEFAULT_PAGINATION_CLASS': 'library.pagination.KeysetPagination',
+    'PAGE_SIZE': 100,
+    # msgpack is optional: with the package installed clients may send
+    # "Accept: application/msgpack".
+    'DEFAULT_RENDERER_CLASSES': [
+        'library.renderers.ORJSONRenderer',
+        'rest_framework.renderers.BrowsableAPIRenderer',
+    ] + (['library.renderers.MessagePackRenderer'] if find_spec('msgpack') else []),
 }
 
 MEDIA_URL = "/media/"
 MEDIA_ROOT = BASE_DIR / "media"
 
+# Background exports: size of the render process pool (0 leaves jobs for
+# `manage.py run_export_jobs`), how long finished files are kept, and after how
+# long a running job is taken for dead and queued again, in seconds.
+EXPORT_JOB_WORKERS = 2
+EXPORT_JOB_TTL = 60 * 60
+EXPORT_JOB_TIMEOUT = 30 * 60
+
+# Per-request timing (library.middleware.ServerTimingMiddleware): Server-Timing
+# headers with SQL/renderer/app time, and the share of requests logged as JSON to
+# the "library.timing" logger together with their slowest statements.
+REQUEST_TIMING_HEADERS = DEBUG
+REQUEST_TIMING_SAMPLE_RATE = 0.0
+
+# /metrics: with several worker processes point METRICS_MULTIPROCESS_DIR at a
+# directory shared by them (emptied on deploy) so every worker reports the
+# totals of all of them; None keeps metrics in process memory.
+METRICS_MULTIPROCESS_DIR = None
+METRICS_ALLOWED_IPS = ['127.0.0.1']
+
+# Seconds between checks (one query, in the background) whether other worker
+# processes changed books or members; only then is the in-memory autocomplete
+# index rebuilt. The first build also runs in the background; lookups find
+# nothing until it is done.
+AUTOCOMPLETE_REFRESH = 30
+AUTOCOMPLETE_BUILD_IN_BACKGROUND = True
+
+# Mixed into list ETags; change it on deploys that alter API response shapes so
+# clients do not keep bodies revalidated against the old code.
+API_ETAG_SALT = "1"
+
+# API response cache (library.response_cache) lives in the "api" cache:
+# "locmem" is a per-process LRU bounded by entries and bytes, "file" a
+# directory shared by the workers, "redis" any Redis-compatible server at
+# REDIS_URL (needs the redis package). Entries are keyed by model versions,
+# so the TTL only bounds memory, not staleness.
+RESPONSE_CACHE_BACKEND = os.environ.get("RESPONSE_CACHE_BACKEND", "locmem")
+RESPONSE_CACHE_TTL = 60
+
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+    },
+    'api': {
+        'locmem': {
+            'BACKEND': 'library.cache_backends.SizeBoundedLocMemCache',
+            'LOCATION': 'api',
+            'OPTIONS': {'MAX_ENTRIES': 10000, 'MAX_BYTES': 64 * 1024 * 1024},
+        },
+        'file': {
+            'BACKEND': 'django.core.cache.backends.filebased.FileBasedCache',
+            'LOCATION': BASE_DIR / 'cache' / 'api',
+            'OPTIONS': {'MAX_ENTRIES': 10000},
+        },
+        'redis': {
+            'BACKEND': 'django.core.cache.backends.redis.RedisCache',
+            'LOCATION': os.environ.get('REDIS_URL', 'redis://127.0.0.1:6379/1'),
+        },
+    }[RESPONSE_CACHE_BACKEND],
+}
+
+# Delta sync (/api/sync/): changes younger than SYNC_LAG seconds wait for the
+# next poll, so rows of still-open transactions are not skipped; tombstones
+# and cursors older than SYNC_TOMBSTONE_TTL seconds are dropped and the
+# client has to reload (`manage.py prune_tombstones`).
+SYNC_LAG = 5
+SYNC_TOMBSTONE_TTL = 30 * 24 * 60 * 60
+
+# Server-Sent Events (/api/events/, ASGI only): seconds between keep-alive
+# comments, and the directory of per-process unix sockets that carries events
+# between worker processes (None: one process only).
+EVENTS_HEARTBEAT = 15
+EVENTS_FANOUT_DIR = None
+
+# Threads that run the statements of the async stats views (/api/async/, ASGI)
+# concurrently; also the most connections those views hold open at once.
+STATS_QUERY_THREADS = 4
+
+# Admin changelists count filtered rows up to ADMIN_COUNT_LIMIT and keep the
+# count for ADMIN_COUNT_TTL seconds or until the model changes.
+ADMIN_COUNT_LIMIT = 10000
+ADMIN_COUNT_TTL = 300
+
+# Lock and result files through which worker processes coalesce identical
+# stats and export computations (library.singleflight).
+SINGLEFLIGHT_DIR = BASE_DIR / 'cache' / 'singleflight'
+# Seconds a result stays on disk for workers still queued on its lock.
+SINGLEFLIGHT_TTL = 60
+
+LOGGING = {
+    'version': 1,
+    'disable_existing_loggers': False,
+    'handlers': {
+        'console': {'class': 'logging.StreamHandler'},
+    },
+    'loggers': {
+        'library.timing': {'handlers': ['console'], 'level': 'INFO', 'propagate': False},
+    },
+}
+
 
 # Application definition
 
@@ -65,6 +174,8 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    'library.middleware.ServerTimingMiddleware',
+    'library.middleware.MetricsMiddleware',
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
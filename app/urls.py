@@ -22,7 +22,8 @@ from django.conf.urls.static import static
 from rest_framework.routers import DefaultRouter
 
 from library.api import LibraryViewSet, BookViewSet, GenreViewSet, LoanViewSet, MemberViewSet
-from library.api import UserProfileViewSet
+from library.api import UserProfileViewSet, ExportJobViewSet, DashboardViewSet, SearchViewSet
+from library.api import AutocompleteViewSet, SyncViewSet
 
 from library import views
 
@@ -33,9 +34,18 @@ router.register("genres", GenreViewSet, basename="genre")
 router.register("members", MemberViewSet, basename="member") 
 router.register("loans", LoanViewSet, basename="loan")
 router.register("userprofile", UserProfileViewSet, basename="userprofile")
+router.register("export-jobs", ExportJobViewSet, basename="export-job")
+router.register("dashboard", DashboardViewSet, basename="dashboard")
+router.register("search", SearchViewSet, basename="search")
+router.register("autocomplete", AutocompleteViewSet, basename="autocomplete")
+router.register("sync", SyncViewSet, basename="sync")
 
 urlpatterns = [
     path('', views.ShowLibraryView.as_view()),
     path('admin/', admin.site.urls),
+    path('api/events/', views.events_view, name='events'),
+    path('api/async/dashboard/', views.dashboard_view, name='async-dashboard'),
+    path('api/async/<str:section>/stats/', views.stats_view, name='async-stats'),
     path('api/', include(router.urls)),
+    path('metrics', views.metrics_view, name='metrics'),
 ] + static(settings.MEDIA_URL, document_root=settings.MEDIA_ROOT)
\ No newline at end of file
@@ -1,4 +1,5 @@
 import { ref } from 'vue';
+import axios from 'axios';
 
 export function showNotification(notification, msg, type = "success", duration = 2000) {
   if (notification._timeoutId) {
@@ -15,3 +16,19 @@ export function showNotification(notification, msg, type = "success", duration =
     notification._timeoutId = null;
   }, duration);
 }
+
+export async function fetchAll(url, params = {}) {
+  const items = [];
+  let cursor = null;
+  while (true) {
+    const r = await axios.get(url, { params: cursor ? { ...params, cursor } : params });
+    if (Array.isArray(r.data)) {
+      return r.data;
+    }
+    items.push(...r.data.results);
+    if (!r.data.next) {
+      return items;
+    }
+    cursor = new URL(r.data.next).searchParams.get('cursor');
+  }
+}
@@ -1,29 +1,159 @@
+import hashlib
+import json
+
+from django.apps import apps
+from django.conf import settings
 from django.contrib import admin
+from django.contrib.admin.views.main import SEARCH_VAR
+from django.core.cache import cache
+from django.core.paginator import Paginator
+from django.utils.functional import cached_property
+
+from library import search, stats, versions
 from library.models import Library, Genre, Book, Member, Loan
 
+# model -> stats counter that already holds its row count
+ROW_COUNTERS = {
+    Genre: stats.GENRE_COUNT,
+    Library: stats.LIBRARY_COUNT,
+    Book: stats.BOOK_COUNT,
+    Loan: stats.LOAN_COUNT,
+}
+
+
+class AtLeast(int):
+    """A capped row count: pages are computed from the number, templates show it as a lower bound."""
+
+    def __str__(self):
+        return f"{int(self)}+"
+
+
+class CountingPaginator(Paginator):
+    """Changelist paginator that never COUNTs a whole large table.
+
+    Unfiltered lists take the row count from the stats counters. Filtered
+    ones count at most ``ADMIN_COUNT_LIMIT`` rows (later pages stay reachable
+    through narrower filters) and keep the result until one of the models
+    the filters read changes. ``models`` adds the ones the query does not
+    join, such as the sources of the search index.
+    """
+
+    def __init__(self, *args, models=(), **kwargs):
+        super().__init__(*args, **kwargs)
+        self.models = models
+
+    @cached_property
+    def count(self):
+        queryset = self.object_list
+        if queryset.query.is_empty():
+            return 0
+        scope = ROW_COUNTERS.get(queryset.model)
+        if scope and not queryset.query.where:
+            return stats.total(scope)
+        models = {queryset.model, *self.models, *_joined_models(queryset)}
+        limit = settings.ADMIN_COUNT_LIMIT
+        queryset = queryset.order_by()[:limit]
+        sql, params = queryset.query.sql_with_params()
+        key = "admin-count:%s" % hashlib.sha1(
+            json.dumps([sql, params, versions.current(models)], default=str).encode()
+        ).hexdigest()
+        count = cache.get(key)
+        if count is None:
+            count = queryset.count()
+            cache.set(key, count, settings.ADMIN_COUNT_TTL)
+        return AtLeast(count) if count >= limit else count
+
+
+def _joined_models(queryset):
+    tables = {join.table_name for join in queryset.query.alias_map.values()}
+    return [model for model in apps.get_models() if model._meta.db_table in tables]
+
+
+class LargeTableAdmin(admin.ModelAdmin):
+    paginator = CountingPaginator
+    ordering = ["-pk"]
+    # The "N total" link next to filtered results would COUNT the whole table.
+    show_full_result_count = False
+    # search type (library.search.SOURCES) -> field holding its id; answered by the FTS index.
+    search_targets = {}
+
+    def get_paginator(self, request, queryset, per_page, orphans=0, allow_empty_first_page=True):
+        models = []
+        if request.GET.get(SEARCH_VAR):
+            models = [search.SOURCES[search.KINDS[name]][1] for name in self.search_targets]
+        return self.paginator(queryset, per_page, orphans, allow_empty_first_page, models=models)
+
+    def get_search_results(self, request, queryset, search_term):
+        if not self.search_targets:
+            return super().get_search_results(request, queryset, search_term)
+        filters = [search.matching(search_term, name, field) for name, field in self.search_targets.items()]
+        filters = [condition for condition in filters if condition is not None]
+        if not filters:
+            return queryset, False
+        condition = filters[0]
+        for other in filters[1:]:
+            condition |= other
+        return queryset.filter(condition), False
+
+
+class LoanStatusFilter(admin.SimpleListFilter):
+    title = "Статус"
+    parameter_name = "status"
+
+    def lookups(self, request, model_admin):
+        return [("open", "На руках"), ("returned", "Возвращена")]
+
+    def queryset(self, request, queryset):
+        if self.value() == "open":
+            return queryset.filter(return_date__isnull=True)
+        if self.value() == "returned":
+            return queryset.filter(return_date__isnull=False)
+        return queryset
+
+
 # Register your models here.
 @admin.register(Library)
-class LibraryAdmin(admin.ModelAdmin):
+class LibraryAdmin(LargeTableAdmin):
     list_display = ["id", "name", "address"]
+    search_fields = ["name"]
+    search_targets = {"library": "pk"}
 
 @admin.register(Genre)
-class GenreAdmin(admin.ModelAdmin):
+class GenreAdmin(LargeTableAdmin):
     list_display = ["id", "name"]
+    search_fields = ["name"]
 
 @admin.register(Book)
-class BookAdmin(admin.ModelAdmin):
+class BookAdmin(LargeTableAdmin):
     list_display = ["id", "title", "genre", "library"]
+    list_select_related = ["genre", "library"]
+    list_filter = ["genre", "library"]
+    search_fields = ["title"]
+    search_targets = {"book": "pk"}
+    autocomplete_fields = ["genre", "library"]
 
 @admin.register(Member)
-class MemberAdmin(admin.ModelAdmin):
+class MemberAdmin(LargeTableAdmin):
     list_display = ["id", "first_name", "library"]
+    list_select_related = ["library"]
+    list_filter = ["library"]
+    search_fields = ["first_name"]
+    search_targets = {"member": "pk"}
+    autocomplete_fields = ["library"]
+    raw_id_fields = ["user"]
 
     def get_queryset(self, request):
         queryset = super().get_queryset(request)
         if request.user.is_superuser:
             return queryset
-        return queryset.none() 
+        return queryset.none()
 
 @admin.register(Loan)
-class LoanAdmin(admin.ModelAdmin):
-    list_display = ["id", "book", "member", "loan_date"]
+class LoanAdmin(LargeTableAdmin):
+    list_display = ["id", "book", "member", "loan_date", "return_date"]
+    list_select_related = ["book", "member"]
+    list_filter = [LoanStatusFilter, "loan_date"]
+    search_fields = ["book__title", "member__first_name"]
+    search_targets = {"book": "book", "member": "member"}
+    autocomplete_fields = ["book", "member"]
+    raw_id_fields = ["user"]
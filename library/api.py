@@ -1,20 +1,30 @@
 import pyotp
-import io
-from datetime import date
+from functools import partial
 from django.contrib.auth import authenticate, login, logout as django_logout
-from django.http import HttpResponse
+from django.http import FileResponse, Http404
+from django.utils import timezone
 from django.utils.decorators import method_decorator
 from django.views.decorators.csrf import ensure_csrf_cookie
-from django.db.models import Count
-from openpyxl import Workbook
-from docx import Document
-from rest_framework import permissions, serializers, status
+from rest_framework import mixins, permissions, serializers, status
 from rest_framework.decorators import action
 from rest_framework.response import Response
 from rest_framework.viewsets import ModelViewSet, GenericViewSet
 from rest_framework.permissions import IsAuthenticated
-from library.models import Library, Book, Genre, Member, Loan, UserProfile, User
+from library.models import Library, Book, Genre, Member, Loan, UserProfile, User, ExportJob
 from library.serializers import LibrarySerializer, BookSerializer, GenreSerializer, LoanSerializer, UserSerializer
+from library.serializers import ExportJobSerializer, BulkLoanSerializer, BulkReturnSerializer
+from library.serializers import BookValuesSerializer, LoanValuesSerializer, UserValuesSerializer
+from library.export_jobs import create_job
+from library import autocomplete, metrics, response_cache, stats, sync, versions
+from library.loans import bulk_checkout, bulk_return, checkout, return_loan, save_loan
+from library.importers import ImportFormatError, import_books, read_rows
+from library.response_cache import cached_action
+from library.search import SEARCH_LIMIT, MAX_SEARCH_LIMIT, search
+from library.autocomplete import AUTOCOMPLETE_LIMIT, MAX_AUTOCOMPLETE_LIMIT
+from library.exports import (
+    EXPORT_FORMATS, CSV_CONTENT_TYPE, NDJSON_CONTENT_TYPE,
+    iter_rows, iter_csv, iter_ndjson, write_export, file_response, streaming_response
+)
 
 class LoginSerializer(serializers.Serializer):
     username = serializers.CharField()
@@ -97,127 +107,309 @@ class UserProfileViewSet(GenericViewSet):
         request.session["second_factor"] = False
         return Response({"success": True})
 
+class VersionETagMixin:
+    """Answer list requests with a version-counter ETag and 304 when it still matches.
+
+    Bodies are served from the response cache under the same tag.
+
+    ``etag_models`` lists every model the list's body is built from. The
+    versions are read before the list, so a change that lands in between can
+    only make the tag look stale, never hide the change.
+    """
+    etag_models = ()
+
+    def list(self, request, *args, **kwargs):
+        tag = versions.etag(request._request, self.etag_models)
+        headers = {"ETag": tag, "Cache-Control": "private, no-cache", "Vary": "Cookie, Accept"}
+        if versions.matches(request._request, tag):
+            return Response(status=status.HTTP_304_NOT_MODIFIED, headers=headers)
+        # The tag already identifies the body, so it doubles as the response cache key.
+        response = response_cache.fetch(
+            request, response_cache.KEY_PREFIX + tag, partial(super().list, request, *args, **kwargs)
+        )
+        for name, value in headers.items():
+            response[name] = value
+        return response
+
+def _field_names(value):
+    return [name.strip() for name in (value or "").split(",") if name.strip()]
+
+class SparseFieldsMixin:
+    """``?fields=a,b`` and ``?exclude=c`` for list and retrieve: drop serializer fields and the SQL behind them.
+
+    ``queryset`` is the cheapest form of the rows; ``field_querysets`` maps a
+    field to what it adds (a join, an annotation), and only the requested
+    fields add theirs. Fields left out are removed from the serializer, so
+    method fields are not computed either.
+    """
+    field_querysets = {}
+    sparse_actions = ("list", "retrieve")
+
+    @classmethod
+    def queryset_for(cls, fields=None):
+        queryset = cls.queryset.all()
+        for name, extend in cls.field_querysets.items():
+            if fields is None or name in fields:
+                queryset = extend(queryset)
+        return queryset
+
+    def requested_fields(self):
+        """Names of the fields to render, in serializer order, or None for all of them."""
+        if self.action not in self.sparse_actions:
+            return None
+        if not hasattr(self, "_requested_fields"):
+            self._requested_fields = self._parse_fields()
+        return self._requested_fields
+
+    def _parse_fields(self):
+        params = self.request.query_params
+        if "fields" not in params and "exclude" not in params:
+            return None
+        available = list(self.get_serializer_class().Meta.fields)
+        fields = _field_names(params.get("fields")) or available
+        excluded = _field_names(params.get("exclude"))
+        unknown = sorted((set(fields) | set(excluded)) - set(available))
+        if unknown:
+            raise serializers.ValidationError({"fields": [f"Неизвестные поля: {', '.join(unknown)}."]})
+        return [name for name in available if name in fields and name not in excluded]
+
+    def get_queryset(self):
+        return self.queryset_for(self.requested_fields())
+
+    def get_serializer(self, *args, **kwargs):
+        serializer = super().get_serializer(*args, **kwargs)
+        fields = self.requested_fields()
+        if fields is not None:
+            target = getattr(serializer, "child", serializer)
+            for name in set(target.fields) - set(fields):
+                target.fields.pop(name)
+        return serializer
+
+class ValuesListMixin(SparseFieldsMixin):
+    """Serve list pages from ``queryset.values()`` through ``values_serializer_class``.
+
+    Model instances and ModelSerializer fields cost far more per row than
+    the columns themselves; the values serializer produces the same JSON.
+    Only the requested fields' columns are selected, plus the pagination
+    key. Everything but ``list`` keeps using ``serializer_class``.
+    """
+    values_serializer_class = None
+
+    def list(self, request, *args, **kwargs):
+        serializer = self.values_serializer_class
+        if serializer is None:
+            return super().list(request, *args, **kwargs)
+        fields = self.requested_fields()
+        ordering = [field.lstrip("-") for field in getattr(self, "pagination_ordering", ("id",))]
+        lookups = dict.fromkeys(serializer.lookups(fields) + ordering)
+        rows = self.filter_queryset(self.get_queryset()).values(*lookups)
+        page = self.paginate_queryset(rows)
+        if page is not None:
+            return self.get_paginated_response(serializer.to_representation(page, fields))
+        return Response(serializer.to_representation(rows, fields))
+
 class BaseExportMixin:
-    def export_queryset(self, queryset, columns, filename_base):
+    export_resource = None
+    export_title = None
+    export_columns = {}
+    export_formatters = {}
+    registry = {}
+
+    def __init_subclass__(cls, **kwargs):
+        super().__init_subclass__(**kwargs)
+        if cls.export_resource:
+            BaseExportMixin.registry[cls.export_resource] = cls
+
+    @classmethod
+    def write_export(cls, file, file_type):
+        rows = iter_rows(cls.queryset_for(), cls.export_columns, cls.export_formatters)
+        write_export(file, file_type, cls.export_title, cls.export_columns, rows)
+
+    def export_queryset(self, queryset, columns, filename_base, formatters=None):
         file_type = self.request.query_params.get("type", "excel")
+        gzip = self.request.query_params.get("gzip") in ("1", "true")
+        rows = iter_rows(queryset, columns, formatters)
+
+        resource = self.export_resource or filename_base
 
-        if file_type == "excel":
-            workbook = Workbook()
-            sheet = workbook.active
-            sheet.title = filename_base
-            sheet.append(columns)
-            for row in queryset:
-                sheet.append([row.get(col, "") for col in columns])
-            buffer = io.BytesIO()
-            workbook.save(buffer)
-            buffer.seek(0)
-            return HttpResponse(
-                buffer,
-                content_type="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"
+        if file_type == "csv":
+            response = streaming_response(iter_csv(columns, rows), f"{filename_base}.csv", CSV_CONTENT_TYPE, gzip)
+        elif file_type == "ndjson":
+            response = streaming_response(
+                iter_ndjson(columns, rows), f"{filename_base}.ndjson", NDJSON_CONTENT_TYPE, gzip
             )
+        else:
+            if file_type != "excel":
+                file_type = "docx"
+            extension, content_type = EXPORT_FORMATS[file_type]
+            # Building a workbook is the slow part of an export; identical requests share one.
+            # The workbook depends only on the resource and format, so other query
+            # parameters must not make new keys (each key leaves files on disk).
+            response = file_response(
+                lambda file: write_export(file, file_type, filename_base, columns, rows),
+                f"{filename_base}.{extension}",
+                content_type,
+                shared_key=f"export:{resource}:{file_type}"
+            )
+        return metrics.observe_size(response, metrics.EXPORT_BYTES, resource, file_type)
 
-        document = Document()
-        for row in queryset:
-            document.add_paragraph(" | ".join(str(row.get(col, "")) for col in columns))
-        buffer = io.BytesIO()
-        document.save(buffer)
-        buffer.seek(0)
-        return HttpResponse(
-            buffer,
-            content_type="application/vnd.openxmlformats-officedocument.wordprocessingml.document"
-        )
+    @action(detail=False, methods=["GET"])
+    def export(self, request):
+        return self.export_queryset(self.get_queryset(), self.export_columns, self.export_title, self.export_formatters)
 
-class GenreViewSet(ModelViewSet, BaseExportMixin):
+class GenreViewSet(VersionETagMixin, SparseFieldsMixin, ModelViewSet, BaseExportMixin):
     queryset = Genre.objects.all()
     serializer_class = GenreSerializer
     permission_classes = [IsAuthenticated]
+    etag_models = (Genre,)
+    pagination_class = None
+    export_resource = "genres"
+    export_title = "Genres"
+    export_columns = {"ID": "id", "Name": "name", "User": "user__username"}
 
     @action(detail=False, methods=["GET"])
+    @cached_action(*stats.SECTION_MODELS["genres"])
     def stats(self, request):
-        top = Genre.objects.annotate(c=Count("book")).order_by("-c").first()
-        return Response({"count": self.get_queryset().count(), "top": getattr(top, "name", None)})
-
-    @action(detail=False, methods=["GET"])
-    def export(self, request):
-        data = [{"ID": g.id, "Name": g.name, "User": g.user.username if g.user else ""} for g in self.get_queryset()]
-        return self.export_queryset(data, ["ID", "Name", "User"], "Genres")
+        return Response(stats.genre_stats())
 
-class LibraryViewSet(ModelViewSet, BaseExportMixin):
+class LibraryViewSet(VersionETagMixin, SparseFieldsMixin, ModelViewSet, BaseExportMixin):
     queryset = Library.objects.all().order_by("name")
     serializer_class = LibrarySerializer
     permission_classes = [IsAuthenticated]
+    etag_models = (Library,)
+    pagination_class = None
+    export_resource = "libraries"
+    export_title = "Libraries"
+    export_columns = {"ID": "id", "Name": "name", "User": "user__username"}
 
     @action(detail=False, methods=["GET"])
+    @cached_action(*stats.SECTION_MODELS["libraries"])
     def stats(self, request):
-        top = Library.objects.annotate(c=Count("book__loan")).order_by("-c").first()
-        return Response({"count": self.get_queryset().count(), "top": getattr(top, "name", None)})
+        return Response(stats.library_stats())
 
-    @action(detail=False, methods=["GET"])
-    def export(self, request):
-        data = [{"ID": l.id, "Name": l.name, "User": l.user.username if l.user else ""} for l in self.get_queryset()]
-        return self.export_queryset(data, ["ID", "Name", "User"], "Libraries")
-
-class BookViewSet(ModelViewSet, BaseExportMixin):
+class BookViewSet(VersionETagMixin, ValuesListMixin, ModelViewSet, BaseExportMixin):
     queryset = Book.objects.all()
+    field_querysets = {
+        "genre_name": lambda queryset: queryset.select_related("genre"),
+        "library_name": lambda queryset: queryset.select_related("library"),
+        "is_available": lambda queryset: queryset.with_availability(),
+    }
     serializer_class = BookSerializer
+    values_serializer_class = BookValuesSerializer
     permission_classes = [IsAuthenticated]
+    etag_models = (Book, Genre, Library, Loan)
+    export_resource = "books"
+    export_title = "Books"
+    export_columns = {
+        "ID": "id",
+        "Title": "title",
+        "Genre": "genre__name",
+        "Library": "library__name",
+        "Status": "has_open_loan"
+    }
+    export_formatters = {"Status": lambda borrowed: "Borrowed" if borrowed else "Available"}
 
     @action(detail=False, methods=["GET"])
+    @cached_action(*stats.SECTION_MODELS["books"])
     def stats(self, request):
-        most = Loan.objects.values("book__id", "book__title").annotate(c=Count("book")).order_by("-c").first()
-        return Response({"count": self.get_queryset().count(), "most_borrowed": most})
-
-    @action(detail=False, methods=["GET"])
-    def export(self, request):
-        data = [{
-            "ID": b.id,
-            "Title": b.title,
-            "Genre": b.genre.name if b.genre else "",
-            "Library": b.library.name if b.library else "",
-            "Status": "Available" if b.is_available else "Borrowed"
-        } for b in self.get_queryset()]
-        return self.export_queryset(data, ["ID", "Title", "Genre", "Library", "Status"], "Books")
-
-class LoanViewSet(ModelViewSet, BaseExportMixin):
-    queryset = Loan.objects.select_related("book", "member", "user")
+        return Response(stats.book_stats())
+
+    @action(detail=False, methods=["POST"], url_path="import")
+    def import_catalog(self, request):
+        upload = request.FILES.get("file")
+        if upload is None:
+            return Response({"file": ["Файл не передан."]}, status=status.HTTP_400_BAD_REQUEST)
+        try:
+            result = import_books(read_rows(upload, upload.name), user=request.user)
+        except ImportFormatError as error:
+            return Response({"file": [str(error)]}, status=status.HTTP_400_BAD_REQUEST)
+        return Response(result)
+
+class LoanViewSet(VersionETagMixin, ValuesListMixin, ModelViewSet, BaseExportMixin):
+    queryset = Loan.objects.all()
+    field_querysets = {
+        "book_title": lambda queryset: queryset.select_related("book"),
+        "member_name": lambda queryset: queryset.select_related("member"),
+    }
     serializer_class = LoanSerializer
+    values_serializer_class = LoanValuesSerializer
     permission_classes = [IsAuthenticated]
+    etag_models = (Loan, Book, Member)
+    pagination_ordering = ("-loan_date", "-id")
+    export_resource = "loans"
+    export_title = "Loans"
+    export_columns = {
+        "ID": "id",
+        "Book": "book__title",
+        "Member": "member__first_name",
+        "User": "user__username",
+        "Loan Date": "loan_date",
+        "Return Date": "return_date"
+    }
+
+    def perform_create(self, serializer):
+        serializer.instance = checkout(user=self.request.user, **serializer.validated_data)
+
+    def perform_update(self, serializer):
+        serializer.instance = save_loan(serializer.instance, **serializer.validated_data)
 
     @action(detail=True, methods=["POST"], url_path="return")
     def return_book(self, request, pk=None):
-        loan = self.get_object()
-        loan.return_date = date.today()
-        loan.save()
+        loan = return_loan(self.get_object())
         return Response(self.get_serializer(loan).data)
 
+    @action(detail=False, methods=["POST"], url_path="bulk", serializer_class=BulkLoanSerializer)
+    def bulk_checkout(self, request):
+        serializer = self.get_serializer(data=request.data)
+        serializer.is_valid(raise_exception=True)
+        items = serializer.validated_data["items"]
+        loans, errors = bulk_checkout(items, request.user)
+        if errors:
+            results = [
+                {"index": index, "status": "error", "errors": errors[index]} if index in errors
+                else {"index": index, "status": "valid"}
+                for index in range(len(items))
+            ]
+            return Response({"results": results}, status=status.HTTP_400_BAD_REQUEST)
+        data = LoanSerializer(loans, many=True).data
+        results = [{"index": index, "status": "created", "loan": loan} for index, loan in enumerate(data)]
+        return Response({"results": results}, status=status.HTTP_201_CREATED)
+
+    @action(detail=False, methods=["POST"], url_path="bulk-return", serializer_class=BulkReturnSerializer)
+    def bulk_return(self, request):
+        serializer = self.get_serializer(data=request.data)
+        serializer.is_valid(raise_exception=True)
+        ids = serializer.validated_data["ids"]
+        outcome = bulk_return(ids)
+        return Response({"results": [{"id": pk, "status": outcome[pk]} for pk in ids]})
+
     @action(detail=False, methods=["GET"])
+    @cached_action(*stats.SECTION_MODELS["loans"])
     def stats(self, request):
-        top = self.get_queryset().values("member__first_name").annotate(c=Count("id")).order_by("-c").first()
-        return Response({"count": self.get_queryset().count(), "topReader": top})
+        return Response(stats.loan_stats())
 
-    @action(detail=False, methods=["GET"])
-    def export(self, request):
-        data = [{
-            "ID": l.id,
-            "Book": l.book.title if l.book else "",
-            "Member": l.member.first_name if l.member else "",
-            "User": l.user.username if l.user else "",
-            "Loan Date": l.loan_date,
-            "Return Date": l.return_date
-        } for l in self.get_queryset()]
-        return self.export_queryset(data, ["ID", "Book", "Member", "User", "Loan Date", "Return Date"], "Loans")
-
-class MemberViewSet(ModelViewSet, BaseExportMixin):
+class MemberViewSet(VersionETagMixin, ValuesListMixin, ModelViewSet, BaseExportMixin):
     queryset = User.objects.all()
+    field_querysets = {"age": lambda queryset: queryset.select_related("profile")}
     serializer_class = UserSerializer
+    values_serializer_class = UserValuesSerializer
     permission_classes = [IsAuthenticated]
+    etag_models = (User, UserProfile)
+    export_resource = "members"
+    export_title = "Members"
+    export_columns = {
+        "ID": "id",
+        "Username": "username",
+        "Email": "email",
+        "Role": "is_superuser",
+        "Age": "profile__age"
+    }
+    export_formatters = {"Role": lambda is_superuser: "Администратор" if is_superuser else "Читатель"}
 
     @action(detail=False, methods=["GET"])
+    @cached_action(*stats.SECTION_MODELS["members"])
     def stats(self, request):
-        return Response({
-            "count_users": self.get_queryset().count(),
-            "count_admins": self.get_queryset().filter(is_superuser=True).count()
-        })
+        return Response(stats.member_stats())
 
     def create(self, request, *args, **kwargs):
         data = request.data.copy()
@@ -247,13 +439,73 @@ class MemberViewSet(ModelViewSet, BaseExportMixin):
             profile.save()
         return Response(self.get_serializer(user).data)
 
-    @action(detail=False, methods=["GET"])
-    def export(self, request):
-        data = [{
-            "ID": u.id,
-            "Username": u.username,
-            "Email": u.email,
-            "Role": "Администратор" if u.is_superuser else "Читатель",
-            "Age": getattr(getattr(u, "userprofile", None), "age", "")
-        } for u in self.get_queryset()]
-        return self.export_queryset(data, ["ID", "Username", "Email", "Role", "Age"], "Members")
+class DashboardViewSet(GenericViewSet):
+    permission_classes = [IsAuthenticated]
+
+    @cached_action(*stats.DASHBOARD_MODELS)
+    def list(self, request):
+        return Response(stats.dashboard())
+
+class SearchViewSet(GenericViewSet):
+    permission_classes = [IsAuthenticated]
+
+    def list(self, request):
+        try:
+            limit = min(int(request.query_params.get("limit", SEARCH_LIMIT)), MAX_SEARCH_LIMIT)
+        except ValueError:
+            limit = SEARCH_LIMIT
+        types = request.query_params.get("type")
+        return Response({"results": search(
+            request.query_params.get("q", ""),
+            types=types.split(",") if types else None,
+            limit=max(limit, 1)
+        )})
+
+class SyncViewSet(GenericViewSet):
+    permission_classes = [IsAuthenticated]
+
+    def list(self, request):
+        return Response(sync.changes(request.query_params.get("since")))
+
+class AutocompleteViewSet(GenericViewSet):
+    permission_classes = [IsAuthenticated]
+
+    def list(self, request):
+        try:
+            limit = min(int(request.query_params.get("limit", AUTOCOMPLETE_LIMIT)), MAX_AUTOCOMPLETE_LIMIT)
+        except ValueError:
+            limit = AUTOCOMPLETE_LIMIT
+        types = request.query_params.get("type")
+        return Response({"results": autocomplete.lookup(
+            request.query_params.get("q", ""),
+            types=types.split(",") if types else None,
+            limit=max(limit, 1)
+        )})
+
+    @action(detail=False, methods=["GET"], permission_classes=[permissions.IsAdminUser])
+    def stats(self, request):
+        return Response(autocomplete.memory_usage())
+
+class ExportJobViewSet(mixins.CreateModelMixin, mixins.RetrieveModelMixin, GenericViewSet):
+    serializer_class = ExportJobSerializer
+    permission_classes = [IsAuthenticated]
+
+    def get_queryset(self):
+        return ExportJob.objects.filter(user=self.request.user)
+
+    def create(self, request, *args, **kwargs):
+        serializer = self.get_serializer(data=request.data)
+        serializer.is_valid(raise_exception=True)
+        job = create_job(serializer.validated_data["resource"], serializer.validated_data["file_type"], request.user)
+        return Response(self.get_serializer(job).data, status=status.HTTP_202_ACCEPTED)
+
+    @action(detail=False, methods=["GET"], url_path=r"download/(?P<token>[\w-]+)", url_name="download",
+            permission_classes=[permissions.AllowAny])
+    def download(self, request, token=None):
+        job = ExportJob.objects.filter(token=token, status=ExportJob.DONE, expires_at__gt=timezone.now()).first()
+        if job is None or not job.file:
+            raise Http404
+        extension, content_type = EXPORT_FORMATS[job.file_type]
+        viewset = BaseExportMixin.registry[job.resource]
+        return FileResponse(job.file.open("rb"), as_attachment=True,
+                            filename=f"{viewset.export_title}.{extension}", content_type=content_type)
@@ -0,0 +1,265 @@
+import logging
+import re
+import sys
+import threading
+import time
+from array import array
+from bisect import bisect_left, insort
+from itertools import chain, islice
+
+from django.conf import settings
+
+from library import versions
+from library.models import Book, Member
+from library.search import fold, words
+
+logger = logging.getLogger(__name__)
+
+AUTOCOMPLETE_LIMIT = 10
+MAX_AUTOCOMPLETE_LIMIT = 50
+# Postings walked and matches ranked per lookup; they bound the worst case
+# for one-letter prefixes and frequent words.
+MAX_SCAN = 1000
+MAX_CANDIDATES = 50
+# One text check costs about as much as walking this many postings.
+TEXT_CHECK_COST = 200
+
+# kind -> (type name, model, field); an object is stored as ``id * 2 + kind``.
+SOURCES = {
+    0: ("book", Book, "title"),
+    1: ("member", Member, "first_name"),
+}
+KINDS = {name: kind for kind, (name, _, _) in SOURCES.items()}
+
+
+def ref(kind, pk):
+    return pk * len(SOURCES) + kind
+
+
+class PrefixIndex:
+    """Sorted array of distinct words, each with an ``array('q')`` of the objects containing it.
+
+    A prefix lookup is a bisect over the words plus a bounded walk through
+    their postings; adding or removing an object only touches its own words.
+    """
+
+    def __init__(self):
+        self.words = []
+        self.postings = {}
+        self.texts = {}
+
+    @classmethod
+    def build(cls, items):
+        """Index ``(ref, text)`` pairs, sorting the vocabulary once at the end."""
+        index = cls()
+        postings = index.postings
+        for key, text in items:
+            index.texts[key] = text
+            for token in set(words(text)):
+                posting = postings.get(token)
+                if posting is None:
+                    posting = postings[sys.intern(token)] = array("q")
+                posting.append(key)
+        index.words = sorted(postings)
+        return index
+
+    def add(self, key, text):
+        self.remove(key)
+        self.texts[key] = text
+        for token in set(words(text)):
+            posting = self.postings.get(token)
+            if posting is None:
+                posting = self.postings[sys.intern(token)] = array("q")
+                insort(self.words, token)
+            posting.append(key)
+
+    def remove(self, key):
+        text = self.texts.pop(key, None)
+        if text is None:
+            return
+        for token in set(words(text)):
+            posting = self.postings[token]
+            posting.remove(key)
+            if not posting:
+                del self.postings[token]
+                del self.words[bisect_left(self.words, token)]
+
+    def _words_with(self, prefix):
+        position = bisect_left(self.words, prefix)
+        while position < len(self.words) and self.words[position].startswith(prefix):
+            yield self.words[position]
+            position += 1
+
+    def _matches(self, prefix):
+        # chain() walks the posting arrays in C, with no Python frame per entry.
+        return chain.from_iterable(self.postings[word] for word in self._words_with(prefix))
+
+    def _count(self, prefix, cap):
+        total = 0
+        for word in self._words_with(prefix):
+            total += len(self.postings[word])
+            if total >= cap:
+                break
+        return total
+
+    def lookup(self, query, kinds, limit):
+        query_words = words(query)
+        if not query_words:
+            return []
+        # Walk the postings of the rarest word; every other word must start some word of the text.
+        anchor = min(query_words, key=lambda word: self._count(word, MAX_SCAN))
+        others = list(query_words)
+        others.remove(anchor)
+        keys = dict.fromkeys(islice(self._matches(anchor), MAX_SCAN))
+        # Each other word is either intersected with its postings or checked in the candidate
+        # texts, whichever is cheaper: texts are scattered over memory, postings are sequential.
+        common = []
+        for word in others:
+            budget = len(keys) * TEXT_CHECK_COST
+            if self._count(word, budget) < budget:
+                allowed = set(keys).intersection(self._matches(word))
+                keys = [key for key in keys if key in allowed]
+            else:
+                common.append(word)
+        pattern = re.compile("".join(rf"(?=.*\b{re.escape(word)})" for word in common)) if common else None
+        kinds = set(kinds)
+        candidates = []
+        for key in keys:
+            if key % len(SOURCES) not in kinds:
+                continue
+            text = self.texts[key]
+            if pattern:
+                folded = fold(text)
+                if not all(word in folded for word in common) or not pattern.match(folded):
+                    continue
+            candidates.append((key, text))
+            if len(candidates) >= MAX_CANDIDATES:
+                break
+
+        # Texts that start with what was typed come first, then shorter ones.
+        typed = fold(query.strip())
+        candidates.sort(key=lambda item: (not fold(item[1]).startswith(typed), len(item[1]), item[1]))
+        return [
+            {"type": SOURCES[key % len(SOURCES)][0], "id": key // len(SOURCES), "text": text}
+            for key, text in candidates[:limit]
+        ]
+
+    def memory_usage(self):
+        """Approximate bytes held by the index, counting each interned word once."""
+        return {
+            "objects": len(self.texts),
+            "words": len(self.words),
+            "entries": sum(len(posting) for posting in self.postings.values()),
+            "bytes": (
+                sys.getsizeof(self.words)
+                + sys.getsizeof(self.postings)
+                + sum(sys.getsizeof(token) + sys.getsizeof(posting) for token, posting in self.postings.items())
+                + sys.getsizeof(self.texts)
+                + sum(sys.getsizeof(key) + sys.getsizeof(text) for key, text in self.texts.items())
+            ),
+        }
+
+
+def load():
+    def items():
+        for kind, (_, model, field) in SOURCES.items():
+            for pk, text in model.objects.values_list("id", field).iterator(chunk_size=5000):
+                yield ref(kind, pk), text or ""
+    return PrefixIndex.build(items())
+
+
+MODELS = [model for _, model, _ in SOURCES.values()]
+
+_index = None
+# versions.snapshot(MODELS) taken when the current index started loading
+_seen = None
+_checked_at = 0.0
+_lock = threading.Lock()
+# Changes seen while a build is loading; replayed onto the new index before it is swapped in.
+_pending = None
+_EMPTY = PrefixIndex()
+
+
+def get_index():
+    """The process-wide index; empty until its first build is done.
+
+    The first call starts the build (in a thread unless
+    ``AUTOCOMPLETE_BUILD_IN_BACKGROUND`` is off) and nothing waits for it.
+    Saves made by this process reach the index through signals; every
+    ``AUTOCOMPLETE_REFRESH`` seconds a background check rebuilds it if the
+    version counters show another process changed books or members.
+    """
+    if _index is None or time.monotonic() - _checked_at > settings.AUTOCOMPLETE_REFRESH:
+        _start_refresh()
+    return _index if _index is not None else _EMPTY
+
+
+def _start_refresh():
+    global _pending, _checked_at
+    with _lock:
+        if _pending is not None:
+            return
+        _pending = []
+        _checked_at = time.monotonic()
+    if _index is None and not settings.AUTOCOMPLETE_BUILD_IN_BACKGROUND:
+        _refresh()
+    else:
+        threading.Thread(target=_refresh, args=(True,), daemon=True).start()
+
+
+def _refresh(background=False):
+    global _index, _seen, _pending
+    from django.db import connection
+
+    try:
+        seen = versions.snapshot(MODELS)
+        index = load() if _index is None or versions.changed_elsewhere(_seen, seen) else None
+    except Exception:
+        logger.exception("Autocomplete index was not built")
+        with _lock:
+            _pending = None
+        return
+    finally:
+        if background:
+            connection.close()
+    with _lock:
+        if index is not None:
+            for change in _pending or ():
+                _apply(index, *change)
+            _index = index
+        _seen, _pending = seen, None
+
+
+def _apply(index, key, text):
+    if text is None:
+        index.remove(key)
+    else:
+        index.add(key, text)
+
+
+def update(kind, pk, text=None):
+    """Add or replace (``text``) or drop (``text=None``) one object; kept for a build in progress."""
+    with _lock:
+        if _index is not None:
+            _apply(_index, ref(kind, pk), text)
+        if _pending is not None:
+            _pending.append((ref(kind, pk), text))
+
+
+def lookup(query, types=None, limit=AUTOCOMPLETE_LIMIT):
+    kinds = [KINDS[name] for name in types or KINDS if name in KINDS]
+    index = get_index()
+    with _lock:
+        return index.lookup(query, kinds, limit)
+
+
+def memory_usage():
+    index = get_index()
+    with _lock:
+        return index.memory_usage()
+
+
+def reset():
+    global _index, _seen, _pending
+    with _lock:
+        _index, _seen, _pending = None, None, None
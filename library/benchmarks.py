@@ -0,0 +1,167 @@
+import io
+import json
+import math
+import time
+import tracemalloc
+from contextlib import contextmanager
+from pathlib import Path
+
+from django.contrib.auth.models import User
+from django.core.cache import caches
+from django.core.management import call_command
+from django.db import connection
+from django.test import Client
+from django.test.utils import CaptureQueriesContext, setup_test_environment, teardown_test_environment
+from django.urls import reverse
+
+from library import response_cache
+from library.exports import EXPORT_FORMATS
+from library.management.commands.generate_data import LOANS_PER_SCALE
+
+BUDGETS_PATH = Path(__file__).with_name("benchmark_budgets.json")
+
+
+@contextmanager
+def test_database(name=None):
+    """Run the block against a throwaway test database so benchmarks never touch real data.
+
+    SQLite test databases live in memory unless ``name`` gives a file; only a
+    file lets concurrent writers wait for each other instead of failing.
+    """
+    test_settings = connection.settings_dict["TEST"]
+    default_name = test_settings["NAME"]
+    test_settings["NAME"] = name or default_name
+    setup_test_environment()
+    old_name = connection.creation.create_test_db(verbosity=0, autoclobber=True)
+    try:
+        yield
+    finally:
+        connection.creation.destroy_test_db(old_name, verbosity=0)
+        teardown_test_environment()
+        test_settings["NAME"] = default_name
+
+
+def benchmark_client():
+    user, _ = User.objects.get_or_create(username="benchmark", defaults={"is_superuser": True, "is_staff": True})
+    client = Client()
+    client.force_login(user)
+    return client
+
+
+def seed_loans(count, seed=0):
+    """Top the database up to ``count`` loans with generate_data's realistic distribution."""
+    call_command(
+        "generate_data", "--scale", str(count / LOANS_PER_SCALE), "--seed", str(seed), stdout=io.StringIO()
+    )
+
+
+def endpoint_cases(router):
+    """Yield ``(name, url)`` for every GET route on the router that needs no extra URL arguments.
+
+    Covers list, detail (first row of the viewset's queryset) and each
+    ``detail=False`` GET action; exports are expanded once per format.
+    """
+    for prefix, viewset, basename in router.registry:
+        if hasattr(viewset, "list"):
+            yield f"{basename}-list", reverse(f"{basename}-list")
+        queryset = getattr(viewset, "queryset", None)
+        if hasattr(viewset, "retrieve") and queryset is not None:
+            pk = queryset.order_by("pk").values_list("pk", flat=True).first()
+            if pk is not None:
+                yield f"{basename}-detail", reverse(f"{basename}-detail", args=[pk])
+        for extra in viewset.get_extra_actions():
+            if extra.detail or "get" not in extra.mapping or "(?P<" in extra.url_path:
+                continue
+            url = reverse(f"{basename}-{extra.url_name}")
+            if extra.url_name == "export":
+                for file_type in EXPORT_FORMATS:
+                    yield f"{basename}-export-{file_type}", f"{url}?type={file_type}"
+            else:
+                yield f"{basename}-{extra.url_name}", url
+
+
+def run_cases(client, cases, trace_memory=True, repeat=3):
+    """Measure every case: one warm-up call, the median of ``repeat`` timed calls, then one traced for memory.
+
+    The response cache is emptied before each call, so every call does the
+    full work; tracemalloc slows code down, so it never runs on a timed call.
+    """
+    results = {}
+    for name, url in cases:
+        def call():
+            caches[response_cache.CACHE_ALIAS].clear()
+            response = client.get(url)
+            return response.status_code, consume(response)
+        call()
+        runs = sorted((measure(call, trace_memory=False) for _ in range(repeat)), key=lambda run: run["seconds"])
+        result = runs[len(runs) // 2]
+        if trace_memory:
+            result["peak_bytes"] = measure(call)["peak_bytes"]
+        status_code, size = result.pop("result")
+        results[name] = {"url": url, "status": status_code, "bytes": size, **result}
+    return results
+
+
+def load_budgets(path=BUDGETS_PATH):
+    path = Path(path)
+    return json.loads(path.read_text()) if path.exists() else {}
+
+
+def check_budgets(results, budgets, size):
+    """Return a readable line for every endpoint that failed, has no budget or went over it."""
+    violations = []
+    for name, result in results.items():
+        budget = budgets.get(name)
+        if result["status"] >= 400:
+            violations.append(f"{name}: HTTP {result['status']}")
+        if budget is None:
+            violations.append(f"{name}: нет бюджета")
+            continue
+        if result["queries"] > budget["queries"]:
+            violations.append(f"{name}: {result['queries']} SQL-запросов при бюджете {budget['queries']}")
+        limits = budget.get("sizes", {}).get(str(size))
+        if limits is None:
+            violations.append(f"{name}@{size}: нет бюджета для этого размера")
+            continue
+        if "ms" in limits and result["seconds"] * 1000 > limits["ms"]:
+            violations.append(f"{name}@{size}: {result['seconds'] * 1000:.0f} мс при бюджете {limits['ms']}")
+        if "peak_mb" in limits and result.get("peak_bytes", 0) / 2**20 > limits["peak_mb"]:
+            violations.append(f"{name}@{size}: {result['peak_bytes'] / 2**20:.1f} МБ при бюджете {limits['peak_mb']}")
+    return violations
+
+
+def record_budgets(budgets, results, size, time_headroom=3.0, memory_headroom=1.5):
+    """Fold measured ``results`` into ``budgets``: exact query counts, padded time and memory."""
+    for name, result in results.items():
+        budget = budgets.setdefault(name, {"queries": 0, "sizes": {}})
+        budget["queries"] = max(budget["queries"], result["queries"])
+        limits = {"ms": math.ceil(result["seconds"] * 1000 * time_headroom) + 10}
+        if "peak_bytes" in result:
+            limits["peak_mb"] = round(result["peak_bytes"] / 2**20 * memory_headroom + 1, 1)
+        budget["sizes"][str(size)] = limits
+    return budgets
+
+
+def consume(response):
+    """Drain a (streaming) response the way a WSGI server would and return its size in bytes."""
+    if response.streaming:
+        size = sum(len(chunk) for chunk in response.streaming_content)
+        response.close()
+        return size
+    return len(response.content)
+
+
+def measure(fn, trace_memory=True):
+    """Call ``fn`` and report wall time, SQL query count and, optionally, peak traced memory."""
+    if trace_memory:
+        tracemalloc.start()
+        tracemalloc.reset_peak()
+    with CaptureQueriesContext(connection) as queries:
+        started = time.perf_counter()
+        result = fn()
+        seconds = time.perf_counter() - started
+    stats = {"seconds": seconds, "queries": len(queries), "result": result}
+    if trace_memory:
+        stats["peak_bytes"] = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+    return stats
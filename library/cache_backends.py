@@ -0,0 +1,47 @@
+from django.core.cache.backends.base import DEFAULT_TIMEOUT
+from django.core.cache.backends.locmem import LocMemCache
+
+# Pickled bytes per cache LOCATION; like LocMemCache's own storage it is shared
+# by the per-thread backend instances and guarded by their shared lock.
+_sizes = {}
+
+
+class SizeBoundedLocMemCache(LocMemCache):
+    """LocMemCache that also evicts least recently used entries past ``OPTIONS["MAX_BYTES"]``.
+
+    LocMemCache keeps its OrderedDict most recently used first, so the
+    eviction candidate is always the last entry.
+    """
+
+    def __init__(self, name, params):
+        super().__init__(name, params)
+        self._max_bytes = int(params.get("OPTIONS", {}).get("MAX_BYTES", 0))
+        self._size = _sizes.setdefault(name, [0])
+
+    def _set(self, key, value, timeout=DEFAULT_TIMEOUT):
+        self._delete(key)
+        super()._set(key, value, timeout)
+        self._size[0] += len(value)
+        while self._max_bytes and self._size[0] > self._max_bytes and len(self._cache) > 1:
+            self._delete(next(reversed(self._cache)))
+
+    def _delete(self, key):
+        value = self._cache.get(key)
+        deleted = super()._delete(key)
+        if deleted:
+            self._size[0] -= len(value)
+        return deleted
+
+    def _cull(self):
+        super()._cull()
+        self._size[0] = sum(len(value) for value in self._cache.values())
+
+    def clear(self):
+        with self._lock:
+            self._cache.clear()
+            self._expire_info.clear()
+            self._size[0] = 0
+
+    @property
+    def size(self):
+        return self._size[0]
@@ -0,0 +1,279 @@
+import asyncio
+import glob
+import itertools
+import json
+import os
+import socket
+import threading
+import uuid
+from collections import deque
+from functools import partial
+
+from django.conf import settings
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db import transaction
+
+# Events buffered per subscriber; a client that falls this far behind is told to resync.
+QUEUE_SIZE = 256
+# Recent events kept for clients reconnecting with Last-Event-ID.
+REPLAY_SIZE = 1000
+RETRY_MS = 3000
+DATAGRAM_SIZE = 65536
+
+_OVERFLOW = object()
+
+
+class Subscription:
+    __slots__ = ("loop", "queue")
+
+    def __init__(self, loop):
+        self.loop = loop
+        self.queue = asyncio.Queue(QUEUE_SIZE)
+
+
+def _deliver(subscriptions, item):
+    for subscription in subscriptions:
+        try:
+            subscription.queue.put_nowait(item)
+        except asyncio.QueueFull:
+            while not subscription.queue.empty():
+                subscription.queue.get_nowait()
+            subscription.queue.put_nowait(_OVERFLOW)
+
+
+class Broker:
+    """Publish from any thread to subscribers waiting in asyncio event loops.
+
+    Subscribers are grouped by loop, so one publish costs one
+    ``call_soon_threadsafe`` per loop, not per subscriber; an idle
+    subscriber is just a small queue and a suspended coroutine.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._loops = {}
+        self._restart()
+
+    def _restart(self):
+        # Ids are "<boot>-<n>": a Last-Event-ID from another process or an
+        # earlier run of this one never matches the prefix and gets a resync.
+        self._pid = os.getpid()
+        self.boot = uuid.uuid4().hex[:12]
+        self._ids = itertools.count(1)
+        self._last_id = 0
+        self._recent = deque(maxlen=REPLAY_SIZE)
+
+    def _check_fork(self):
+        # A forked worker must not reuse the ids of its parent.
+        if self._pid != os.getpid():
+            self._restart()
+
+    def subscribe(self, last_id=None):
+        subscription = Subscription(asyncio.get_running_loop())
+        with self._lock:
+            self._check_fork()
+            self._loops.setdefault(subscription.loop, set()).add(subscription)
+            missed = self._missed(last_id)
+        if missed is None:
+            subscription.queue.put_nowait(_OVERFLOW)
+        for item in missed or ():
+            _deliver([subscription], item)
+        return subscription
+
+    def _missed(self, last_id):
+        # None when the gap is not in the replay buffer: too old, or an id from another process.
+        if last_id is None:
+            return []
+        boot, _, number = last_id.rpartition("-")
+        if boot != self.boot or not number.isdigit():
+            return None
+        last_id = int(number)
+        if last_id == self._last_id:
+            return []
+        first = self._recent[0][0] if self._recent else self._last_id + 1
+        if not first - 1 <= last_id < self._last_id:
+            return None
+        return [item for item in self._recent if item[0] > last_id]
+
+    def unsubscribe(self, subscription):
+        with self._lock:
+            subscriptions = self._loops.get(subscription.loop)
+            if subscriptions is not None:
+                subscriptions.discard(subscription)
+                if not subscriptions:
+                    del self._loops[subscription.loop]
+
+    def publish(self, event):
+        with self._lock:
+            self._check_fork()
+            self._last_id = next(self._ids)
+            # Formatted once here rather than once per subscriber.
+            item = (self._last_id, event, format_event(f"{self.boot}-{self._last_id}", event))
+            self._recent.append(item)
+            targets = [(loop, list(subscriptions)) for loop, subscriptions in self._loops.items()]
+        for loop, subscriptions in targets:
+            try:
+                loop.call_soon_threadsafe(_deliver, subscriptions, item)
+            except RuntimeError:
+                pass  # the loop was closed
+        return item
+
+    def subscriber_count(self):
+        with self._lock:
+            return sum(len(subscriptions) for subscriptions in self._loops.values())
+
+    def recent(self):
+        with self._lock:
+            return [event for _, event, _ in self._recent]
+
+
+class Fanout:
+    """Multi-process stand-in for a message bus: one unix datagram socket per process in ``directory``.
+
+    Every process sends each event to the sockets of all the others;
+    processes with subscribers run a thread that reads their own socket
+    into the broker. Sockets of dead processes are removed by the first
+    sender that finds them refusing. A receiver whose buffer is full misses
+    the event, and its clients see a gap.
+    """
+
+    def __init__(self, broker, directory):
+        self.broker = broker
+        self.directory = directory
+        self.pid = None
+        self.path = None
+        self._sender = None
+        self._lock = threading.Lock()
+
+    def _own_path(self):
+        return os.path.join(self.directory, f"events_{os.getpid()}.sock")
+
+    def listen(self):
+        with self._lock:
+            if self.pid == os.getpid():
+                return
+            os.makedirs(self.directory, exist_ok=True)
+            path = self._own_path()
+            if os.path.exists(path):
+                os.unlink(path)
+            receiver = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+            receiver.bind(path)
+            self.pid, self.path = os.getpid(), path
+        threading.Thread(target=self._receive, args=(receiver,), daemon=True).start()
+
+    def _receive(self, receiver):
+        while True:
+            data = receiver.recv(DATAGRAM_SIZE)
+            try:
+                event = json.loads(data)
+            except ValueError:
+                continue
+            self.broker.publish(event)
+
+    def send(self, event):
+        data = json.dumps(event, cls=DjangoJSONEncoder).encode()
+        if self._sender is None:
+            self._sender = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+            self._sender.setblocking(False)
+        own = self._own_path()
+        for path in glob.glob(os.path.join(self.directory, "events_*.sock")):
+            if path == own:
+                continue
+            try:
+                self._sender.sendto(data, path)
+            except (ConnectionRefusedError, FileNotFoundError):
+                try:
+                    os.unlink(path)
+                except FileNotFoundError:
+                    pass
+            except BlockingIOError:
+                pass
+
+
+BROKER = Broker()
+_fanout = None
+
+
+def fanout():
+    global _fanout
+    directory = getattr(settings, "EVENTS_FANOUT_DIR", None)
+    if not directory:
+        return None
+    if _fanout is None or _fanout.directory != str(directory):
+        _fanout = Fanout(BROKER, str(directory))
+    return _fanout
+
+
+def publish(event):
+    """Deliver ``event`` (a dict with a ``type``) to subscribers here and, with a fan-out dir, in other processes."""
+    BROKER.publish(event)
+    bus = fanout()
+    if bus is not None:
+        bus.send(event)
+
+
+def publish_on_commit(events):
+    if events:
+        transaction.on_commit(partial(_publish_all, events))
+
+
+def _publish_all(events):
+    for event in events:
+        publish(event)
+
+
+def format_event(event_id, event):
+    data = json.dumps({key: value for key, value in event.items() if key != "type"}, cls=DjangoJSONEncoder)
+    return f"id: {event_id}\nevent: {event['type']}\ndata: {data}\n\n"
+
+
+async def _get(queue, timeout):
+    # asyncio.timeout (3.11+) only arms a timer; wait_for wraps every wait in a task.
+    if hasattr(asyncio, "timeout"):
+        async with asyncio.timeout(timeout):
+            return await queue.get()
+    return await asyncio.wait_for(queue.get(), timeout)
+
+
+async def stream(last_id=None, heartbeat=None):
+    """Server-Sent Events text for one client, until it disconnects.
+
+    After a gap the replay buffer cannot fill (or a queue overflow) the
+    client gets a ``resync`` event and should reload through /api/sync/.
+    """
+    heartbeat = settings.EVENTS_HEARTBEAT if heartbeat is None else heartbeat
+    bus = fanout()
+    if bus is not None:
+        bus.listen()
+    subscription = BROKER.subscribe(last_id)
+    try:
+        yield f"retry: {RETRY_MS}\n\n"
+        while True:
+            try:
+                item = await _get(subscription.queue, heartbeat)
+            except asyncio.TimeoutError:
+                yield ": ping\n\n"
+                continue
+            if item is _OVERFLOW:
+                yield "event: resync\ndata: {}\n\n"
+                continue
+            yield item[2]
+    finally:
+        BROKER.unsubscribe(subscription)
+
+
+def loan_events(loan, change):
+    """Events for a loan ``created``, ``returned`` or ``deleted``, with the book's new availability."""
+    event = {"type": f"loan.{change}", "loan": loan.pk, "book": loan.book_id}
+    if change == "created":
+        event.update(member=loan.member_id, loan_date=loan.loan_date, return_date=loan.return_date)
+        available = loan.return_date is not None
+    elif change == "returned":
+        event.update(return_date=loan.return_date)
+        available = True
+    else:
+        available = True
+    events = [event]
+    if change != "deleted" or loan.return_date is None:
+        events.append({"type": "book.availability", "book": loan.book_id, "is_available": available})
+    return events
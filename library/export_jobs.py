@@ -0,0 +1,128 @@
+import logging
+import multiprocessing
+import os
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from datetime import timedelta
+
+import django
+from django.conf import settings
+from django.core.files.storage import default_storage
+from django.db import transaction
+from django.utils import timezone
+
+from library import metrics
+from library.exports import EXPORT_FORMATS
+from library.models import ExportJob
+
+logger = logging.getLogger(__name__)
+
+_executor = None
+_executor_lock = threading.Lock()
+
+
+def _init_worker(settings_module):
+    os.environ.setdefault("DJANGO_SETTINGS_MODULE", settings_module)
+    django.setup()
+
+
+def get_executor():
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            _executor = ProcessPoolExecutor(
+                max_workers=settings.EXPORT_JOB_WORKERS,
+                mp_context=multiprocessing.get_context("spawn"),
+                initializer=_init_worker,
+                initargs=(os.environ["DJANGO_SETTINGS_MODULE"],)
+            )
+        return _executor
+
+
+def create_job(resource, file_type, user=None):
+    cleanup_expired_jobs()
+    job = ExportJob.objects.create(resource=resource, file_type=file_type, user=user)
+    if settings.EXPORT_JOB_WORKERS:
+        # Jobs a dead worker or a lost pool left behind go in with the new one.
+        job_ids = [*stranded_jobs(), job.pk]
+        transaction.on_commit(lambda: submit_jobs(job_ids))
+    return job
+
+
+def submit_jobs(job_ids):
+    # A job submitted twice runs once: run_export_job claims it with a conditional UPDATE.
+    global _executor
+    try:
+        executor = get_executor()
+        for job_id in job_ids:
+            executor.submit(run_export_job, job_id)
+    except BrokenProcessPool:
+        # A crashed worker poisons the pool and takes its queue with it: start a
+        # fresh pool and hand it every job still waiting.
+        logger.exception("Export pool is broken, restarting it")
+        with _executor_lock:
+            _executor = None
+        executor = get_executor()
+        for job_id in ExportJob.objects.filter(status=ExportJob.PENDING).order_by("id").values_list("id", flat=True):
+            executor.submit(run_export_job, job_id)
+
+
+def run_export_job(job_id):
+    from library.api import BaseExportMixin
+
+    started = ExportJob.objects.filter(pk=job_id, status=ExportJob.PENDING).update(
+        status=ExportJob.RUNNING, started_at=timezone.now()
+    )
+    if not started:
+        return
+    job = ExportJob.objects.get(pk=job_id)
+    # Anything short of a finished file, interruptions included, leaves the job failed.
+    job.status, job.error, path = ExportJob.FAILED, "Выгрузка прервана.", None
+    try:
+        viewset = BaseExportMixin.registry[job.resource]
+        extension, _ = EXPORT_FORMATS[job.file_type]
+        name = f"exports/{job.token}.{extension}"
+        path = default_storage.path(name)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, "wb") as file:
+            viewset.write_export(file, job.file_type)
+        job.file.name = name
+        job.status, job.error = ExportJob.DONE, ""
+        metrics.EXPORT_BYTES.observe(os.path.getsize(path), viewset.export_resource, job.file_type)
+    except Exception as error:
+        logger.exception("Export job %s failed", job_id)
+        job.error = str(error)
+    finally:
+        if job.status != ExportJob.DONE and path is not None and os.path.exists(path):
+            os.remove(path)
+        job.finished_at = timezone.now()
+        job.expires_at = job.finished_at + timedelta(seconds=settings.EXPORT_JOB_TTL)
+        job.save(update_fields=["file", "status", "error", "finished_at", "expires_at"])
+
+
+def requeue_stale_jobs():
+    """Put back jobs left running by a worker process that died; returns their ids."""
+    stale = timezone.now() - timedelta(seconds=settings.EXPORT_JOB_TIMEOUT)
+    jobs = ExportJob.objects.filter(status=ExportJob.RUNNING, started_at__lt=stale)
+    job_ids = list(jobs.values_list("id", flat=True))
+    jobs.filter(pk__in=job_ids).update(status=ExportJob.PENDING, started_at=None)
+    return job_ids
+
+
+def stranded_jobs():
+    """Ids of jobs no pool will run: requeued stale ones and ones pending for longer than a job may take.
+
+    The latter were queued in a pool that is gone (a restarted process, a broken pool).
+    """
+    stale = timezone.now() - timedelta(seconds=settings.EXPORT_JOB_TIMEOUT)
+    waiting = ExportJob.objects.filter(status=ExportJob.PENDING, created_at__lt=stale).values_list("id", flat=True)
+    return sorted({*requeue_stale_jobs(), *waiting})
+
+
+def cleanup_expired_jobs():
+    # Only finished jobs expire; a worker may still be writing the others.
+    expired = ExportJob.objects.filter(status__in=[ExportJob.DONE, ExportJob.FAILED], expires_at__lt=timezone.now())
+    for name in expired.exclude(file="").values_list("file", flat=True):
+        default_storage.delete(name)
+    return expired.delete()[0]
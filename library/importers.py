@@ -0,0 +1,116 @@
+import csv
+import io
+import os
+import zipfile
+
+from django.db import transaction
+from openpyxl import load_workbook
+from openpyxl.utils.exceptions import InvalidFileException
+
+from library.models import Library, Book, Genre
+from library.signals import post_bulk_create
+
+IMPORT_BATCH_SIZE = 2000
+MAX_REPORTED_ERRORS = 1000
+
+COLUMNS = {
+    "title": "title", "название": "title",
+    "genre": "genre", "жанр": "genre",
+    "library": "library", "библиотека": "library",
+    "address": "address", "адрес": "address",
+}
+REQUIRED = ("title", "genre", "library")
+REQUIRED_MESSAGE = "Обязательное поле."
+UNREADABLE_MESSAGE = "Не удалось прочитать файл: нужен .xlsx или .csv в кодировке UTF-8."
+
+
+class ImportFormatError(ValueError):
+    pass
+
+
+def read_rows(file, filename):
+    """Yield raw rows from an .xlsx or .csv upload without loading it into memory.
+
+    A file that cannot be read, up front or partway through, raises ``ImportFormatError``.
+    """
+    try:
+        if os.path.splitext(filename)[1].lower() in (".xlsx", ".xlsm"):
+            workbook = load_workbook(file, read_only=True, data_only=True)
+            try:
+                yield from workbook.active.iter_rows(values_only=True)
+            finally:
+                workbook.close()
+        else:
+            yield from csv.reader(io.TextIOWrapper(file, encoding="utf-8-sig", newline=""))
+    except (zipfile.BadZipFile, InvalidFileException, KeyError, UnicodeDecodeError, csv.Error) as error:
+        raise ImportFormatError(UNREADABLE_MESSAGE) from error
+
+
+def _clean(value):
+    return "" if value is None else str(value).strip()
+
+
+def _positions(header):
+    positions = {}
+    for index, name in enumerate(header or ()):
+        column = COLUMNS.get(_clean(name).casefold())
+        if column and column not in positions:
+            positions[column] = index
+    missing = [column for column in REQUIRED if column not in positions]
+    if missing:
+        raise ImportFormatError(f"В заголовке нет колонок: {', '.join(missing)}")
+    return positions
+
+
+def import_books(rows, batch_size=IMPORT_BATCH_SIZE, user=None):
+    """Insert books from ``rows`` (header first) in bulk_create batches.
+
+    Genre and library names are resolved case-insensitively against maps loaded
+    once up front; unknown names are created. Invalid rows are skipped and
+    reported as ``{"row": <1-based line>, "errors": {...}}``. The import is one
+    transaction: a file that turns out unreadable partway leaves nothing behind,
+    so it can simply be uploaded again.
+    """
+    with transaction.atomic():
+        return _import_books(rows, batch_size, user)
+
+
+def _import_books(rows, batch_size, user):
+    rows = iter(rows)
+    positions = _positions(next(rows, None))
+    genres = {name.casefold(): pk for pk, name in Genre.objects.values_list("id", "name")}
+    libraries = {name.casefold(): pk for pk, name in Library.objects.values_list("id", "name")}
+    result = {"created": 0, "errors": [], "errors_total": 0}
+    batch = []
+
+    def flush():
+        Book.objects.bulk_create(batch)
+        post_bulk_create.send(sender=Book, instances=batch)
+        result["created"] += len(batch)
+        batch.clear()
+
+    for number, row in enumerate(rows, start=2):
+        values = {column: _clean(row[index]) if index < len(row) else "" for column, index in positions.items()}
+        if not any(values.values()):
+            continue
+        errors = {column: [REQUIRED_MESSAGE] for column in REQUIRED if not values[column]}
+        if errors:
+            result["errors_total"] += 1
+            if len(result["errors"]) < MAX_REPORTED_ERRORS:
+                result["errors"].append({"row": number, "errors": errors})
+            continue
+
+        genre_key, library_key = values["genre"].casefold(), values["library"].casefold()
+        if genre_key not in genres:
+            genres[genre_key] = Genre.objects.create(name=values["genre"], user=user).pk
+        if library_key not in libraries:
+            libraries[library_key] = Library.objects.create(
+                name=values["library"], address=values.get("address", ""), user=user
+            ).pk
+        batch.append(Book(title=values["title"], genre_id=genres[genre_key], library_id=libraries[library_key]))
+        if len(batch) >= batch_size:
+            flush()
+
+    if batch:
+        flush()
+    return result
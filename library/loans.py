@@ -0,0 +1,149 @@
+from datetime import date
+
+from django.db import IntegrityError, connection, transaction
+from django.utils import timezone
+from rest_framework import status
+from rest_framework.exceptions import APIException
+
+from library.models import Book, Member, Loan
+from library.signals import post_bulk_create, post_bulk_update
+
+BOOK_NOT_FOUND = "Книга не найдена."
+BOOK_ON_LOAN = "Книга уже выдана."
+MEMBER_NOT_FOUND = "Читатель не найден."
+LOAN_RETURNED = "Книга по этой выдаче уже возвращена."
+# Inserts tried when the open loan that blocked the previous one is gone by the time we look.
+SAVE_ATTEMPTS = 3
+
+
+class LoanConflict(APIException):
+    status_code = status.HTTP_409_CONFLICT
+    default_detail = BOOK_ON_LOAN
+    default_code = "book_on_loan"
+
+
+def save_loan(loan, **changes):
+    """Set ``changes`` on ``loan`` and save it; ``LoanConflict`` if its book is already on loan.
+
+    There is no check before the write: the ``loan_one_open_per_book``
+    constraint decides between concurrent desks, and only the one that loses
+    pays for the extra lookup that tells a conflict from other errors.
+    """
+    for field, value in changes.items():
+        setattr(loan, field, value)
+    others = Loan.objects.filter(book_id=loan.book_id, return_date__isnull=True).exclude(pk=loan.pk)
+    for attempt in range(SAVE_ATTEMPTS):
+        try:
+            with transaction.atomic():
+                loan.save()
+            return loan
+        except IntegrityError:
+            if loan.return_date is not None or attempt == SAVE_ATTEMPTS - 1:
+                raise
+            if others.exists():
+                raise LoanConflict()
+            # The loan in the way was returned in the meantime: the book is free now.
+
+
+def checkout(book, member, loan_date=None, user=None):
+    """Lend ``book`` to ``member`` with one INSERT, or raise ``LoanConflict``."""
+    return save_loan(Loan(book=book, member=member, loan_date=loan_date or date.today(), user=user))
+
+
+def return_loan(loan, return_date=None):
+    """Close ``loan`` with one conditional UPDATE; ``LoanConflict`` if it was closed already."""
+    if bulk_return([loan.pk], return_date)[loan.pk] != "returned":
+        raise LoanConflict(LOAN_RETURNED, "already_returned")
+    loan.refresh_from_db(fields=["return_date", "updated_at"])
+    return loan
+
+
+def bulk_checkout(items, user=None):
+    """Validate and insert a batch of loans with a fixed number of queries.
+
+    Returns ``(loans, errors)`` where ``errors`` maps an item index to its field
+    errors. Nothing is written unless every item is valid.
+    """
+    book_ids = {item["book"] for item in items}
+    member_ids = {item["member"] for item in items}
+    with transaction.atomic():
+        books = {pk: Book(pk=pk, title=title, library_id=library_id) for pk, title, library_id in
+                 Book.objects.filter(pk__in=book_ids).values_list("id", "title", "library_id")}
+        members = {pk: Member(pk=pk, first_name=name) for pk, name in
+                   Member.objects.filter(pk__in=member_ids).values_list("id", "first_name")}
+        on_loan = set(Loan.objects.filter(book__in=book_ids, return_date__isnull=True).values_list("book_id", flat=True))
+
+        loans, errors = [], {}
+        for index, item in enumerate(items):
+            item_errors = {}
+            if item["book"] not in books:
+                item_errors["book"] = [BOOK_NOT_FOUND]
+            elif item["book"] in on_loan:
+                item_errors["book"] = [BOOK_ON_LOAN]
+            if item["member"] not in members:
+                item_errors["member"] = [MEMBER_NOT_FOUND]
+            if item_errors:
+                errors[index] = item_errors
+                continue
+            on_loan.add(item["book"])
+            loans.append(Loan(
+                book=books[item["book"]],
+                member=members[item["member"]],
+                loan_date=item.get("loan_date") or date.today(),
+                user=user
+            ))
+
+        if errors:
+            return [], errors
+        try:
+            with transaction.atomic():
+                Loan.objects.bulk_create(loans)
+        except IntegrityError:
+            # Another desk lent one of the books after the check above.
+            if Loan.objects.filter(book__in=book_ids, return_date__isnull=True).exists():
+                raise LoanConflict()
+            raise
+        post_bulk_create.send(sender=Loan, instances=loans)
+    return loans, {}
+
+
+def bulk_return(ids, return_date=None):
+    """Close every open loan in ``ids`` with one UPDATE; returns ``{id: outcome}``.
+
+    Exactly the loans this UPDATE closed are reported ``returned``, so of
+    two desks returning the same loan at once only one is told so.
+    """
+    return_date = return_date or date.today()
+    with transaction.atomic():
+        returned = _close_open_loans(ids, return_date)
+        found = set(Loan.objects.filter(pk__in=ids).values_list("id", flat=True))
+        if returned:
+            post_bulk_update.send(sender=Loan, pks=returned, fields=["return_date", "updated_at"])
+    returned = set(returned)
+    return {pk: "not_found" if pk not in found else "returned" if pk in returned else "already_returned" for pk in ids}
+
+
+def _close_open_loans(ids, return_date):
+    now = timezone.now()
+    if connection.features.has_select_for_update:
+        # Row locks: the open ones stay open until the UPDATE below closes them.
+        open_ids = list(
+            Loan.objects.select_for_update().filter(pk__in=ids, return_date__isnull=True).values_list("id", flat=True)
+        )
+        Loan.objects.filter(pk__in=open_ids).update(return_date=return_date, updated_at=now)
+        return open_ids
+    # SQLite cannot lock rows, and a transaction that read before writing
+    # fails when another desk wrote in between: the UPDATE reports its own rows.
+    if not ids:
+        return []
+    with connection.cursor() as cursor:
+        cursor.execute(
+            f"UPDATE {Loan._meta.db_table} SET return_date = %s, updated_at = %s "
+            f"WHERE id IN ({', '.join(['%s'] * len(ids))}) AND return_date IS NULL RETURNING id",
+            [
+                connection.ops.adapt_datefield_value(return_date),
+                connection.ops.adapt_datetimefield_value(now),
+                *ids,
+            ],
+        )
+        return [pk for pk, in cursor.fetchall()]
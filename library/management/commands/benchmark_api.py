@@ -0,0 +1,66 @@
+import json
+
+from django.core.management.base import BaseCommand, CommandError
+
+from app.urls import router
+from library.benchmarks import (
+    BUDGETS_PATH, test_database, benchmark_client, seed_loans, endpoint_cases, run_cases,
+    load_budgets, check_budgets, record_budgets
+)
+
+
+class Command(BaseCommand):
+    help = ("Прогоняет все GET-маршруты API на тестовых базах разного размера, "
+            "замеряет время, число SQL-запросов и пиковую память и сверяет их с бюджетами")
+
+    def add_arguments(self, parser):
+        parser.add_argument("--sizes", type=int, nargs="+", default=[1000, 100000],
+                            help="Число выдач в тестовых базах (бюджеты записаны для 1000 и 100000)")
+        parser.add_argument("--repeat", type=int, default=3,
+                            help="Замеров на маршрут после прогревочного; берётся медиана")
+        parser.add_argument("--budgets", default=str(BUDGETS_PATH))
+        parser.add_argument("--only", default="", help="Проверять только маршруты, содержащие эту подстроку")
+        parser.add_argument("--no-memory", action="store_true", help="Не замерять память (tracemalloc замедляет)")
+        parser.add_argument("--write-budgets", action="store_true",
+                            help="Записать замеры в файл бюджетов вместо проверки")
+        parser.add_argument("--json", dest="json_path", help="Сохранить сырые замеры в JSON")
+
+    def handle(self, *args, **options):
+        budgets = load_budgets(options["budgets"])
+        report, violations = {}, []
+
+        with test_database():
+            client = benchmark_client()
+            for size in sorted(options["sizes"]):
+                seed_loans(size)
+                cases = [(name, url) for name, url in endpoint_cases(router) if options["only"] in name]
+                results = run_cases(client, cases, trace_memory=not options["no_memory"], repeat=options["repeat"])
+                report[size] = results
+                self.print_results(size, results)
+                if options["write_budgets"]:
+                    record_budgets(budgets, results, size)
+                else:
+                    violations += check_budgets(results, budgets, size)
+
+        if options["json_path"]:
+            with open(options["json_path"], "w") as file:
+                json.dump(report, file, indent=2)
+        if options["write_budgets"]:
+            with open(options["budgets"], "w") as file:
+                json.dump(budgets, file, indent=2, sort_keys=True, ensure_ascii=False)
+                file.write("\n")
+            self.stdout.write(self.style.SUCCESS(f"Бюджеты записаны в {options['budgets']}"))
+            return
+        if violations:
+            raise CommandError("Превышены бюджеты:\n" + "\n".join(violations))
+        self.stdout.write(self.style.SUCCESS("Все маршруты уложились в бюджеты."))
+
+    def print_results(self, size, results):
+        self.stdout.write(f"\n== {size} выдач ==")
+        self.stdout.write(f"{'endpoint':<32} {'status':>6} {'ms':>9} {'queries':>8} {'peak MB':>8} {'KB':>9}")
+        for name, result in results.items():
+            peak = f"{result['peak_bytes'] / 2**20:.1f}" if "peak_bytes" in result else "-"
+            self.stdout.write(
+                f"{name:<32} {result['status']:>6} {result['seconds'] * 1000:>9.1f} "
+                f"{result['queries']:>8} {peak:>8} {result['bytes'] / 1024:>9.1f}"
+            )
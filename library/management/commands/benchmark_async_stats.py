@@ -0,0 +1,84 @@
+import asyncio
+import statistics
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from django.conf import settings
+from django.core.cache import caches
+from django.core.management.base import BaseCommand
+from django.test import AsyncClient
+
+from library import stats
+from library.benchmarks import test_database, benchmark_client, seed_loans
+
+PATHS = [("dashboard", "/api/dashboard/", "/api/async/dashboard/")] + [
+    (f"{section} stats", f"/api/{section}/stats/", f"/api/async/{section}/stats/") for section in stats.SECTIONS
+]
+
+
+def summary(times):
+    times = sorted(times)
+    return statistics.median(times) * 1000, times[int(len(times) * 0.95) - 1] * 1000
+
+
+class Command(BaseCommand):
+    help = "Сравнивает задержку статистики: синхронные представления (WSGI) против асинхронных (ASGI)"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--loans", type=int, default=10000)
+        parser.add_argument("--requests", type=int, default=50)
+        parser.add_argument("--concurrency", type=int, default=10)
+
+    def handle(self, *args, **options):
+        count, concurrency = options["requests"], options["concurrency"]
+        with test_database():
+            seed_loans(options["loans"])
+            client = benchmark_client()
+            async_client = AsyncClient()
+            async_client.cookies = client.cookies
+
+            def wsgi_get(path):
+                # Without the response cache both paths run their statements every time.
+                caches["api"].clear()
+                started = time.perf_counter()
+                response = client.get(path)
+                assert response.status_code == 200, response.status_code
+                return time.perf_counter() - started, response.json()
+
+            async def asgi_get(path):
+                caches["api"].clear()
+                started = time.perf_counter()
+                response = await async_client.get(path)
+                assert response.status_code == 200, response.status_code
+                return time.perf_counter() - started, response.json()
+
+            async def asgi_burst(path):
+                started = time.perf_counter()
+                await asyncio.gather(*(asgi_get(path) for _ in range(count)))
+                return time.perf_counter() - started
+
+            async def asgi_run(path):
+                return [await asgi_get(path) for _ in range(count)], await asgi_burst(path)
+
+            self.stdout.write(
+                f"{'endpoint':<16} {'wsgi p50':>9} {'asgi p50':>9} {'wsgi p95':>9} {'asgi p95':>9} "
+                f"{'wsgi burst':>11} {'asgi burst':>11} {'same':>5}"
+            )
+            with ThreadPoolExecutor(concurrency) as pool:
+                for name, sync_path, async_path in PATHS:
+                    wsgi = [wsgi_get(sync_path) for _ in range(count)]
+                    started = time.perf_counter()
+                    list(pool.map(wsgi_get, [sync_path] * count))
+                    wsgi_burst = time.perf_counter() - started
+                    asgi, asgi_burst_seconds = asyncio.run(asgi_run(async_path))
+                    wsgi_p50, wsgi_p95 = summary([seconds for seconds, _ in wsgi])
+                    asgi_p50, asgi_p95 = summary([seconds for seconds, _ in asgi])
+                    same = wsgi[-1][1] == asgi[-1][1]
+                    self.stdout.write(
+                        f"{name:<16} {wsgi_p50:>7.2f}ms {asgi_p50:>7.2f}ms {wsgi_p95:>7.2f}ms {asgi_p95:>7.2f}ms "
+                        f"{wsgi_burst * 1000:>9.1f}ms {asgi_burst_seconds * 1000:>9.1f}ms {'yes' if same else 'NO':>5}"
+                    )
+            self.stdout.write(
+                f"burst: {count} requests, WSGI on {concurrency} threads, ASGI in one event loop "
+                f"with {settings.STATS_QUERY_THREADS} query threads"
+            )
@@ -0,0 +1,88 @@
+import os
+import random
+import tempfile
+import threading
+import time
+from collections import Counter
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from django.db.models import Count
+from model_bakery import baker
+
+from library.benchmarks import test_database
+from library.loans import LoanConflict, checkout, return_loan
+from library.models import Book, Loan, Member
+
+
+class Command(BaseCommand):
+    help = "Нагрузочная проверка выдачи: много потоков выдают и возвращают одни и те же книги"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--threads", type=int, default=16)
+        parser.add_argument("--attempts", type=int, default=200, help="выдач на поток")
+        parser.add_argument("--books", type=int, default=20)
+        parser.add_argument("--seed", type=int, default=0)
+
+    def handle(self, *args, **options):
+        threads, attempts = options["threads"], options["attempts"]
+        with tempfile.TemporaryDirectory() as directory, test_database(os.path.join(directory, "checkout.sqlite3")):
+            books = baker.make(Book, options["books"])
+            members = baker.make(Member, threads)
+            outcomes = Counter()
+            lock = threading.Lock()
+            barrier = threading.Barrier(threads)
+
+            def desk(number):
+                rng = random.Random(options["seed"] + number)
+                seen, held = Counter(), []
+                try:
+                    barrier.wait()
+                    for _ in range(attempts):
+                        # Readers bring books back now and then, so books keep changing hands.
+                        if held and rng.random() < 0.5:
+                            return_loan(held.pop(0))
+                            seen["returned"] += 1
+                        try:
+                            held.append(checkout(rng.choice(books), members[number]))
+                            seen["lent"] += 1
+                        except LoanConflict:
+                            seen["conflict"] += 1
+                except Exception as error:
+                    seen[f"error: {error!r}"] += 1
+                finally:
+                    connection.close()
+                    with lock:
+                        outcomes.update(seen)
+
+            workers = [threading.Thread(target=desk, args=(number,)) for number in range(threads)]
+            started = time.perf_counter()
+            for worker in workers:
+                worker.start()
+            for worker in workers:
+                worker.join()
+            elapsed = time.perf_counter() - started
+
+            duplicates = (
+                Loan.objects.filter(return_date__isnull=True).values("book")
+                .annotate(n=Count("id")).filter(n__gt=1).count()
+            )
+            open_loans = Loan.objects.filter(return_date__isnull=True).count()
+            total = threads * attempts
+            self.stdout.write(
+                f"{threads} threads x {attempts} checkouts of {len(books)} books in {elapsed:.2f}s: "
+                f"{total / elapsed:.0f} checkouts/s"
+            )
+            for outcome, count in sorted(outcomes.items()):
+                self.stdout.write(f"  {outcome}: {count}")
+            self.stdout.write(
+                f"loans: {Loan.objects.count()}, open: {open_loans}, books with several open loans: {duplicates}"
+            )
+            consistent = (
+                outcomes["lent"] + outcomes["conflict"] == total
+                and Loan.objects.count() == outcomes["lent"]
+                and open_loans == outcomes["lent"] - outcomes["returned"]
+            )
+            if duplicates or not consistent:
+                raise CommandError("Выдачи не согласованы")
+            self.stdout.write(self.style.SUCCESS("OK"))
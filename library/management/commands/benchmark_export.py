@@ -0,0 +1,25 @@
+from django.core.management.base import BaseCommand
+
+from library.benchmarks import test_database, benchmark_client, seed_loans, consume, measure
+
+
+class Command(BaseCommand):
+    help = "Замеряет время и пиковую память выгрузки на тестовой базе разного размера"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--rows", type=int, nargs="+", default=[1000, 10000, 100000])
+        parser.add_argument("--resource", default="loans")
+        parser.add_argument("--type", default="excel")
+
+    def handle(self, *args, **options):
+        url = f"/api/{options['resource']}/export/?type={options['type']}"
+        with test_database():
+            client = benchmark_client()
+            self.stdout.write(f"{'rows':>10} {'seconds':>10} {'peak MB':>10} {'size MB':>10}")
+            for rows in sorted(options["rows"]):
+                seed_loans(rows)
+                stats = measure(lambda: consume(client.get(url)))
+                self.stdout.write(
+                    f"{rows:>10} {stats['seconds']:>10.2f} "
+                    f"{stats['peak_bytes'] / 2**20:>10.1f} {stats['result'] / 2**20:>10.1f}"
+                )
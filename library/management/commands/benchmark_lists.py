@@ -0,0 +1,53 @@
+import time
+
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand
+from rest_framework.renderers import JSONRenderer
+
+from library.api import BookViewSet, LoanViewSet, MemberViewSet
+from library.benchmarks import test_database, seed_loans
+from library.renderers import ORJSONRenderer
+
+
+def best_of(repeat, fn):
+    times = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        result = fn()
+        times.append(time.perf_counter() - started)
+    return min(times), result
+
+
+class Command(BaseCommand):
+    help = "Сравнивает скорость списков: ModelSerializer и JSONRenderer против values() и orjson"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--rows", type=int, default=10000)
+        parser.add_argument("--repeat", type=int, default=5)
+
+    def handle(self, *args, **options):
+        rows, repeat = options["rows"], options["repeat"]
+        with test_database():
+            seed_loans(rows)
+            # generate_data makes library members, not accounts; /api/members/ lists accounts.
+            User.objects.bulk_create(User(username=f"reader{number}") for number in range(rows // 10))
+            self.stdout.write(
+                f"{'resource':<10} {'rows':>8} {'model rows/s':>14} {'values rows/s':>14} {'speedup':>8} {'same':>5}"
+            )
+            for resource, viewset in (("books", BookViewSet), ("loans", LoanViewSet), ("members", MemberViewSet)):
+                queryset = viewset.queryset_for().order_by("id")[:rows]
+                values = viewset.values_serializer_class
+
+                def model_path():
+                    return JSONRenderer().render(viewset.serializer_class(queryset, many=True).data)
+
+                def values_path():
+                    return ORJSONRenderer().render(values.to_representation(queryset.values(*values.lookups())))
+
+                model_seconds, expected = best_of(repeat, model_path)
+                values_seconds, content = best_of(repeat, values_path)
+                count = queryset.count()
+                self.stdout.write(
+                    f"{resource:<10} {count:>8} {count / model_seconds:>14.0f} {count / values_seconds:>14.0f} "
+                    f"{model_seconds / values_seconds:>7.1f}x {'yes' if content == expected else 'NO':>5}"
+                )
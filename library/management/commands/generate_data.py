@@ -1,17 +1,52 @@
 # library/management/commands/generate_data.py
 
 from django.core.management.base import BaseCommand
+from django.db import transaction
 from faker import Faker
 import random
-from datetime import timedelta
+from bisect import bisect
+from collections import defaultdict
+from datetime import date, timedelta
+from itertools import accumulate, islice
+from library import stats, versions
 from library.models import Library, Book, Genre, Member, Loan
 
+BOOKS_PER_SCALE = 800
+MEMBERS_PER_SCALE = 200
+LOANS_PER_SCALE = 1000
+ZIPF_EXPONENT = 0.9
+HISTORY_DAYS = 730
+LOAN_PERIOD_DAYS = 60
+
+
+def zipf_weights(n, exponent=ZIPF_EXPONENT):
+    return list(accumulate(1 / (rank ** exponent) for rank in range(1, n + 1)))
+
+
+def insert(model, objects, batch_size):
+    objects = iter(objects)
+    created = 0
+    while batch := list(islice(objects, batch_size)):
+        model.objects.bulk_create(batch, batch_size=batch_size)
+        created += len(batch)
+    return created
+
 
 class Command(BaseCommand):
     help = "Генерирует реалистичные тестовые данные для библиотек Иркутска"
 
+    def add_arguments(self, parser):
+        parser.add_argument("--scale", type=float, default=1.0,
+                            help="Множитель объёма: 1 ≈ 800 книг, 200 читателей, 1000 выдач")
+        parser.add_argument("--seed", type=int, default=None, help="Зерно генератора для воспроизводимых данных")
+        parser.add_argument("--batch-size", type=int, default=5000)
+
     def handle(self, *args, **options):
+        scale, batch_size = options["scale"], options["batch_size"]
+        rng = random.Random(options["seed"])
         fake = Faker("ru_RU")
+        if options["seed"] is not None:
+            fake.seed_instance(options["seed"])
 
         # ------------------------------
         # 1. Жанры
@@ -71,62 +106,84 @@ class Command(BaseCommand):
         # ------------------------------
         # 3. Книги
         # ------------------------------
-        if Book.objects.count() < 800:
-            for genre_name, titles in genre_map.items():
-                genre = Genre.objects.get(name=genre_name)
-                for library in libraries:
-                    for _ in range(random.randint(10, 25)):
-                        Book.objects.create(
-                            title=random.choice(titles),
-                            genre=genre,
-                            library=library,
-                        )
-
-            self.stdout.write(self.style.SUCCESS("📘 Книги созданы."))
-
-        books = list(Book.objects.all())
+        books_needed = int(BOOKS_PER_SCALE * scale) - Book.objects.count()
+        if books_needed > 0:
+            genre_ids = {genre.name: genre.id for genre in genres}
+            titles = [(genre_ids[name], title) for name, group in genre_map.items() for title in group]
+            with transaction.atomic():
+                created = insert(Book, (
+                    Book(title=title, genre_id=genre_id, library=rng.choice(libraries))
+                    for genre_id, title in (rng.choice(titles) for _ in range(books_needed))
+                ), batch_size)
+            self.stdout.write(self.style.SUCCESS(f"📘 Книги созданы: {created}."))
 
         # ------------------------------
         # 4. Читатели
         # ------------------------------
-        if Member.objects.count() < 200:
-            for _ in range(200):
-                Member.objects.create(
-                    first_name=fake.name(),
-                    library=random.choice(libraries),
-                )
-
-        members = list(Member.objects.all())
+        members_needed = int(MEMBERS_PER_SCALE * scale) - Member.objects.count()
+        if members_needed > 0:
+            with transaction.atomic():
+                insert(Member, (
+                    Member(first_name=fake.name(), library=rng.choice(libraries))
+                    for _ in range(members_needed)
+                ), batch_size)
         self.stdout.write(self.style.SUCCESS("🧍 Читатели готовы."))
 
         # ------------------------------
         # 5. Реалистичные выдачи
         # ------------------------------
-        if Loan.objects.count() < 1000:
-            for _ in range(1000):
-
-                library = random.choice(libraries)
-                library_books = [b for b in books if b.library == library]
-                library_members = [m for m in members if m.library == library]
-
-                if not library_books or not library_members:
-                    continue
-
-                book = random.choice(library_books)
-                member = random.choice(library_members)
-
-                loan_date = fake.date_between(start_date="-2y", end_date="today")
-
-                return_date = None
-                if random.random() < 0.4:
-                    return_date = loan_date + timedelta(days=random.randint(3, 60))
-
-                Loan.objects.create(
-                    book=book,
-                    member=member,
-                    loan_date=loan_date,
-                    return_date=return_date,
-                )
-
-        self.stdout.write(self.style.SUCCESS("🎉 Выдачи созданы!"))
+        # Популярность книг и активность читателей распределены по Ципфу:
+        # небольшая доля книг и читателей даёт основную часть выдач.
+        loans_needed = int(LOANS_PER_SCALE * scale) - Loan.objects.count()
+        if loans_needed > 0:
+            books_by_library = defaultdict(list)
+            for book_id, library_id in Book.objects.values_list("id", "library_id").iterator(chunk_size=batch_size):
+                books_by_library[library_id].append(book_id)
+            members = list(Member.objects.values_list("id", "library_id"))
+            rng.shuffle(members)
+            for library_books in books_by_library.values():
+                rng.shuffle(library_books)
+            book_weights = {library_id: zipf_weights(len(ids)) for library_id, ids in books_by_library.items()}
+            members = [member for member in members if member[1] in books_by_library]
+
+            if members:
+                member_weights = zipf_weights(len(members))
+                on_loan = set(Loan.objects.filter(return_date__isnull=True).values_list("book_id", flat=True))
+                today = date.today()
+
+                def pick_book(library_id):
+                    weights = book_weights[library_id]
+                    return books_by_library[library_id][bisect(weights, rng.random() * weights[-1])]
+
+                # Отдельный генератор: выбор читателей по пачкам не зависит от размера пачки.
+                member_rng = random.Random(rng.getrandbits(64))
+
+                def borrowers():
+                    # Читатели выбираются по пачкам, чтобы не держать в памяти список на все выдачи.
+                    for start in range(0, loans_needed, batch_size):
+                        count = min(batch_size, loans_needed - start)
+                        yield from member_rng.choices(members, cum_weights=member_weights, k=count)
+
+                def loans():
+                    for member_id, library_id in borrowers():
+                        book_id = pick_book(library_id)
+                        age = rng.randrange(HISTORY_DAYS)
+                        loan_date = today - timedelta(days=age)
+                        return_date = loan_date + timedelta(days=rng.randint(3, LOAN_PERIOD_DAYS))
+                        # Свежие выдачи часто ещё не вернули, но книга не может быть выдана дважды.
+                        if return_date > today or (age < LOAN_PERIOD_DAYS and rng.random() < 0.5):
+                            if book_id not in on_loan:
+                                on_loan.add(book_id)
+                                return_date = None
+                            elif return_date > today:
+                                return_date = today
+                        yield Loan(book_id=book_id, member_id=member_id, loan_date=loan_date, return_date=return_date)
+
+                with transaction.atomic():
+                    created = insert(Loan, loans(), batch_size)
+                self.stdout.write(self.style.SUCCESS(f"🎉 Выдачи созданы: {created}!"))
+
+        stats.rebuild()
+        versions.bump(Genre, Library, Book, Member, Loan)
+        self.stdout.write(self.style.SUCCESS("📊 Статистика пересчитана."))
         self.stdout.write(self.style.SUCCESS("✨ ГЕНЕРАЦИЯ УСПЕШНА"))
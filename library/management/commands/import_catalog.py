@@ -0,0 +1,33 @@
+import os
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+
+from library.importers import IMPORT_BATCH_SIZE, ImportFormatError, import_books, read_rows
+
+
+class Command(BaseCommand):
+    help = "Импортирует каталог книг из файла .xlsx или .csv (колонки Title, Genre, Library)"
+
+    def add_arguments(self, parser):
+        parser.add_argument("path")
+        parser.add_argument("--batch-size", type=int, default=IMPORT_BATCH_SIZE)
+
+    def handle(self, *args, **options):
+        path = options["path"]
+        if not os.path.exists(path):
+            raise CommandError(f"Файл не найден: {path}")
+
+        started = time.perf_counter()
+        with open(path, "rb") as file:
+            try:
+                result = import_books(read_rows(file, path), batch_size=options["batch_size"])
+            except ImportFormatError as error:
+                raise CommandError(str(error))
+
+        for error in result["errors"]:
+            self.stderr.write(f"Строка {error['row']}: {error['errors']}")
+        self.stdout.write(self.style.SUCCESS(
+            f"📘 Импортировано книг: {result['created']}, ошибок: {result['errors_total']} "
+            f"за {time.perf_counter() - started:.1f} с"
+        ))
@@ -0,0 +1,10 @@
+from django.core.management.base import BaseCommand
+
+from library import sync
+
+
+class Command(BaseCommand):
+    help = "Удаляет отметки об удалённых записях старше SYNC_TOMBSTONE_TTL"
+
+    def handle(self, *args, **options):
+        self.stdout.write(self.style.SUCCESS(f"Удалено отметок: {sync.prune_tombstones()}"))
@@ -0,0 +1,11 @@
+from django.core.management.base import BaseCommand
+
+from library import stats
+
+
+class Command(BaseCommand):
+    help = "Пересчитывает таблицу счётчиков статистики по исходным данным"
+
+    def handle(self, *args, **options):
+        stats.rebuild()
+        self.stdout.write(self.style.SUCCESS("📊 Счётчики статистики пересчитаны."))
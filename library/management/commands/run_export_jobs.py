@@ -0,0 +1,31 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from library.export_jobs import run_export_job, cleanup_expired_jobs, requeue_stale_jobs
+from library.models import ExportJob
+
+
+class Command(BaseCommand):
+    help = "Выполняет задачи фоновой выгрузки из очереди и удаляет просроченные файлы"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--once", action="store_true", help="Обработать очередь один раз и выйти")
+        parser.add_argument("--cleanup", action="store_true", help="Только удалить просроченные задачи")
+        parser.add_argument("--interval", type=float, default=2.0)
+
+    def handle(self, *args, **options):
+        if options["cleanup"]:
+            self.stdout.write(self.style.SUCCESS(f"Удалено задач: {cleanup_expired_jobs()}"))
+            return
+
+        while True:
+            cleanup_expired_jobs()
+            requeue_stale_jobs()
+            pending = list(ExportJob.objects.filter(status=ExportJob.PENDING).order_by("id").values_list("id", flat=True))
+            for job_id in pending:
+                run_export_job(job_id)
+                self.stdout.write(f"Задача {job_id}: {ExportJob.objects.get(pk=job_id).status}")
+            if options["once"]:
+                return
+            time.sleep(options["interval"])
@@ -0,0 +1,324 @@
+import glob
+import itertools
+import math
+import mmap
+import os
+import struct
+import threading
+import uuid
+import weakref
+from collections import defaultdict
+from functools import lru_cache
+
+from django.conf import settings
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, math.inf)
+QUERY_BUCKETS = (0, 1, 2, 3, 5, 10, 20, 50, 100, 500, math.inf)
+SIZE_BUCKETS = (1e3, 1e4, 1e5, 1e6, 1e7, 1e8, 1e9, math.inf)
+
+_INITIAL_FILE_SIZE = 1 << 16
+_HEADER = struct.Struct("<Q")
+_LENGTH = struct.Struct("<I")
+_VALUE = struct.Struct("<d")
+
+
+class _MemoryShard(dict):
+    def __init__(self):
+        super().__init__()
+        self.pid = os.getpid()
+
+    def add(self, key, amount):
+        self[key] = self.get(key, 0.0) + amount
+
+    def samples(self):
+        # dict.copy() runs without releasing the GIL, so it is safe while the owner writes.
+        return self.copy().items()
+
+
+class _MmapShard:
+    """A file of ``key -> float`` entries with exactly one writer thread.
+
+    Layout: an 8-byte "bytes used" header, then entries of a 4-byte key
+    length, the UTF-8 key padded to 8 bytes and an 8-byte double. New entries
+    are written before the header is bumped, so readers in other processes
+    never see a half-written key.
+    """
+
+    def __init__(self, path):
+        self.pid = os.getpid()
+        self.positions = {}
+        self.file = open(path, "w+b")
+        self.file.truncate(_INITIAL_FILE_SIZE)
+        self.map = mmap.mmap(self.file.fileno(), _INITIAL_FILE_SIZE)
+        self.used = _HEADER.size
+        _HEADER.pack_into(self.map, 0, self.used)
+
+    def add(self, key, amount):
+        position = self.positions.get(key)
+        if position is None:
+            position = self._append(key)
+        value, = _VALUE.unpack_from(self.map, position)
+        _VALUE.pack_into(self.map, position, value + amount)
+
+    def _append(self, key):
+        encoded = key.encode()
+        padded = len(encoded) + (-(_LENGTH.size + len(encoded)) % 8)
+        size = _LENGTH.size + padded + _VALUE.size
+        if self.used + size > len(self.map):
+            new_size = max(len(self.map) * 2, self.used + size)
+            self.file.truncate(new_size)
+            self.map.close()
+            self.map = mmap.mmap(self.file.fileno(), new_size)
+        _LENGTH.pack_into(self.map, self.used, len(encoded))
+        start = self.used + _LENGTH.size
+        self.map[start:start + len(encoded)] = encoded
+        position = start + padded
+        _VALUE.pack_into(self.map, position, 0.0)
+        self.used += size
+        _HEADER.pack_into(self.map, 0, self.used)
+        self.positions[key] = position
+        return position
+
+    def samples(self):
+        return _read_entries(bytes(self.map))
+
+
+def _read_entries(data):
+    if len(data) < _HEADER.size:
+        return
+    used, = _HEADER.unpack_from(data, 0)
+    position = _HEADER.size
+    while position < used:
+        length, = _LENGTH.unpack_from(data, position)
+        start = position + _LENGTH.size
+        key = data[start:start + length].decode()
+        position = start + length + (-(_LENGTH.size + length) % 8)
+        value, = _VALUE.unpack_from(data, position)
+        position += _VALUE.size
+        yield key, value
+
+
+class _Lease:
+    """Held only by a thread's local storage; its finalizer hands the shard back when the thread ends."""
+
+    __slots__ = ("__weakref__",)
+
+
+class Registry:
+    """Metric families plus the per-thread shards their samples are written to.
+
+    Every thread writes only to its own shard, so updates take no locks; the
+    registry lock is held just while a shard is handed out. A thread's shard
+    goes back to a free list when the thread ends and the next new thread
+    keeps adding to it, so there are never more shards (or files) than
+    threads alive at once and totals never go down. With a multiprocess
+    directory (``METRICS_MULTIPROCESS_DIR`` by default) each shard is an mmap
+    file there and ``collect()`` sums the files of every process. The
+    directory should be emptied when the server (re)starts.
+    """
+
+    def __init__(self, directory=None):
+        self._directory = directory
+        self.families = {}
+        self._shards = []
+        self._free = []
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self._ids = itertools.count()
+
+    @property
+    def directory(self):
+        return self._directory or getattr(settings, "METRICS_MULTIPROCESS_DIR", None)
+
+    def register(self, family):
+        if family.name in self.families:
+            raise ValueError(f"Metric {family.name} is already registered")
+        self.families[family.name] = family
+
+    def shard(self):
+        shard = getattr(self._local, "shard", None)
+        # A forked worker must not keep writing into its parent's shard.
+        if shard is None or shard.pid != os.getpid():
+            shard = self._local.shard = self._acquire()
+            self._local.lease = lease = _Lease()
+            weakref.finalize(lease, self._release, shard)
+        return shard
+
+    def _acquire(self):
+        pid = os.getpid()
+        with self._lock:
+            while self._free:
+                shard = self._free.pop()
+                # Shards inherited through fork belong to the parent.
+                if shard.pid == pid:
+                    return shard
+        return self._new_shard()
+
+    def _release(self, shard):
+        with self._lock:
+            self._free.append(shard)
+
+    def _new_shard(self):
+        directory = self.directory
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+            name = f"metrics_{os.getpid()}_{next(self._ids)}_{uuid.uuid4().hex[:8]}.db"
+            shard = _MmapShard(os.path.join(directory, name))
+        else:
+            shard = _MemoryShard()
+        with self._lock:
+            self._shards.append(shard)
+        return shard
+
+    def collect(self):
+        totals = defaultdict(float)
+        directory = self.directory
+        if directory:
+            for path in glob.glob(os.path.join(directory, "metrics_*.db")):
+                with open(path, "rb") as file:
+                    for key, value in _read_entries(file.read()):
+                        totals[key] += value
+        else:
+            with self._lock:
+                shards = list(self._shards)
+            for shard in shards:
+                for key, value in shard.samples():
+                    totals[key] += value
+        return totals
+
+
+REGISTRY = Registry()
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+@lru_cache(maxsize=4096)
+def _labels(names, values):
+    if len(names) != len(values):
+        raise ValueError(f"Expected labels {names}, got {values}")
+    return ",".join(f'{name}="{_escape(value)}"' for name, value in zip(names, values))
+
+
+def _sample(name, labels):
+    return f"{name}{{{labels}}}" if labels else name
+
+
+def _bound(value):
+    return "+Inf" if value == math.inf else repr(float(value))
+
+
+class Counter:
+    type = "counter"
+
+    def __init__(self, name, documentation, labelnames=(), registry=REGISTRY):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.sample_names = {name}
+        self.registry = registry
+        registry.register(self)
+
+    def inc(self, *labelvalues, amount=1):
+        self.registry.shard().add(_sample(self.name, _labels(self.labelnames, labelvalues)), amount)
+
+    def sort_key(self, key):
+        return key
+
+
+class Histogram:
+    type = "histogram"
+
+    def __init__(self, name, documentation, labelnames=(), buckets=LATENCY_BUCKETS, registry=REGISTRY):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(sorted(buckets))
+        if self.buckets[-1] != math.inf:
+            self.buckets += (math.inf,)
+        self.sample_names = {f"{name}_bucket", f"{name}_sum", f"{name}_count"}
+        self.registry = registry
+        self._keys = {}
+        registry.register(self)
+
+    def _samples_for(self, labelvalues):
+        keys = self._keys.get(labelvalues)
+        if keys is None:
+            labels = _labels(self.labelnames, labelvalues)
+            prefix = f"{labels}," if labels else ""
+            keys = self._keys[labelvalues] = (
+                [(bound, f'{self.name}_bucket{{{prefix}le="{_bound(bound)}"}}') for bound in self.buckets],
+                _sample(f"{self.name}_sum", labels),
+                _sample(f"{self.name}_count", labels),
+            )
+        return keys
+
+    def observe(self, value, *labelvalues):
+        buckets, sum_key, count_key = self._samples_for(labelvalues)
+        shard = self.registry.shard()
+        # Every bucket is touched, even with 0, so the exposition lists all of them.
+        for bound, key in buckets:
+            shard.add(key, 1 if value <= bound else 0)
+        shard.add(sum_key, value)
+        shard.add(count_key, 1)
+
+    def sort_key(self, key):
+        name, _, labels = key.partition("{")
+        if name.endswith("_bucket"):
+            rest, _, bound = labels.rpartition('le="')
+            return rest.rstrip(","), 0, float(bound.rstrip('"}'))
+        return labels.rstrip("}"), 1 if name.endswith("_sum") else 2, 0.0
+
+
+def _format(value):
+    return str(int(value)) if value.is_integer() else repr(value)
+
+
+def render(registry=REGISTRY):
+    """Prometheus text exposition format (version 0.0.4) of everything collected."""
+    totals = registry.collect()
+    lines = []
+    for family in registry.families.values():
+        lines.append(f"# HELP {family.name} {family.documentation}")
+        lines.append(f"# TYPE {family.name} {family.type}")
+        keys = [key for key in totals if key.partition("{")[0] in family.sample_names]
+        lines.extend(f"{key} {_format(totals[key])}" for key in sorted(keys, key=family.sort_key))
+    return "\n".join(lines) + "\n"
+
+
+def observe_size(response, histogram, *labelvalues):
+    """Record a response body's size once it is known, without buffering streamed bodies."""
+    if not response.streaming:
+        histogram.observe(len(response.content), *labelvalues)
+    elif response.has_header("Content-Length"):
+        histogram.observe(int(response["Content-Length"]), *labelvalues)
+    else:
+        def counted(chunks):
+            size = 0
+            for chunk in chunks:
+                size += len(chunk)
+                yield chunk
+            histogram.observe(size, *labelvalues)
+        response.streaming_content = counted(response.streaming_content)
+    return response
+
+
+REQUESTS = Counter(
+    "library_http_requests_total", "HTTP requests by view, method and status.", ["view", "method", "status"]
+)
+LATENCY = Histogram(
+    "library_http_request_duration_seconds", "Time spent producing the response.", ["view", "method"]
+)
+QUERIES = Histogram(
+    "library_http_request_queries", "SQL statements per request.", ["view"], buckets=QUERY_BUCKETS
+)
+EXPORT_BYTES = Histogram(
+    "library_export_bytes", "Size of exported files.", ["resource", "type"], buckets=SIZE_BUCKETS
+)
+RESPONSE_CACHE = Counter(
+    "library_response_cache_requests_total", "API response cache lookups by view and result.", ["view", "result"]
+)
+SINGLEFLIGHT = Counter(
+    "library_singleflight_calls_total", "Coalesced computations: computed by the caller or shared with it.", ["result"]
+)
@@ -0,0 +1,190 @@
+import heapq
+import json
+import logging
+import random
+import time
+from contextlib import ExitStack, contextmanager
+
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction
+from django.conf import settings
+from django.db import connections
+
+from library import metrics
+
+logger = logging.getLogger("library.timing")
+
+SLOWEST_STATEMENTS = 5
+SQL_PREVIEW_LENGTH = 500
+
+
+class _QueryRecorder:
+    """``execute_wrapper`` hook summing query count and time, optionally keeping the slowest SQL."""
+
+    def __init__(self, keep_slowest):
+        self.count = 0
+        self.seconds = 0.0
+        self.keep_slowest = keep_slowest
+        self.slowest = []
+
+    def __call__(self, execute, sql, params, many, context):
+        started = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            elapsed = time.perf_counter() - started
+            self.count += 1
+            self.seconds += elapsed
+            if self.keep_slowest:
+                entry = (elapsed, self.count, sql)
+                if len(self.slowest) < SLOWEST_STATEMENTS:
+                    heapq.heappush(self.slowest, entry)
+                elif elapsed > self.slowest[0][0]:
+                    heapq.heapreplace(self.slowest, entry)
+
+
+@contextmanager
+def _recording(queries):
+    with ExitStack() as stack:
+        for connection in connections.all():
+            stack.enter_context(connection.execute_wrapper(queries))
+        yield
+
+
+class ServerTimingMiddleware:
+    """Break each request's time down into SQL, the response renderer and application code.
+
+    ``REQUEST_TIMING_HEADERS`` adds a ``Server-Timing`` header (visible in the
+    browser's network tab); ``REQUEST_TIMING_SAMPLE_RATE`` is the share of
+    requests written to the ``library.timing`` logger as one JSON line with the
+    slowest statements. With both off the middleware only calls through.
+    "renderer" is only the DRF renderer turning data into bytes: serializers
+    run inside the view, so their time is part of "app" (and "db").
+    Streaming bodies are produced after the middleware returns, so their time
+    and queries are not counted. Under ASGI no statements are seen at all
+    (views run on other threads' connections), so the SQL figures are left out.
+    """
+
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        self.headers = getattr(settings, "REQUEST_TIMING_HEADERS", False)
+        self.sample_rate = getattr(settings, "REQUEST_TIMING_SAMPLE_RATE", 0.0)
+        if iscoroutinefunction(get_response):
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if iscoroutinefunction(self):
+            return self.__acall__(request)
+        sampled = self.sample_rate > 0 and random.random() < self.sample_rate
+        if not (self.headers or sampled):
+            return self.get_response(request)
+
+        queries = _QueryRecorder(keep_slowest=sampled)
+        request._timing_render = [0.0, 0.0]
+        started = time.perf_counter()
+        with _recording(queries):
+            response = self.get_response(request)
+        return self._report(request, response, queries, time.perf_counter() - started, sampled)
+
+    async def __acall__(self, request):
+        sampled = self.sample_rate > 0 and random.random() < self.sample_rate
+        if not (self.headers or sampled):
+            return await self.get_response(request)
+
+        # Views run on other threads with their own connections: no statements are seen here.
+        request._timing_render = [0.0, 0.0]
+        started = time.perf_counter()
+        response = await self.get_response(request)
+        return self._report(request, response, None, time.perf_counter() - started, sampled)
+
+    def _report(self, request, response, queries, total, sampled):
+        # ``queries`` is None when nothing was recorded (ASGI): the SQL entries are
+        # left out rather than reported as zero, and "app" then includes SQL time.
+        render_started, render_finished = request._timing_render
+        renderer = max(render_finished - render_started, 0.0)
+        app = max(total - (queries.seconds if queries else 0.0) - renderer, 0.0)
+        if self.headers:
+            entries = [
+                f"renderer;dur={renderer * 1000:.1f}",
+                f"app;dur={app * 1000:.1f}",
+                f"total;dur={total * 1000:.1f}",
+            ]
+            if queries is not None:
+                entries.insert(0, f'db;dur={queries.seconds * 1000:.1f};desc="{queries.count} queries"')
+            response["Server-Timing"] = ", ".join(entries)
+        if sampled:
+            line = {
+                "method": request.method,
+                "path": request.path,
+                "status": response.status_code,
+                "total_ms": round(total * 1000, 2),
+                "renderer_ms": round(renderer * 1000, 2),
+                "app_ms": round(app * 1000, 2),
+            }
+            if queries is not None:
+                line.update({
+                    "db_ms": round(queries.seconds * 1000, 2),
+                    "queries": queries.count,
+                    "slowest": [
+                        {"ms": round(elapsed * 1000, 2), "sql": sql[:SQL_PREVIEW_LENGTH]}
+                        for elapsed, _, sql in sorted(queries.slowest, reverse=True)
+                    ],
+                })
+            logger.info(json.dumps(line, ensure_ascii=False))
+        return response
+
+    def process_template_response(self, request, response):
+        # DRF responses are template responses: rendering starts right after
+        # this hook and the post-render callback fires when it is done.
+        timing = getattr(request, "_timing_render", None)
+        if timing is not None:
+            timing[0] = time.perf_counter()
+
+            def finished(rendered):
+                timing[1] = time.perf_counter()
+            response.add_post_render_callback(finished)
+        return response
+
+
+class MetricsMiddleware:
+    """Feed request counts, latency and SQL statements per request into ``library.metrics``.
+
+    Requests are labelled with the URL name (``book-list``, ``loan-export``),
+    which keeps the label set small whatever the query string is. Under ASGI
+    no statements are seen (views run on other threads), so no query count is
+    observed rather than a zero.
+    """
+
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        if iscoroutinefunction(get_response):
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if iscoroutinefunction(self):
+            return self.__acall__(request)
+        queries = _QueryRecorder(keep_slowest=False)
+        started = time.perf_counter()
+        with _recording(queries):
+            response = self.get_response(request)
+        self._record(request, response, time.perf_counter() - started, queries)
+        return response
+
+    async def __acall__(self, request):
+        started = time.perf_counter()
+        response = await self.get_response(request)
+        self._record(request, response, time.perf_counter() - started)
+        return response
+
+    def _record(self, request, response, elapsed, queries=None):
+        match = request.resolver_match
+        view = match.view_name if match else "unmatched"
+        metrics.REQUESTS.inc(view, request.method, str(response.status_code))
+        metrics.LATENCY.observe(elapsed, view, request.method)
+        if queries is not None:
+            metrics.QUERIES.observe(queries.count, view)
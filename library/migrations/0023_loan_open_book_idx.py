@@ -0,0 +1,19 @@
+# Generated by Django 5.2.5 on 2026-10-17 07:03
+
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('library', '0022_remove_book_cover_alter_userprofile_totp_key'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='loan',
+            index=models.Index(condition=models.Q(('return_date__isnull', True)), fields=['book'], name='loan_open_book_idx'),
+        ),
+    ]
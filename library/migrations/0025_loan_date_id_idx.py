@@ -0,0 +1,19 @@
+# Generated by Django 5.2.5 on 2026-10-17 07:08
+
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('library', '0024_exportjob'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='loan',
+            index=models.Index(fields=['loan_date', 'id'], name='loan_date_id_idx'),
+        ),
+    ]
@@ -0,0 +1,54 @@
+# Generated by Django 5.2.5 on 2026-10-17 07:10
+
+from django.db import migrations, models
+from django.db.models import Count
+
+
+def fill_counters(apps, schema_editor):
+    StatCounter = apps.get_model('library', 'StatCounter')
+    Genre = apps.get_model('library', 'Genre')
+    Library = apps.get_model('library', 'Library')
+    Book = apps.get_model('library', 'Book')
+    Loan = apps.get_model('library', 'Loan')
+
+    rows = [
+        StatCounter(scope='genre_count', value=Genre.objects.count()),
+        StatCounter(scope='library_count', value=Library.objects.count()),
+        StatCounter(scope='book_count', value=Book.objects.count()),
+        StatCounter(scope='loan_count', value=Loan.objects.count()),
+    ]
+    for scope, queryset, field in [
+        ('genre_books', Book.objects, 'genre'),
+        ('book_loans', Loan.objects, 'book'),
+        ('library_loans', Loan.objects, 'book__library'),
+        ('member_loans', Loan.objects, 'member'),
+    ]:
+        grouped = queryset.values_list(field).annotate(c=Count('id')).order_by()
+        rows += [StatCounter(scope=scope, key=key, value=value) for key, value in grouped if key is not None]
+    StatCounter.objects.bulk_create(rows, batch_size=5000)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('library', '0025_loan_date_id_idx'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='StatCounter',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('scope', models.CharField(max_length=32, verbose_name='Показатель')),
+                ('key', models.BigIntegerField(default=0, verbose_name='Объект')),
+                ('value', models.BigIntegerField(default=0, verbose_name='Значение')),
+            ],
+            options={
+                'verbose_name': 'Счётчик статистики',
+                'verbose_name_plural': 'Счётчики статистики',
+                'indexes': [models.Index(fields=['scope', '-value'], name='stat_counter_top_idx')],
+                'constraints': [models.UniqueConstraint(fields=('scope', 'key'), name='stat_counter_scope_key')],
+            },
+        ),
+        migrations.RunPython(fill_counters, migrations.RunPython.noop),
+    ]
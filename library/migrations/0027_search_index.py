@@ -0,0 +1,63 @@
+from django.db import migrations
+
+# Must match library.search.SOURCES: (kind, table, column).
+SOURCES = [
+    (1, 'library_book', 'title'),
+    (2, 'library_member', 'first_name'),
+    (3, 'library_library', 'name'),
+]
+
+
+def fold(expression):
+    # unicode61 only strips diacritics from Latin letters, so "ё" is folded by hand.
+    return f"replace(replace({expression}, 'ё', 'е'), 'Ё', 'Е')"
+
+
+def create_search_index(apps, schema_editor, prefix='2 3'):
+    if schema_editor.connection.vendor != 'sqlite':
+        return
+    execute = schema_editor.execute
+    execute(
+        "CREATE VIRTUAL TABLE library_search USING fts5("
+        f"text UNINDEXED, terms, tokenize = 'unicode61 remove_diacritics 2', prefix = '{prefix}')"
+    )
+    for kind, table, column in SOURCES:
+        rowid = f'{{row}}.id * 4 + {kind}'
+        execute(
+            f"CREATE TRIGGER library_search_{table}_insert AFTER INSERT ON {table} BEGIN "
+            f"INSERT INTO library_search (rowid, text, terms) "
+            f"VALUES ({rowid.format(row='new')}, new.{column}, {fold(f'new.{column}')}); END"
+        )
+        execute(
+            f"CREATE TRIGGER library_search_{table}_update AFTER UPDATE OF {column} ON {table} BEGIN "
+            f"UPDATE library_search SET text = new.{column}, terms = {fold(f'new.{column}')} "
+            f"WHERE rowid = {rowid.format(row='old')}; END"
+        )
+        execute(
+            f"CREATE TRIGGER library_search_{table}_delete AFTER DELETE ON {table} BEGIN "
+            f"DELETE FROM library_search WHERE rowid = {rowid.format(row='old')}; END"
+        )
+        execute(
+            f"INSERT INTO library_search (rowid, text, terms) "
+            f"SELECT id * 4 + {kind}, {column}, {fold(column)} FROM {table}"
+        )
+
+
+def drop_search_index(apps, schema_editor):
+    if schema_editor.connection.vendor != 'sqlite':
+        return
+    for kind, table, column in SOURCES:
+        for event in ('insert', 'update', 'delete'):
+            schema_editor.execute(f"DROP TRIGGER IF EXISTS library_search_{table}_{event}")
+    schema_editor.execute("DROP TABLE IF EXISTS library_search")
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('library', '0026_statcounter'),
+    ]
+
+    operations = [
+        migrations.RunPython(create_search_index, drop_search_index),
+    ]
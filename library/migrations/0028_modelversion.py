@@ -0,0 +1,36 @@
+# Generated by Django 5.2.5 on 2026-10-17 08:27
+
+from django.db import migrations, models
+
+VERSIONED_MODELS = [
+    'library.genre', 'library.library', 'library.book', 'library.member', 'library.loan',
+    'auth.user', 'library.userprofile',
+]
+
+
+def create_versions(apps, schema_editor):
+    ModelVersion = apps.get_model('library', 'ModelVersion')
+    ModelVersion.objects.bulk_create([ModelVersion(model=label) for label in VERSIONED_MODELS])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('library', '0027_search_index'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ModelVersion',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('model', models.CharField(max_length=100, unique=True, verbose_name='Модель')),
+                ('version', models.BigIntegerField(default=0, verbose_name='Версия')),
+            ],
+            options={
+                'verbose_name': 'Версия данных',
+                'verbose_name_plural': 'Версии данных',
+            },
+        ),
+        migrations.RunPython(create_versions, migrations.RunPython.noop),
+    ]
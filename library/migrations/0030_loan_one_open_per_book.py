@@ -0,0 +1,35 @@
+# Generated by Django 5.2.5 on 2026-10-17 09:20
+
+from django.db import migrations, models
+from django.db.models import Count
+from django.utils import timezone
+
+
+def close_duplicate_open_loans(apps, schema_editor):
+    # Of several open loans of one book only the latest stays open; the others
+    # are closed on the day it was handed out.
+    Loan = apps.get_model('library', 'Loan')
+    open_loans = Loan.objects.filter(return_date__isnull=True)
+    duplicated = open_loans.values('book').annotate(n=Count('id')).filter(n__gt=1).values_list('book', flat=True)
+    for book_id in list(duplicated):
+        books_loans = open_loans.filter(book=book_id)
+        latest_id, latest_date = books_loans.order_by('-loan_date', '-id').values_list('id', 'loan_date').first()
+        books_loans.exclude(pk=latest_id).update(return_date=latest_date, updated_at=timezone.now())
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('library', '0029_sync'),
+    ]
+
+    operations = [
+        migrations.RunPython(close_duplicate_open_loans, migrations.RunPython.noop),
+        migrations.RemoveIndex(
+            model_name='loan',
+            name='loan_open_book_idx',
+        ),
+        migrations.AddConstraint(
+            model_name='loan',
+            constraint=models.UniqueConstraint(condition=models.Q(('return_date__isnull', True)), fields=('book',), name='loan_one_open_per_book'),
+        ),
+    ]
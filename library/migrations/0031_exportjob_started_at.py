@@ -0,0 +1,18 @@
+# Generated by Django 5.2.5 on 2026-10-17 09:39
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('library', '0030_loan_one_open_per_book'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='exportjob',
+            name='started_at',
+            field=models.DateTimeField(blank=True, null=True, verbose_name='Запущено'),
+        ),
+    ]
@@ -0,0 +1,26 @@
+from importlib import import_module
+
+from django.db import migrations
+
+search_index = import_module('library.migrations.0027_search_index')
+
+
+def rebuild_search_index(prefix):
+    # FTS5 cannot change the prefix indexes of an existing table.
+    def rebuild(apps, schema_editor):
+        search_index.drop_search_index(apps, schema_editor)
+        search_index.create_search_index(apps, schema_editor, prefix=prefix)
+    return rebuild
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('library', '0031_exportjob_started_at'),
+    ]
+
+    # Only prefixes of search.MIN_PREFIX letters are ever queried; the
+    # two-letter index was kept up to date for nothing.
+    operations = [
+        migrations.RunPython(rebuild_search_index('3'), rebuild_search_index('2 3')),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 5.2.5 on 2026-10-17 10:13
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('library', '0032_search_index_prefix'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='exportjob',
+            name='expires_at',
+            field=models.DateTimeField(blank=True, db_index=True, null=True, verbose_name='Удалить после'),
+        ),
+    ]
@@ -1,7 +1,9 @@
 from django.db import models
+from django.db.models import Exists, OuterRef, Q
 from django.contrib.auth.models import User
 from django.dispatch import receiver
 from django.db.models.signals import post_save
+import secrets
 import pyotp
 
 
@@ -9,6 +11,7 @@ import pyotp
 class Genre(models.Model):
     name = models.TextField("Жанр")
     user = models.ForeignKey(User, on_delete=models.CASCADE, null=True, blank=True, verbose_name="Пользователь")
+    updated_at = models.DateTimeField("Изменено", auto_now=True, db_index=True)
     
     class Meta:
         verbose_name = "Жанр"
@@ -21,6 +24,7 @@ class Library(models.Model):
     name = models.TextField("Название библиотеки")
     address = models.TextField("Адрес")
     user = models.ForeignKey(User, on_delete=models.CASCADE, null=True, blank=True, verbose_name="Пользователь")
+    updated_at = models.DateTimeField("Изменено", auto_now=True, db_index=True)
 
     class Meta:
         verbose_name = "Библиотека"
@@ -30,10 +34,19 @@ class Library(models.Model):
         return self.name
 
 
+class BookQuerySet(models.QuerySet):
+    def with_availability(self):
+        open_loans = Loan.objects.filter(book=OuterRef("pk"), return_date__isnull=True)
+        return self.annotate(has_open_loan=Exists(open_loans))
+
+
 class Book(models.Model):
     title = models.TextField("Название книги")
     genre = models.ForeignKey(Genre, on_delete=models.CASCADE, verbose_name="Жанр")
     library = models.ForeignKey(Library, on_delete=models.CASCADE, verbose_name="Библиотека")
+    updated_at = models.DateTimeField("Изменено", auto_now=True, db_index=True)
+
+    objects = BookQuerySet.as_manager()
 
     class Meta:
         verbose_name = "Книга"
@@ -43,6 +56,8 @@ class Book(models.Model):
         return self.title
     
     def is_available(self):
+        if hasattr(self, "has_open_loan"):
+            return not self.has_open_loan
         return not Loan.objects.filter(book=self, return_date__isnull=True).exists()
 
 
@@ -51,6 +66,7 @@ class Member(models.Model):
     library = models.ForeignKey(Library, on_delete=models.CASCADE, verbose_name="Библиотека")
     photo = models.ImageField("Фото", upload_to="members", null=True, blank=True)
     user = models.ForeignKey(User, on_delete=models.CASCADE, null=True, blank=True, verbose_name="Пользователь")
+    updated_at = models.DateTimeField("Изменено", auto_now=True, db_index=True)
 
     class Meta:
         verbose_name = "Читатель"
@@ -66,15 +82,104 @@ class Loan(models.Model):
     loan_date = models.DateField("Дата выдачи")
     return_date = models.DateField(null=True, blank=True, verbose_name="Дата возврата")
     user = models.ForeignKey(User, on_delete=models.CASCADE, null=True, blank=True, verbose_name="Пользователь")
+    updated_at = models.DateTimeField("Изменено", auto_now=True, db_index=True)
 
     class Meta:
         verbose_name = "Выдача книги"
         verbose_name_plural = "Выдачи книг"
+        indexes = [
+            models.Index(fields=["loan_date", "id"], name="loan_date_id_idx"),
+        ]
+        constraints = [
+            # At most one open loan per book; also serves the availability lookups.
+            models.UniqueConstraint(fields=["book"], condition=Q(return_date__isnull=True), name="loan_one_open_per_book"),
+        ]
 
     def __str__(self) -> str:
         return f"{self.book} → {self.member}"
 
 
+class StatCounter(models.Model):
+    scope = models.CharField("Показатель", max_length=32)
+    key = models.BigIntegerField("Объект", default=0)
+    value = models.BigIntegerField("Значение", default=0)
+
+    class Meta:
+        verbose_name = "Счётчик статистики"
+        verbose_name_plural = "Счётчики статистики"
+        constraints = [
+            models.UniqueConstraint(fields=["scope", "key"], name="stat_counter_scope_key"),
+        ]
+        indexes = [
+            models.Index(fields=["scope", "-value"], name="stat_counter_top_idx"),
+        ]
+
+    def __str__(self) -> str:
+        return f"{self.scope}[{self.key}] = {self.value}"
+
+
+class ModelVersion(models.Model):
+    model = models.CharField("Модель", max_length=100, unique=True)
+    version = models.BigIntegerField("Версия", default=0)
+
+    class Meta:
+        verbose_name = "Версия данных"
+        verbose_name_plural = "Версии данных"
+
+    def __str__(self) -> str:
+        return f"{self.model} v{self.version}"
+
+
+class Tombstone(models.Model):
+    model = models.CharField("Модель", max_length=100)
+    object_id = models.BigIntegerField("Объект")
+    deleted_at = models.DateTimeField("Удалено", auto_now_add=True, db_index=True)
+
+    class Meta:
+        verbose_name = "Удалённая запись"
+        verbose_name_plural = "Удалённые записи"
+
+    def __str__(self) -> str:
+        return f"{self.model}#{self.object_id}"
+
+
+def new_export_token():
+    return secrets.token_urlsafe(32)
+
+
+class ExportJob(models.Model):
+    PENDING = "pending"
+    RUNNING = "running"
+    DONE = "done"
+    FAILED = "failed"
+    STATUS_CHOICES = [
+        (PENDING, "В очереди"),
+        (RUNNING, "Выполняется"),
+        (DONE, "Готово"),
+        (FAILED, "Ошибка"),
+    ]
+
+    resource = models.CharField("Раздел", max_length=32)
+    file_type = models.CharField("Формат", max_length=16)
+    status = models.CharField("Статус", max_length=16, choices=STATUS_CHOICES, default=PENDING)
+    token = models.CharField(max_length=64, unique=True, default=new_export_token)
+    file = models.FileField("Файл", upload_to="exports", blank=True)
+    error = models.TextField("Ошибка", blank=True)
+    user = models.ForeignKey(User, on_delete=models.CASCADE, null=True, blank=True, verbose_name="Пользователь")
+    created_at = models.DateTimeField("Создано", auto_now_add=True)
+    started_at = models.DateTimeField("Запущено", null=True, blank=True)
+    finished_at = models.DateTimeField("Завершено", null=True, blank=True)
+    # Set when the job finishes: the link lives EXPORT_JOB_TTL from then, however long the export took.
+    expires_at = models.DateTimeField("Удалить после", null=True, blank=True, db_index=True)
+
+    class Meta:
+        verbose_name = "Задача выгрузки"
+        verbose_name_plural = "Задачи выгрузки"
+
+    def __str__(self) -> str:
+        return f"{self.resource}.{self.file_type} ({self.status})"
+
+
 class UserProfile(models.Model):
     user = models.OneToOneField(User, on_delete=models.CASCADE, related_name='profile')
     age = models.IntegerField(null=True, blank=True, verbose_name='Возраст')
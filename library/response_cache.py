@@ -0,0 +1,75 @@
+from functools import partial, wraps
+
+from django.conf import settings
+from django.core.cache import caches
+from rest_framework.response import Response
+
+from library import metrics, singleflight, versions
+
+CACHE_ALIAS = "api"
+KEY_PREFIX = "response:"
+MISSING = object()
+
+
+def fetch(request, key, compute, ttl=None, coalesce=False):
+    """Response data cached under ``key``, or the response of ``compute()`` (cached when it is a 200).
+
+    Keys carry the versions of the models the data is built from, so a write
+    never needs to find and delete entries: the next request simply asks
+    for a new key and the old one ages out through the TTL or LRU eviction.
+    With ``coalesce`` concurrent misses share one ``compute()`` (see
+    ``library.singleflight``).
+    """
+    data = lookup(request, key)
+    if data is not MISSING:
+        return Response(data)
+    if not coalesce:
+        return _compute(key, compute, ttl)
+
+    computed = []
+
+    def shared():
+        response = _compute(key, compute, ttl)
+        computed.append(response)
+        return response.data if response.status_code == 200 else None
+
+    data = singleflight.run(key, shared)
+    if computed:
+        return computed[0]
+    # Only 200 bodies are shared; a waiter whose leader got another status computes its own response.
+    return Response(data) if data is not None else compute()
+
+
+def lookup(request, key):
+    """Data cached under ``key``, or ``MISSING``; counted as a hit or miss of the request's view."""
+    match = request.resolver_match
+    view = match.view_name if match else "unmatched"
+    data = caches[CACHE_ALIAS].get(key, MISSING)
+    metrics.RESPONSE_CACHE.inc(view, "miss" if data is MISSING else "hit")
+    return data
+
+
+def store(key, data, ttl=None):
+    caches[CACHE_ALIAS].set(key, data, settings.RESPONSE_CACHE_TTL if ttl is None else ttl)
+
+
+def _compute(key, compute, ttl):
+    response = compute()
+    if response.status_code == 200:
+        store(key, response.data, ttl)
+    return response
+
+
+def cached_action(*models, per_user=False, ttl=None):
+    """Cache a viewset action by request, ``models`` versions and the user's role (or the user).
+
+    Concurrent misses for the same key are computed once.
+    """
+    def decorator(method):
+        @wraps(method)
+        def wrapper(self, request, *args, **kwargs):
+            scope = None if per_user else versions.permission_scope(request.user)
+            key = KEY_PREFIX + versions.etag(request._request, models, scope)
+            return fetch(request, key, partial(method, self, request, *args, **kwargs), ttl, coalesce=True)
+        return wrapper
+    return decorator
@@ -0,0 +1,112 @@
+import re
+
+from django.db import connection
+from django.db.models import Q
+from django.db.models.expressions import RawSQL
+
+from library.models import Library, Book, Member
+
+SEARCH_LIMIT = 20
+MAX_SEARCH_LIMIT = 100
+MAX_TERMS = 8
+# Shorter prefixes match too much of a large catalog to rank in a few ms;
+# the FTS table indexes exactly this prefix length (migration 0032).
+MIN_PREFIX = 3
+
+# kind -> (type name, model, indexed field); kept in step with migration 0027.
+SOURCES = {
+    1: ("book", Book, "title"),
+    2: ("member", Member, "first_name"),
+    3: ("library", Library, "name"),
+}
+KINDS = {name: kind for kind, (name, _, _) in SOURCES.items()}
+
+TERM_RE = re.compile(r"\w+")
+
+
+def fold(text):
+    # The index stores "ё" as "е" (see migration 0027), so queries are folded the same way.
+    return text.casefold().replace("ё", "е")
+
+
+def words(text):
+    return TERM_RE.findall(fold(text))
+
+
+def terms(query):
+    return words(query)[:MAX_TERMS]
+
+
+def fts_query(words):
+    """Every word must match, the last one as a prefix so results follow the user's typing."""
+    quoted = [f'"{word}"' for word in words]
+    if len(words[-1]) >= MIN_PREFIX:
+        quoted[-1] += "*"
+    return " ".join(quoted)
+
+
+def search(query, types=None, limit=SEARCH_LIMIT):
+    """Books, members and libraries matching ``query``, best first.
+
+    On SQLite this is one statement against the ``library_search`` FTS5 index
+    (bm25 ranking, diacritic- and case-insensitive Unicode tokenization, so
+    "ёлка" finds "Елка"); other backends fall back to ``icontains``.
+    """
+    words = terms(query)
+    if not words:
+        return []
+    kinds = [KINDS[name] for name in types or KINDS if name in KINDS]
+    if not kinds:
+        return []
+    if connection.vendor != "sqlite":
+        return _fallback(words, kinds, limit)
+
+    sql = "SELECT rowid, text FROM library_search WHERE library_search MATCH %s"
+    params = [fts_query(words)]
+    if len(kinds) < len(SOURCES):
+        sql += f" AND rowid % 4 IN ({', '.join(['%s'] * len(kinds))})"
+        params += kinds
+    sql += " ORDER BY rank LIMIT %s"
+    params.append(limit)
+    with connection.cursor() as cursor:
+        cursor.execute(sql, params)
+        return [
+            {"type": SOURCES[rowid % 4][0], "id": rowid // 4, "text": text}
+            for rowid, text in cursor.fetchall()
+        ]
+
+
+def _fallback(words, kinds, limit):
+    results = []
+    for kind in kinds:
+        name, model, field = SOURCES[kind]
+        queryset = model.objects.all()
+        for word in words:
+            queryset = queryset.filter(**{f"{field}__icontains": word})
+        results += [
+            {"type": name, "id": pk, "text": text}
+            for pk, text in queryset.order_by(field).values_list("id", field)[:limit]
+        ]
+    return results[:limit]
+
+
+def matching(query, name, field="pk"):
+    """Filter on ``field`` (an id of ``name`` objects) by the words of ``query``, for querysets such as the admin's.
+
+    On SQLite the ids come from the FTS index, not a LIKE scan; ``None``
+    when the query has no words.
+    """
+    words = terms(query)
+    if not words:
+        return None
+    kind = KINDS[name]
+    if connection.vendor != "sqlite":
+        _, model, text_field = SOURCES[kind]
+        ids = model.objects.all()
+        for word in words:
+            ids = ids.filter(**{f"{text_field}__icontains": word})
+        return Q(**{f"{field}__in": ids.values("id")})
+    return Q(**{f"{field}__in": RawSQL(
+        "SELECT rowid / 4 FROM library_search WHERE library_search MATCH %s AND rowid %% 4 = %s",
+        [fts_query(words), kind],
+    )})
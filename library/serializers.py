@@ -1,6 +1,10 @@
+import operator
+
 from rest_framework import serializers
-from library.models import Library, Book, Genre, Member, Loan, UserProfile
+from library.models import Library, Book, Genre, Member, Loan, UserProfile, ExportJob
+from library.exports import EXPORT_FORMATS
 from django.contrib.auth.models import User
+from django.urls import reverse
 
 
 class BookSerializer(serializers.ModelSerializer):
@@ -75,17 +79,23 @@ class LoanSerializer(serializers.ModelSerializer):
         fields = ['id', 'book', 'member', 'loan_date', 'return_date', 'book_title', 'member_name']
         read_only_fields = ['return_date']
 
-    def create(self, validated_data):
-        user = self.context['request'].user
-        validated_data['user'] = user
-        return super().create(validated_data)
 
-    def update(self, instance, validated_data):
-        return super().update(instance, validated_data)
+class BulkLoanItemSerializer(serializers.Serializer):
+    book = serializers.IntegerField()
+    member = serializers.IntegerField()
+    loan_date = serializers.DateField(required=False)
+
+
+class BulkLoanSerializer(serializers.Serializer):
+    items = BulkLoanItemSerializer(many=True, allow_empty=False, max_length=1000)
+
+
+class BulkReturnSerializer(serializers.Serializer):
+    ids = serializers.ListField(child=serializers.IntegerField(), allow_empty=False, max_length=1000)
 
 
 class UserSerializer(serializers.ModelSerializer):
-    age = serializers.IntegerField(source='userprofile.age', required=False, allow_null=True)
+    age = serializers.IntegerField(source='profile.age', required=False, allow_null=True)
 
     class Meta:
         model = User
@@ -93,7 +103,7 @@ class UserSerializer(serializers.ModelSerializer):
         read_only_fields = ['id']
 
     def update(self, instance, validated_data):
-        profile_data = validated_data.pop('userprofile', {})
+        profile_data = validated_data.pop('profile', {})
         age = profile_data.get('age')
 
         for attr, value in validated_data.items():
@@ -104,4 +114,113 @@ class UserSerializer(serializers.ModelSerializer):
             profile, _ = UserProfile.objects.get_or_create(user=instance)
             profile.age = age
             profile.save()
-        return instance
\ No newline at end of file
+        return instance
+
+class ExportJobSerializer(serializers.ModelSerializer):
+    type = serializers.ChoiceField(source='file_type', choices=list(EXPORT_FORMATS), default="excel")
+    download_url = serializers.SerializerMethodField()
+
+    class Meta:
+        model = ExportJob
+        fields = ['id', 'resource', 'type', 'status', 'error', 'created_at', 'finished_at', 'expires_at', 'download_url']
+        read_only_fields = ['status', 'error', 'created_at', 'finished_at', 'expires_at']
+
+    def validate_resource(self, value):
+        from library.api import BaseExportMixin
+        if value not in BaseExportMixin.registry:
+            raise serializers.ValidationError(f"Неизвестный раздел: {value}")
+        return value
+
+    def get_download_url(self, obj):
+        if obj.status != ExportJob.DONE:
+            return None
+        url = reverse('export-job-download', kwargs={'token': obj.token})
+        request = self.context.get('request')
+        return request.build_absolute_uri(url) if request else url
+
+
+def iso_date(value):
+    return None if value is None else value.isoformat()
+
+
+class ValuesSerializer:
+    """Read-only list representation built from ``queryset.values()`` rows, without model instances.
+
+    ``fields`` maps each output key to the ORM lookup it is read from and
+    ``converters`` maps a key to a callable for its raw value. The output
+    must match the model serializer it stands in for, key order included.
+    """
+    fields = {}
+    converters = {}
+
+    @classmethod
+    def lookups(cls, keys=None):
+        return [lookup for key, lookup in cls.fields.items() if keys is None or key in keys]
+
+    @classmethod
+    def to_representation(cls, rows, keys=None):
+        plan = [
+            (key, lookup, cls.converters.get(key))
+            for key, lookup in cls.fields.items() if keys is None or key in keys
+        ]
+        return [
+            {key: convert(row[lookup]) if convert else row[lookup] for key, lookup, convert in plan}
+            for row in rows
+        ]
+
+
+class GenreValuesSerializer(ValuesSerializer):
+    fields = {'id': 'id', 'name': 'name', 'user': 'user_id'}
+
+
+class LibraryValuesSerializer(ValuesSerializer):
+    fields = {'id': 'id', 'name': 'name', 'user': 'user_id'}
+
+
+class BookValuesSerializer(ValuesSerializer):
+    fields = {
+        'id': 'id',
+        'title': 'title',
+        'genre': 'genre_id',
+        'library': 'library_id',
+        'genre_name': 'genre__name',
+        'library_name': 'library__name',
+        'is_available': 'has_open_loan',
+    }
+    converters = {'is_available': operator.not_}
+
+
+class LoanValuesSerializer(ValuesSerializer):
+    fields = {
+        'id': 'id',
+        'book': 'book_id',
+        'member': 'member_id',
+        'loan_date': 'loan_date',
+        'return_date': 'return_date',
+        'book_title': 'book__title',
+        'member_name': 'member__first_name',
+    }
+    converters = {'loan_date': iso_date, 'return_date': iso_date}
+
+
+class UserValuesSerializer(ValuesSerializer):
+    fields = {
+        'id': 'id',
+        'username': 'username',
+        'first_name': 'first_name',
+        'last_name': 'last_name',
+        'email': 'email',
+        'is_superuser': 'is_superuser',
+        'age': 'profile__age',
+    }
+
+
+class ReaderValuesSerializer(ValuesSerializer):
+    fields = {
+        'id': 'id',
+        'user': 'user_id',
+        'user_name': 'user__username',
+        'library': 'library_id',
+        'library_name': 'library__name',
+        'first_name': 'first_name',
+    }
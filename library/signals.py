@@ -1,8 +1,18 @@
-from django.db.models.signals import post_save
-from django.dispatch import receiver
+from collections import Counter
+from functools import partial
+
+from django.db.models.signals import post_save, pre_save, post_delete
+from django.db import transaction
+from django.dispatch import Signal, receiver
 from django.contrib.auth.models import User
 
-from .models import Member, Library, UserProfile
+from . import autocomplete, events, stats, sync, versions
+from .models import Member, Library, UserProfile, Genre, Book, Loan, Tombstone
+
+# Sent by code paths that bypass per-row signals: bulk_create (``instances``)
+# and queryset.update() (``pks`` and the ``fields`` that changed).
+post_bulk_create = Signal()
+post_bulk_update = Signal()
 
 
 @receiver(post_save, sender=User)
@@ -20,3 +30,228 @@ def create_member_profile(sender, instance, created, **kwargs):
                     'library': library
                 }
             )
+
+
+def _loan_key(loan):
+    if Loan.book.is_cached(loan):
+        library_id = loan.book.library_id
+    else:
+        library_id = Book.objects.filter(pk=loan.book_id).values_list("library_id", flat=True).first()
+    return loan.book_id, library_id, loan.member_id
+
+
+@receiver(post_save, sender=Genre)
+@receiver(post_save, sender=Library)
+def count_created(sender, instance, created, raw=False, **kwargs):
+    if created and not raw:
+        scope = stats.GENRE_COUNT if sender is Genre else stats.LIBRARY_COUNT
+        stats.apply({(scope, 0): 1})
+
+
+@receiver(post_delete, sender=Genre)
+@receiver(post_delete, sender=Library)
+def count_deleted(sender, instance, **kwargs):
+    if sender is Genre:
+        stats.apply({(stats.GENRE_COUNT, 0): -1})
+        stats.forget(stats.GENRE_BOOKS, instance.pk)
+    else:
+        stats.apply({(stats.LIBRARY_COUNT, 0): -1})
+        stats.forget(stats.LIBRARY_LOANS, instance.pk)
+
+
+@receiver(pre_save, sender=Book)
+def remember_book_origin(sender, instance, raw=False, **kwargs):
+    if instance.pk and not raw:
+        instance._stats_origin = Book.objects.filter(pk=instance.pk).values_list("genre_id", "library_id").first()
+
+
+@receiver(post_save, sender=Book)
+def count_book_saved(sender, instance, created, raw=False, **kwargs):
+    if raw:
+        return
+    if created:
+        stats.apply(stats.book_changes([instance.genre_id]))
+        return
+    origin = getattr(instance, "_stats_origin", None)
+    if not origin:
+        return
+    genre_id, library_id = origin
+    changes = Counter()
+    if genre_id != instance.genre_id:
+        changes[stats.GENRE_BOOKS, genre_id] -= 1
+        changes[stats.GENRE_BOOKS, instance.genre_id] += 1
+    if library_id != instance.library_id:
+        loans = Loan.objects.filter(book=instance).count()
+        changes[stats.LIBRARY_LOANS, library_id] -= loans
+        changes[stats.LIBRARY_LOANS, instance.library_id] += loans
+    stats.apply(changes)
+
+
+@receiver(post_delete, sender=Book)
+def count_book_deleted(sender, instance, **kwargs):
+    stats.apply(stats.book_changes([instance.genre_id], sign=-1))
+    stats.forget(stats.BOOK_LOANS, instance.pk)
+
+
+@receiver(pre_save, sender=Loan)
+def remember_loan_origin(sender, instance, raw=False, **kwargs):
+    if instance.pk and not raw:
+        origin = Loan.objects.filter(pk=instance.pk).values_list(
+            "book_id", "book__library_id", "member_id", "return_date"
+        ).first()
+        instance._stats_origin = origin[:3] if origin else None
+        instance._was_returned = bool(origin and origin[3])
+
+
+@receiver(post_save, sender=Loan)
+def count_loan_saved(sender, instance, created, raw=False, **kwargs):
+    if raw:
+        return
+    if created:
+        stats.apply(stats.loan_changes([_loan_key(instance)]))
+        return
+    origin = getattr(instance, "_stats_origin", None)
+    if origin and (origin[0], origin[2]) != (instance.book_id, instance.member_id):
+        changes = stats.loan_changes([_loan_key(instance)])
+        changes.subtract(stats.loan_changes([origin]))
+        stats.apply(changes)
+
+
+@receiver(post_delete, sender=Loan)
+def count_loan_deleted(sender, instance, **kwargs):
+    stats.apply(stats.loan_changes([_loan_key(instance)], sign=-1))
+
+
+@receiver(post_bulk_create, sender=Book)
+def count_books_bulk_created(sender, instances, **kwargs):
+    stats.apply(stats.book_changes(book.genre_id for book in instances))
+
+
+@receiver(post_bulk_create, sender=Loan)
+def count_loans_bulk_created(sender, instances, **kwargs):
+    stats.apply(stats.loan_changes(_loan_key(loan) for loan in instances))
+
+
+@receiver(post_delete, sender=Member)
+def forget_member(sender, instance, **kwargs):
+    stats.forget(stats.MEMBER_LOANS, instance.pk)
+
+
+@receiver(post_save, sender=Book)
+@receiver(post_save, sender=Member)
+def autocomplete_saved(sender, instance, raw=False, **kwargs):
+    if not raw:
+        _autocomplete_later(sender, [instance])
+
+
+@receiver(post_bulk_create, sender=Book)
+def autocomplete_bulk_created(sender, instances, **kwargs):
+    _autocomplete_later(sender, instances)
+
+
+@receiver(post_delete, sender=Book)
+@receiver(post_delete, sender=Member)
+def autocomplete_deleted(sender, instance, **kwargs):
+    kind = autocomplete.KINDS["book" if sender is Book else "member"]
+    transaction.on_commit(partial(autocomplete.update, kind, instance.pk))
+
+
+def _autocomplete_later(sender, instances):
+    kind = autocomplete.KINDS["book" if sender is Book else "member"]
+    field = autocomplete.SOURCES[kind][2]
+    changes = [(instance.pk, getattr(instance, field) or "") for instance in instances]
+
+    def apply():
+        for pk, text in changes:
+            autocomplete.update(kind, pk, text)
+    transaction.on_commit(apply)
+
+
+@receiver(post_delete, sender=Genre)
+@receiver(post_delete, sender=Library)
+@receiver(post_delete, sender=Book)
+@receiver(post_delete, sender=Member)
+@receiver(post_delete, sender=Loan)
+def leave_tombstone(sender, instance, **kwargs):
+    Tombstone.objects.create(model=sender._meta.label_lower, object_id=instance.pk)
+
+
+# Rows that show a changed row's name or a book's availability are marked
+# changed too, so delta sync (library.sync) sends them again.
+@receiver(post_save, sender=Genre)
+@receiver(post_save, sender=Library)
+@receiver(post_save, sender=Book)
+@receiver(post_save, sender=Member)
+@receiver(post_save, sender=User)
+def touch_dependents(sender, instance, created, raw=False, **kwargs):
+    if created or raw:
+        return
+    if sender is Genre:
+        sync.touch(Book, genre=instance)
+    elif sender is Library:
+        sync.touch(Book, library=instance)
+        sync.touch(Member, library=instance)
+    elif sender is Book:
+        sync.touch(Loan, book=instance)
+    elif sender is Member:
+        sync.touch(Loan, member=instance)
+    else:
+        sync.touch(Member, user=instance)
+
+
+@receiver(post_save, sender=Loan)
+@receiver(post_delete, sender=Loan)
+def touch_loan_books(sender, instance, raw=False, **kwargs):
+    if raw:
+        return
+    origin = getattr(instance, "_stats_origin", None)
+    sync.touch(Book, pk__in={instance.book_id, origin[0]} if origin else [instance.book_id])
+
+
+@receiver(post_bulk_create, sender=Loan)
+def touch_bulk_created_loan_books(sender, instances, **kwargs):
+    sync.touch(Book, pk__in={loan.book_id for loan in instances})
+
+
+@receiver(post_bulk_update, sender=Loan)
+def touch_bulk_updated_loan_books(sender, pks, **kwargs):
+    sync.touch(Book, loan__in=pks)
+
+
+@receiver(post_save, sender=Loan)
+def publish_loan_saved(sender, instance, created, raw=False, **kwargs):
+    if raw:
+        return
+    if created:
+        events.publish_on_commit(events.loan_events(instance, "created"))
+    elif instance.return_date is not None and not getattr(instance, "_was_returned", True):
+        events.publish_on_commit(events.loan_events(instance, "returned"))
+
+
+@receiver(post_delete, sender=Loan)
+def publish_loan_deleted(sender, instance, **kwargs):
+    events.publish_on_commit(events.loan_events(instance, "deleted"))
+
+
+@receiver(post_bulk_create, sender=Loan)
+def publish_loans_bulk_created(sender, instances, **kwargs):
+    events.publish_on_commit([event for loan in instances for event in events.loan_events(loan, "created")])
+
+
+@receiver(post_bulk_update, sender=Loan)
+def publish_loans_bulk_returned(sender, pks, fields, **kwargs):
+    if "return_date" in fields:
+        loans = Loan.objects.filter(pk__in=pks, return_date__isnull=False).only("id", "book_id", "return_date")
+        events.publish_on_commit([event for loan in loans for event in events.loan_events(loan, "returned")])
+
+
+VERSIONED = (Genre, Library, Book, Member, Loan, User, UserProfile)
+
+
+def bump_version(sender, **kwargs):
+    versions.bump(sender)
+
+
+for model in VERSIONED:
+    for signal in (post_save, post_delete, post_bulk_create, post_bulk_update):
+        signal.connect(bump_version, sender=model, dispatch_uid=f"bump_version_{model._meta.label_lower}")
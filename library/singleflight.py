@@ -0,0 +1,195 @@
+import hashlib
+import os
+import pickle
+import tempfile
+import threading
+import time
+from contextlib import contextmanager
+
+from django.conf import settings
+
+from library import metrics
+
+try:
+    import fcntl
+except ImportError:  # Windows: calls are still coalesced within the process
+    fcntl = None
+
+
+class _Call:
+    def __init__(self):
+        self.done = threading.Event()
+        self.error = None
+        self.waiters = 0
+        self.results = []
+
+
+_calls = {}
+_lock = threading.Lock()
+
+
+def run(key, compute):
+    """Result of ``compute()``, shared by every concurrent caller with the same ``key``.
+
+    Threads of one process wait on the first caller; processes queue on a
+    lock file in ``SINGLEFLIGHT_DIR`` and take the result it leaves behind
+    when it was finished after they started waiting. The result must pickle.
+    """
+    return _flight(key, lambda path: _replace(path, lambda file: pickle.dump(compute(), file)), _load)
+
+
+def shared_file(key, write):
+    """Like ``run`` for large results: an open file that ``write(file)`` filled, read by every waiter."""
+    return _flight(key, lambda path: _replace(path, write), lambda path: open(path, "rb"))
+
+
+def _flight(key, produce, consume):
+    name = hashlib.sha1(key.encode()).hexdigest()
+    path = os.path.join(settings.SINGLEFLIGHT_DIR, name)
+    with _lock:
+        call = _calls.get(name)
+        leader = call is None
+        if leader:
+            call = _calls[name] = _Call()
+        else:
+            call.waiters += 1
+    if not leader:
+        metrics.SINGLEFLIGHT.inc("shared")
+        call.done.wait()
+        if call.error is not None:
+            raise call.error
+        return call.results.pop()
+
+    try:
+        os.makedirs(settings.SINGLEFLIGHT_DIR, exist_ok=True)
+        with _locked(path) as lock:
+            if lock.finished_elsewhere and os.path.exists(path):
+                metrics.SINGLEFLIGHT.inc("shared")
+            else:
+                metrics.SINGLEFLIGHT.inc("computed")
+                produce(path)
+                lock.advance()
+            # Threads that joined open the result while the lock keeps the sweep away from it.
+            with _lock:
+                del _calls[name]
+            call.results = [consume(path) for _ in range(call.waiters)]
+            result = consume(path)
+    except BaseException as error:
+        call.error = error
+        with _lock:
+            _calls.pop(name, None)
+        raise
+    finally:
+        call.done.set()
+    _sweep(settings.SINGLEFLIGHT_DIR)
+    return result
+
+
+class _Generation:
+    """Number of results produced under one lock file, kept in the file itself."""
+
+    def __init__(self, fd, seen):
+        self.fd = fd
+        self.value = _read_generation(fd)
+        # Another process produced while we waited for the lock.
+        self.finished_elsewhere = fd is not None and self.value != seen
+
+    def advance(self):
+        if self.fd is not None:
+            os.pwrite(self.fd, (self.value + 1).to_bytes(8, "little"), 0)
+
+
+def _read_generation(fd):
+    return int.from_bytes(os.pread(fd, 8, 0), "little") if fd is not None else 0
+
+
+@contextmanager
+def _locked(path):
+    if fcntl is None:
+        yield _Generation(None, 0)
+        return
+    lock_path = f"{path}.lock"
+    while True:
+        fd = os.open(lock_path, os.O_RDWR | os.O_CREAT)
+        seen = _read_generation(fd)
+        fcntl.flock(fd, fcntl.LOCK_EX)
+        if _is_current(fd, lock_path):
+            break
+        # The sweep removed the file while we waited on it: queue on the new one.
+        os.close(fd)
+    try:
+        yield _Generation(fd, seen)
+    finally:
+        os.close(fd)
+
+
+def _is_current(fd, lock_path):
+    try:
+        return os.fstat(fd).st_ino == os.stat(lock_path).st_ino
+    except FileNotFoundError:
+        return False
+
+
+def _sweep(directory):
+    """Remove results, lock and temporary files of keys idle for ``SINGLEFLIGHT_TTL`` seconds."""
+    expired = time.time() - settings.SINGLEFLIGHT_TTL
+    names = set()
+    for entry in os.scandir(directory):
+        try:
+            if entry.stat().st_mtime < expired:
+                names.add(entry.name.lstrip(".").split(".")[0])
+        except FileNotFoundError:
+            pass
+    for name in names:
+        _remove(os.path.join(directory, name))
+
+
+def _remove(path):
+    if fcntl is None:
+        return _unlink(path)
+    directory, name = os.path.split(path)
+    files = [os.path.join(directory, file) for file in os.listdir(directory) if file.startswith(f".{name}.")]
+    files.append(path)
+    try:
+        fd = os.open(f"{path}.lock", os.O_RDWR)
+    except FileNotFoundError:
+        fd = None
+    try:
+        if fd is not None:
+            try:
+                fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                return  # a flight is running; it will sweep afterwards
+            if not _is_current(fd, f"{path}.lock"):
+                return
+            files.append(f"{path}.lock")
+        for file in files:
+            _unlink(file)
+    finally:
+        if fd is not None:
+            os.close(fd)
+
+
+def _unlink(path):
+    try:
+        os.unlink(path)
+    except FileNotFoundError:
+        pass
+
+
+def _replace(path, write):
+    # Readers holding the previous file keep it open; new ones see a complete file or the old one.
+    directory, name = os.path.split(path)
+    file = tempfile.NamedTemporaryFile(dir=directory, prefix=f".{name}.", delete=False)
+    try:
+        with file:
+            write(file)
+        os.replace(file.name, path)
+    except BaseException:
+        os.unlink(file.name)
+        raise
+
+
+def _load(path):
+    with open(path, "rb") as file:
+        return pickle.load(file)
@@ -0,0 +1,253 @@
+import asyncio
+import threading
+from collections import Counter, defaultdict
+from concurrent.futures import ThreadPoolExecutor
+
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.db import close_old_connections, transaction
+from django.db.models import Count, F, Q, Subquery
+
+from library.models import Library, Book, Genre, Member, Loan, StatCounter
+
+GENRE_COUNT = "genre_count"
+LIBRARY_COUNT = "library_count"
+BOOK_COUNT = "book_count"
+LOAN_COUNT = "loan_count"
+
+GENRE_BOOKS = "genre_books"
+LIBRARY_LOANS = "library_loans"
+BOOK_LOANS = "book_loans"
+MEMBER_LOANS = "member_loans"
+
+
+def apply(changes):
+    """Add ``{(scope, key): delta}`` to the counters inside the caller's transaction.
+
+    Missing rows are created with INSERT OR IGNORE, then one UPDATE per
+    distinct (scope, delta) pair increments them with F(), so a batch of
+    thousands of loans costs a handful of statements and stays race-free.
+    """
+    changes = {target: delta for target, delta in changes.items() if delta}
+    if not changes:
+        return
+    grouped = defaultdict(list)
+    for (scope, key), delta in changes.items():
+        grouped[scope, delta].append(key)
+    with transaction.atomic():
+        StatCounter.objects.bulk_create(
+            [StatCounter(scope=scope, key=key) for scope, key in changes],
+            ignore_conflicts=True,
+            batch_size=5000
+        )
+        for (scope, delta), keys in grouped.items():
+            StatCounter.objects.filter(scope=scope, key__in=keys).update(value=F("value") + delta)
+
+
+def forget(scope, key):
+    StatCounter.objects.filter(scope=scope, key=key).delete()
+
+
+def loan_changes(loans, sign=1):
+    """Counter deltas for loans given as ``(book_id, library_id, member_id)`` tuples."""
+    changes = Counter()
+    for book_id, library_id, member_id in loans:
+        changes[LOAN_COUNT, 0] += sign
+        changes[BOOK_LOANS, book_id] += sign
+        changes[LIBRARY_LOANS, library_id] += sign
+        changes[MEMBER_LOANS, member_id] += sign
+    return changes
+
+
+def book_changes(genre_ids, sign=1):
+    changes = Counter()
+    for genre_id in genre_ids:
+        changes[BOOK_COUNT, 0] += sign
+        changes[GENRE_BOOKS, genre_id] += sign
+    return changes
+
+
+def rebuild():
+    """Recompute every counter from the source tables."""
+    def grouped(scope, queryset, field):
+        rows = queryset.values_list(field).annotate(c=Count("id")).order_by()
+        return (StatCounter(scope=scope, key=key, value=value) for key, value in rows if key is not None)
+
+    with transaction.atomic():
+        StatCounter.objects.all().delete()
+        StatCounter.objects.bulk_create([
+            StatCounter(scope=GENRE_COUNT, value=Genre.objects.count()),
+            StatCounter(scope=LIBRARY_COUNT, value=Library.objects.count()),
+            StatCounter(scope=BOOK_COUNT, value=Book.objects.count()),
+            StatCounter(scope=LOAN_COUNT, value=Loan.objects.count()),
+        ])
+        for scope, queryset, field in [
+            (GENRE_BOOKS, Book.objects, "genre"),
+            (BOOK_LOANS, Loan.objects, "book"),
+            (LIBRARY_LOANS, Loan.objects, "book__library"),
+            (MEMBER_LOANS, Loan.objects, "member"),
+        ]:
+            StatCounter.objects.bulk_create(grouped(scope, queryset, field), batch_size=5000)
+
+
+def _top(scope, field):
+    return Subquery(
+        StatCounter.objects.filter(scope=scope, value__gt=0).order_by("-value", "key").values(field)[:1]
+    )
+
+
+def _label(model, field, scope):
+    return Subquery(model.objects.filter(pk=_top(scope, "key")).values(field)[:1])
+
+
+def _summary(scopes, **tops):
+    """Read totals and top-ranked labels in one statement.
+
+    The ``key=0`` total rows are annotated with uncorrelated scalar subqueries,
+    each an index-ordered LIMIT 1 seek, so the database evaluates every one of
+    them once however many counters there are.
+    """
+    totals = dict.fromkeys(scopes, 0)
+    extras = dict.fromkeys(tops)
+    rows = StatCounter.objects.filter(scope__in=scopes, key=0).annotate(**tops).values("scope", "value", *tops)
+    for row in rows:
+        totals[row["scope"]] = row["value"]
+        extras.update((name, row[name]) for name in tops)
+    return totals, extras
+
+
+def total(scope):
+    """A ``key=0`` counter such as ``BOOK_COUNT``: the row count without a COUNT(*)."""
+    return _summary([scope])[0][scope]
+
+
+GENRE_TOPS = {"top_genre": _label(Genre, "name", GENRE_BOOKS)}
+LIBRARY_TOPS = {"top_library": _label(Library, "name", LIBRARY_LOANS)}
+BOOK_TOPS = {
+    "top_book": _top(BOOK_LOANS, "key"),
+    "top_book_loans": _top(BOOK_LOANS, "value"),
+    "top_book_title": _label(Book, "title", BOOK_LOANS),
+}
+LOAN_TOPS = {
+    "top_reader_loans": _top(MEMBER_LOANS, "value"),
+    "top_reader": _label(Member, "first_name", MEMBER_LOANS),
+}
+
+
+def _genre_section(totals, tops):
+    return {"count": totals[GENRE_COUNT], "top": tops["top_genre"]}
+
+
+def _library_section(totals, tops):
+    return {"count": totals[LIBRARY_COUNT], "top": tops["top_library"]}
+
+
+def _book_section(totals, tops):
+    most = None
+    if tops["top_book"] is not None:
+        most = {"book__id": tops["top_book"], "book__title": tops["top_book_title"], "c": tops["top_book_loans"]}
+    return {"count": totals[BOOK_COUNT], "most_borrowed": most}
+
+
+def _loan_section(totals, tops):
+    reader = None
+    if tops["top_reader_loans"] is not None:
+        reader = {"member__first_name": tops["top_reader"], "c": tops["top_reader_loans"]}
+    return {"count": totals[LOAN_COUNT], "topReader": reader}
+
+
+def genre_stats():
+    return _genre_section(*_summary([GENRE_COUNT], **GENRE_TOPS))
+
+
+def library_stats():
+    return _library_section(*_summary([LIBRARY_COUNT], **LIBRARY_TOPS))
+
+
+def book_stats():
+    return _book_section(*_summary([BOOK_COUNT], **BOOK_TOPS))
+
+
+def loan_stats():
+    return _loan_section(*_summary([LOAN_COUNT], **LOAN_TOPS))
+
+
+def member_stats():
+    return User.objects.aggregate(
+        count_users=Count("id"),
+        count_admins=Count("id", filter=Q(is_superuser=True))
+    )
+
+
+def _counter_sections():
+    totals, tops = _summary(
+        [GENRE_COUNT, LIBRARY_COUNT, BOOK_COUNT, LOAN_COUNT],
+        **GENRE_TOPS, **LIBRARY_TOPS, **BOOK_TOPS, **LOAN_TOPS
+    )
+    return {
+        "genres": _genre_section(totals, tops),
+        "libraries": _library_section(totals, tops),
+        "books": _book_section(totals, tops),
+        "loans": _loan_section(totals, tops),
+    }
+
+
+def dashboard():
+    """All five stats sections in two statements: one over users, one over the counters."""
+    return {**_counter_sections(), "members": member_stats()}
+
+SECTIONS = {
+    "genres": genre_stats,
+    "libraries": library_stats,
+    "books": book_stats,
+    "loans": loan_stats,
+    "members": member_stats,
+}
+
+# section -> models its numbers are read from; cached responses carry their versions
+SECTION_MODELS = {
+    "genres": (Genre, Book),
+    "libraries": (Library, Book, Loan),
+    "books": (Book, Loan),
+    "loans": (Loan, Member),
+    "members": (User,),
+}
+DASHBOARD_MODELS = (Genre, Library, Book, Member, Loan, User)
+
+_executor = None
+_executor_lock = threading.Lock()
+
+
+def get_executor():
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            _executor = ThreadPoolExecutor(max_workers=settings.STATS_QUERY_THREADS, thread_name_prefix="stats")
+        return _executor
+
+
+def _in_worker(function):
+    # Worker threads keep their own connections; treat each call like a request.
+    close_old_connections()
+    try:
+        return function()
+    finally:
+        close_old_connections()
+
+
+async def gather(*functions):
+    """Results of ``functions``, each run on the bounded stats thread pool, all at once."""
+    loop = asyncio.get_running_loop()
+    executor = get_executor()
+    return await asyncio.gather(*(loop.run_in_executor(executor, _in_worker, function) for function in functions))
+
+
+async def section_async(name):
+    result, = await gather(SECTIONS[name])
+    return result
+
+
+async def dashboard_async():
+    """``dashboard()`` with its two statements in flight together."""
+    counters, members = await gather(_counter_sections, member_stats)
+    return {**counters, "members": members}
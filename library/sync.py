@@ -0,0 +1,112 @@
+import base64
+import binascii
+import json
+from datetime import datetime, timedelta
+
+from django.conf import settings
+from django.db.models import Q
+from django.utils import timezone
+from rest_framework import status
+from rest_framework.exceptions import APIException, NotFound
+
+from library.models import Genre, Library, Book, Member, Loan, Tombstone
+from library.serializers import (
+    GenreValuesSerializer, LibraryValuesSerializer, BookValuesSerializer, LoanValuesSerializer,
+    ReaderValuesSerializer,
+)
+
+# Rows per type (and tombstones) in one response; "more" tells the client to ask again at once.
+SYNC_LIMIT = 500
+DELETED = "deleted"
+
+# type -> (model, values serializer, base queryset)
+SOURCES = {
+    "genres": (Genre, GenreValuesSerializer, lambda: Genre.objects.all()),
+    "libraries": (Library, LibraryValuesSerializer, lambda: Library.objects.all()),
+    "books": (Book, BookValuesSerializer, lambda: Book.objects.with_availability()),
+    "loans": (Loan, LoanValuesSerializer, lambda: Loan.objects.all()),
+    "readers": (Member, ReaderValuesSerializer, lambda: Member.objects.all()),
+}
+TYPES = {model._meta.label_lower: name for name, (model, _, _) in SOURCES.items()}
+
+
+class CursorExpired(APIException):
+    status_code = status.HTTP_410_GONE
+    default_detail = "Курсор устарел: загрузите данные заново."
+    default_code = "cursor_expired"
+
+
+def touch(model, **filters):
+    """Mark rows changed whose representation depends on a row that changed (a title, a loan)."""
+    model.objects.filter(**filters).update(updated_at=timezone.now())
+
+
+def encode_cursor(positions):
+    data = {name: [moment.isoformat(), pk] for name, (moment, pk) in positions.items()}
+    return base64.urlsafe_b64encode(json.dumps(data).encode()).decode()
+
+
+def decode_cursor(encoded):
+    try:
+        data = json.loads(base64.urlsafe_b64decode(encoded.encode()))
+        positions = {name: (datetime.fromisoformat(data[name][0]), data[name][1]) for name in [*SOURCES, DELETED]}
+    except (binascii.Error, ValueError, TypeError, KeyError, IndexError):
+        raise NotFound("Некорректный курсор.")
+    if min(moment for moment, _ in positions.values()) < timezone.now() - timedelta(seconds=settings.SYNC_TOMBSTONE_TTL):
+        raise CursorExpired()
+    return positions
+
+
+def _after(field, position):
+    # (field, id) > position; an id of None means every row at that moment was already sent.
+    moment, pk = position
+    if pk is None:
+        return Q(**{f"{field}__gt": moment})
+    return Q(**{f"{field}__gt": moment}) | Q(**{field: moment, "id__gt": pk})
+
+
+def _page(queryset, field, position, upper, limit):
+    rows = list(queryset.filter(_after(field, position), **{f"{field}__lte": upper}).order_by(field, "id")[:limit + 1])
+    if len(rows) > limit:
+        rows = rows[:limit]
+        return rows, (rows[-1][field], rows[-1]["id"]), True
+    return rows, (upper, None), False
+
+
+def changes(encoded=None, limit=SYNC_LIMIT):
+    """Rows of every type changed since the cursor, deletions, and the cursor to send next time.
+
+    Each type is a range scan over its ``updated_at`` index, so a poll costs
+    what changed, not what is stored. Only changes older than ``SYNC_LAG``
+    seconds are returned: a row saved inside a still-open transaction
+    carries a timestamp from before its commit and must not be skipped.
+    Without a cursor nothing is returned, just the cursor to start from;
+    clients fetch it before loading the collections. Apply ``deleted``
+    before ``changes``: ids of deleted rows can be reused.
+    """
+    upper = timezone.now() - timedelta(seconds=settings.SYNC_LAG)
+    if not encoded:
+        return {"cursor": encode_cursor({name: (upper, None) for name in [*SOURCES, DELETED]}), "more": False,
+                "changes": {name: [] for name in SOURCES}, DELETED: []}
+
+    positions = decode_cursor(encoded)
+    result, more = {}, False
+    for name, (model, serializer, queryset) in SOURCES.items():
+        rows = queryset().values(*dict.fromkeys(serializer.lookups() + ["updated_at"]))
+        rows, positions[name], truncated = _page(rows, "updated_at", positions[name], upper, limit)
+        result[name] = serializer.to_representation(rows)
+        more |= truncated
+    tombstones = Tombstone.objects.values("id", "model", "object_id", "deleted_at")
+    tombstones, positions[DELETED], truncated = _page(tombstones, "deleted_at", positions[DELETED], upper, limit)
+    return {
+        "cursor": encode_cursor(positions),
+        "more": more or truncated,
+        "changes": result,
+        DELETED: [{"type": TYPES[row["model"]], "id": row["object_id"]} for row in tombstones],
+    }
+
+
+def prune_tombstones():
+    """Drop tombstones older than any cursor still accepted; returns how many."""
+    expired = timezone.now() - timedelta(seconds=settings.SYNC_TOMBSTONE_TTL)
+    return Tombstone.objects.filter(deleted_at__lt=expired).delete()[0]
@@ -1,29 +1,56 @@
 
 import pytest
+import gzip
+import io
 import json
+import logging
+from datetime import timedelta
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.core.management import call_command
+from django.test import Client
+from django.utils import timezone
+from openpyxl import Workbook, load_workbook
 from model_bakery import baker
+from library import stats
+from library.models import Book, ExportJob, Loan, Member, StatCounter
+
+
+@pytest.fixture(autouse=True)
+def isolated_caches(settings, tmp_path):
+    # Test transactions roll version counters back, so a key cached by an
+    # earlier test could match again with different rows behind it.
+    from django.core.cache import caches
+
+    caches["api"].clear()
+    caches["default"].clear()
+    settings.SINGLEFLIGHT_DIR = tmp_path / "singleflight"
+    # A build thread would read the test database over its own connection.
+    from library import autocomplete
+
+    settings.AUTOCOMPLETE_BUILD_IN_BACKGROUND = False
+    autocomplete.reset()
 
 
 @pytest.mark.django_db
 class TestLibraryAPI:
-    def test_get_libraries(self, client):
+    def test_get_libraries(self, admin_client):
         baker.make("library.Library", 5)
-        r = client.get("/api/library/")
+        r = admin_client.get("/api/libraries/")
         data = r.json()
         assert r.status_code == 200
         assert len(data) == 5
 
-    def test_create_library(self, client):
+    def test_create_library(self, admin_client):
         payload = {"name": "Городская библиотека", "address": "ул. Ленина, 10"}
-        r = client.post("/api/library/", json.dumps(payload), content_type="application/json")
+        r = admin_client.post("/api/libraries/", json.dumps(payload), content_type="application/json")
         assert r.status_code == 201
         data = r.json()
         assert data["name"] == "Городская библиотека"
 
-    def test_update_library(self, client):
+    def test_update_library(self, admin_client):
         lib = baker.make("library.Library")
         payload = {"name": "Новая библиотека", "address": "ул. Чехова, 5"}
-        r = client.put(f"/api/library/{lib.id}/", json.dumps(payload), content_type="application/json")
+        r = admin_client.put(f"/api/libraries/{lib.id}/", json.dumps(payload), content_type="application/json")
         assert r.status_code == 200
         data = r.json()
         assert data["name"] == "Новая библиотека"
@@ -31,96 +58,1272 @@ class TestLibraryAPI:
 
 @pytest.mark.django_db
 class TestGenreAPI:
-    def test_get_genres(self, client):
+    def test_get_genres(self, admin_client):
         baker.make("library.Genre", 4)
-        r = client.get("/api/genre/")
+        r = admin_client.get("/api/genres/")
         data = r.json()
         assert r.status_code == 200
         assert len(data) == 4
 
-    def test_create_genre(self, client):
+    def test_create_genre(self, admin_client):
         payload = {"name": "Фантастика"}
-        r = client.post("/api/genre/", json.dumps(payload), content_type="application/json")
+        r = admin_client.post("/api/genres/", json.dumps(payload), content_type="application/json")
         assert r.status_code == 201
         assert r.json()["name"] == "Фантастика"
 
-    def test_update_genre(self, client):
+    def test_update_genre(self, admin_client):
         genre = baker.make("library.Genre")
         payload = {"name": "Детектив"}
-        r = client.put(f"/api/genre/{genre.id}/", json.dumps(payload), content_type="application/json")
+        r = admin_client.put(f"/api/genres/{genre.id}/", json.dumps(payload), content_type="application/json")
         assert r.status_code == 200
         assert r.json()["name"] == "Детектив"
 
 
 @pytest.mark.django_db
 class TestBookAPI:
-    def test_get_books(self, client):
+    def test_get_books(self, admin_client):
         baker.make("library.Book", 5)
-        r = client.get("/api/book/")
-        data = r.json()
+        r = admin_client.get("/api/books/")
+        data = r.json()["results"]
         assert r.status_code == 200
         assert len(data) == 5
 
-    def test_create_book(self, client):
+    def test_create_book(self, admin_client):
         genre = baker.make("library.Genre")
         library = baker.make("library.Library")
         payload = {"title": "1984", "genre": genre.id, "library": library.id}
-        r = client.post("/api/book/", json.dumps(payload), content_type="application/json")
+        r = admin_client.post("/api/books/", json.dumps(payload), content_type="application/json")
         assert r.status_code == 201
         assert r.json()["title"] == "1984"
 
-    def test_update_book(self, client):
+    def test_update_book(self, admin_client):
         book = baker.make("library.Book")
         payload = {"title": "Animal Farm", "genre": book.genre.id, "library": book.library.id}
-        r = client.put(f"/api/book/{book.id}/", json.dumps(payload), content_type="application/json")
+        r = admin_client.put(f"/api/books/{book.id}/", json.dumps(payload), content_type="application/json")
         assert r.status_code == 200
         assert r.json()["title"] == "Animal Farm"
 
 
 @pytest.mark.django_db
 class TestMemberAPI:
-    def test_get_members(self, client):
-        baker.make("library.Member", 6)
-        r = client.get("/api/member/")
-        data = r.json()
+    # /api/members/ is backed by auth users; the admin making the requests is one of them.
+    def test_get_members(self, admin_client):
+        baker.make("auth.User", 6)
+        r = admin_client.get("/api/members/")
+        data = r.json()["results"]
         assert r.status_code == 200
-        assert len(data) == 6
+        assert len(data) == 7
 
-    def test_create_member(self, client):
-        library = baker.make("library.Library")
-        payload = {"first_name": "Иван", "library": library.id}
-        r = client.post("/api/member/", json.dumps(payload), content_type="application/json")
+    def test_create_member(self, admin_client):
+        payload = {"username": "ivan", "first_name": "Иван"}
+        r = admin_client.post("/api/members/", json.dumps(payload), content_type="application/json")
         assert r.status_code == 201
         assert r.json()["first_name"] == "Иван"
 
-    def test_update_member(self, client):
-        member = baker.make("library.Member")
-        payload = {"first_name": "Петр", "library": member.library.id}
-        r = client.put(f"/api/member/{member.id}/", json.dumps(payload), content_type="application/json")
+    def test_update_member(self, admin_client):
+        member = baker.make("auth.User")
+        payload = {"first_name": "Петр"}
+        r = admin_client.put(f"/api/members/{member.id}/", json.dumps(payload), content_type="application/json")
         assert r.status_code == 200
         assert r.json()["first_name"] == "Петр"
 
 
 @pytest.mark.django_db
 class TestLoanAPI:
-    def test_get_loans(self, client):
+    def test_get_loans(self, admin_client):
         baker.make("library.Loan", 3)
-        r = client.get("/api/loan/")
-        data = r.json()
+        r = admin_client.get("/api/loans/")
+        data = r.json()["results"]
         assert r.status_code == 200
         assert len(data) == 3
 
-    def test_create_loan(self, client):
+    def test_create_loan(self, admin_client):
         book = baker.make("library.Book")
         member = baker.make("library.Member")
         payload = {"book": book.id, "member": member.id, "loan_date": "2024-10-01"}
-        r = client.post("/api/loan/", json.dumps(payload), content_type="application/json")
+        r = admin_client.post("/api/loans/", json.dumps(payload), content_type="application/json")
         assert r.status_code == 201
         assert r.json()["loan_date"] == "2024-10-01"
 
-    def test_update_loan(self, client):
+    def test_update_loan(self, admin_client):
         loan = baker.make("library.Loan")
         payload = {"book": loan.book.id, "member": loan.member.id, "loan_date": "2024-12-31"}
-        r = client.put(f"/api/loan/{loan.id}/", json.dumps(payload), content_type="application/json")
+        r = admin_client.put(f"/api/loans/{loan.id}/", json.dumps(payload), content_type="application/json")
+        assert r.status_code == 200
+        assert r.json()["loan_date"] == "2024-12-31"
+
+@pytest.mark.django_db
+class TestBookAvailability:
+    def test_list_query_count_is_constant(self, admin_client, django_assert_max_num_queries):
+        baker.make("library.Book", 3)
+        with django_assert_max_num_queries(4) as small:
+            admin_client.get("/api/books/")
+        baker.make("library.Book", 30)
+        with django_assert_max_num_queries(len(small.captured_queries)):
+            r = admin_client.get("/api/books/")
+        assert r.status_code == 200
+        assert len(r.json()["results"]) == 33
+
+    def test_is_available_reflects_open_loans(self, admin_client):
+        loaned, free = baker.make("library.Book", 2)
+        baker.make("library.Loan", book=loaned, return_date=None)
+        baker.make("library.Loan", book=free, return_date="2024-10-01")
+        data = {b["id"]: b["is_available"] for b in admin_client.get("/api/books/").json()["results"]}
+        assert data == {loaned.id: False, free.id: True}
+
+
+@pytest.mark.django_db
+class TestExport:
+    def test_excel_export_is_streamed(self, admin_client):
+        baker.make("library.Loan", 3)
+        r = admin_client.get("/api/loans/export/?type=excel")
+        assert r.status_code == 200
+        assert r.streaming
+        sheet = load_workbook(io.BytesIO(b"".join(r.streaming_content))).active
+        rows = list(sheet.values)
+        assert rows[0] == ("ID", "Book", "Member", "User", "Loan Date", "Return Date")
+        assert len(rows) == 4
+
+    def test_book_export_status(self, admin_client):
+        book = baker.make("library.Book")
+        baker.make("library.Loan", book=book, return_date=None)
+        r = admin_client.get("/api/books/export/")
+        sheet = load_workbook(io.BytesIO(b"".join(r.streaming_content))).active
+        assert list(sheet.values)[1][4] == "Borrowed"
+
+    @pytest.mark.parametrize("resource", ["genres", "libraries", "books", "loans", "members"])
+    def test_csv_export(self, admin_client, resource):
+        baker.make("library.Loan", 2)
+        r = admin_client.get(f"/api/{resource}/export/?type=csv")
+        assert r.status_code == 200
+        assert r["Content-Type"].startswith("text/csv")
+        lines = b"".join(r.streaming_content).decode().splitlines()
+        assert lines[0].startswith("ID,")
+        assert len(lines) > 1
+
+    def test_ndjson_export_gzip(self, admin_client):
+        loan = baker.make("library.Loan", return_date=None)
+        r = admin_client.get("/api/loans/export/?type=ndjson&gzip=1")
+        assert r["Content-Type"] == "application/gzip"
+        assert r["Content-Disposition"] == 'attachment; filename="Loans.ndjson.gz"'
+        lines = gzip.decompress(b"".join(r.streaming_content)).decode().splitlines()
+        assert json.loads(lines[0]) == {
+            "ID": loan.id,
+            "Book": loan.book.title,
+            "Member": loan.member.first_name,
+            "User": None,
+            "Loan Date": loan.loan_date.isoformat(),
+            "Return Date": None,
+        }
+
+    def test_docx_has_a_paragraph_per_row(self, admin_client):
+        from docx import Document
+
+        genres = baker.make("library.Genre", 3)
+        r = admin_client.get("/api/genres/export/?type=docx")
+        document = Document(io.BytesIO(b"".join(r.streaming_content)))
+        assert sorted(p.text for p in document.paragraphs) == sorted(f"{g.id} | {g.name} | " for g in genres)
+
+
+
+@pytest.mark.django_db
+class TestExportJobs:
+    def test_job_lifecycle(self, admin_client, settings, tmp_path):
+        settings.EXPORT_JOB_WORKERS = 0
+        settings.MEDIA_ROOT = tmp_path
+        baker.make("library.Loan", 2)
+        r = admin_client.post("/api/export-jobs/", {"resource": "loans", "type": "csv"})
+        assert r.status_code == 202
+        job = r.json()
+        assert job["status"] == "pending"
+        assert job["download_url"] is None
+
+        call_command("run_export_jobs", "--once")
+
+        job = admin_client.get(f"/api/export-jobs/{job['id']}/").json()
+        assert job["status"] == "done"
+        r = Client().get(job["download_url"])
+        assert r.status_code == 200
+        assert len(b"".join(r.streaming_content).decode().splitlines()) == 3
+
+    def test_unknown_resource(self, admin_client):
+        r = admin_client.post("/api/export-jobs/", {"resource": "userprofile", "type": "csv"})
+        assert r.status_code == 400
+
+    def test_expired_link_is_gone(self, settings, tmp_path):
+        settings.EXPORT_JOB_WORKERS = 0
+        settings.MEDIA_ROOT = tmp_path
+        job = baker.make("library.ExportJob", resource="genres", file_type="csv", expires_at=timezone.now() + timedelta(hours=1))
+        call_command("run_export_jobs", "--once")
+        url = f"/api/export-jobs/download/{job.token}/"
+        assert Client().get(url).status_code == 200
+        ExportJob.objects.filter(pk=job.pk).update(expires_at=timezone.now() - timedelta(seconds=1))
+        assert Client().get(url).status_code == 404
+
+    def test_failed_render_leaves_no_file(self, settings, tmp_path, monkeypatch):
+        from library.api import GenreViewSet
+        from library.export_jobs import run_export_job
+
+        settings.MEDIA_ROOT = tmp_path
+
+        def broken(cls, file, file_type):
+            file.write(b"partial")
+            raise ValueError("сбой")
+        monkeypatch.setattr(GenreViewSet, "write_export", classmethod(broken))
+        job = baker.make("library.ExportJob", resource="genres", file_type="csv", expires_at=timezone.now() + timedelta(hours=1))
+        run_export_job(job.pk)
+        job.refresh_from_db()
+        assert job.status == ExportJob.FAILED and job.error == "сбой" and not job.file
+        assert not list((tmp_path / "exports").iterdir())
+
+    def test_stale_running_jobs_are_requeued(self, settings, tmp_path):
+        from library.export_jobs import requeue_stale_jobs
+
+        settings.MEDIA_ROOT = tmp_path
+        expires = timezone.now() + timedelta(hours=1)
+        stale = baker.make("library.ExportJob", status=ExportJob.RUNNING, expires_at=expires,
+                           started_at=timezone.now() - timedelta(seconds=settings.EXPORT_JOB_TIMEOUT + 1))
+        fresh = baker.make("library.ExportJob", status=ExportJob.RUNNING, expires_at=expires, started_at=timezone.now())
+        assert requeue_stale_jobs() == [stale.pk]
+        stale.refresh_from_db()
+        fresh.refresh_from_db()
+        assert stale.status == ExportJob.PENDING and fresh.status == ExportJob.RUNNING
+
+    def test_stranded_jobs_are_resubmitted(self, settings, monkeypatch, django_capture_on_commit_callbacks):
+        from concurrent.futures.process import BrokenProcessPool
+        from library import export_jobs
+
+        settings.EXPORT_JOB_WORKERS = 2
+        long_ago = timezone.now() - timedelta(seconds=settings.EXPORT_JOB_TIMEOUT + 1)
+        running = baker.make("library.ExportJob", status=ExportJob.RUNNING, started_at=long_ago)
+        waiting = baker.make("library.ExportJob")
+        ExportJob.objects.filter(pk=waiting.pk).update(created_at=long_ago)
+        queued = baker.make("library.ExportJob")
+        pools = []
+
+        class Pool:
+            def __init__(self, broken):
+                self.broken, self.jobs = broken, []
+                pools.append(self)
+
+            def submit(self, function, job_id):
+                if self.broken:
+                    raise BrokenProcessPool
+                self.jobs.append(job_id)
+
+        monkeypatch.setattr(export_jobs, "_executor", Pool(broken=False))
+        with django_capture_on_commit_callbacks(execute=True):
+            first = export_jobs.create_job("genres", "csv")
+        # The dead worker's job and the one lost with an old pool go in with the new one.
+        assert pools[0].jobs == [running.pk, waiting.pk, first.pk]
+
+        # A broken pool is replaced and the replacement gets every job still waiting.
+        monkeypatch.setattr(export_jobs, "_executor", Pool(broken=True))
+        monkeypatch.setattr(export_jobs, "ProcessPoolExecutor", lambda **kwargs: Pool(broken=False))
+        with django_capture_on_commit_callbacks(execute=True):
+            job = export_jobs.create_job("genres", "csv")
+        assert pools[-1].jobs == [running.pk, waiting.pk, queued.pk, first.pk, job.pk]
+
+    def test_expired_jobs_are_removed(self, settings, tmp_path):
+        settings.MEDIA_ROOT = tmp_path
+        expired = timezone.now() - timedelta(seconds=1)
+        baker.make("library.ExportJob", status=ExportJob.DONE, expires_at=expired)
+        running = baker.make("library.ExportJob", status=ExportJob.RUNNING, expires_at=expired)
+        assert call_command("run_export_jobs", "--cleanup") is None
+        assert list(ExportJob.objects.all()) == [running]
+
+    def test_link_lives_from_the_finish(self, settings, tmp_path):
+        from library.export_jobs import create_job, run_export_job
+
+        settings.EXPORT_JOB_WORKERS = 0
+        settings.MEDIA_ROOT = tmp_path
+        job = create_job("genres", "csv")
+        assert job.expires_at is None
+        run_export_job(job.pk)
+        job.refresh_from_db()
+        assert job.expires_at == job.finished_at + timedelta(seconds=settings.EXPORT_JOB_TTL)
+
+
+@pytest.mark.django_db
+class TestKeysetPagination:
+    def test_walks_loans_by_date_and_id(self, admin_client):
+        loans = baker.make("library.Loan", 7, loan_date="2024-10-01") + baker.make("library.Loan", 5, loan_date="2024-11-01")
+        expected = [l.id for l in sorted(loans, key=lambda l: (str(l.loan_date), l.id), reverse=True)]
+        seen, url, pages = [], "/api/loans/?page_size=5", []
+        while url:
+            page = admin_client.get(url).json()
+            pages.append(page)
+            seen += [l["id"] for l in page["results"]]
+            url = page["next"]
+        assert seen == expected
+        assert pages[0]["previous"] is None
+        back = admin_client.get(pages[-1]["previous"]).json()
+        assert [l["id"] for l in back["results"]] == expected[5:10]
+
+    def test_page_query_count_is_independent_of_depth(self, admin_client, django_assert_max_num_queries):
+        baker.make("library.Book", 30)
+        first = admin_client.get("/api/books/?page_size=10").json()
+        with django_assert_max_num_queries(4):
+            page = admin_client.get(first["next"]).json()
+        assert len(page["results"]) == 10
+
+    def test_invalid_cursor(self, admin_client):
+        assert admin_client.get("/api/books/?cursor=garbage").status_code == 404
+
+    def test_lookup_tables_are_not_paginated(self, admin_client):
+        baker.make("library.Genre", 3)
+        assert len(admin_client.get("/api/genres/").json()) == 3
+
+
+def counter_snapshot():
+    return {(c.scope, c.key): c.value for c in StatCounter.objects.exclude(value=0)}
+
+
+@pytest.mark.django_db
+class TestStatCounters:
+    def test_signals_match_rebuild(self):
+        genre, other_genre = baker.make("library.Genre", 2)
+        library, other_library = baker.make("library.Library", 2)
+        books = baker.make("library.Book", 4, genre=genre, library=library)
+        member = baker.make("library.Member", library=library)
+        # A book has at most one open loan: the first of each pair was returned.
+        loans = [
+            baker.make("library.Loan", book=book, member=member, return_date=None if n else "2024-09-01")
+            for book in books for n in range(2)
+        ]
+
+        loans[0].book = books[3]
+        loans[0].save()
+        books[1].genre = other_genre
+        books[1].library = other_library
+        books[1].save()
+        loans[3].return_date = "2024-10-01"
+        loans[3].save()
+        books[2].delete()
+        baker.make("library.Member").delete()
+
+        incremental = counter_snapshot()
+        stats.rebuild()
+        assert incremental == counter_snapshot()
+
+    def test_stats_endpoints_read_counters(self, admin_client, django_assert_max_num_queries):
+        book = baker.make("library.Book", title="Мы")
+        reader = baker.make("library.Member", first_name="Анна")
+        baker.make("library.Loan", 3, book=book, member=reader, return_date=iter([None, "2024-09-01", "2024-09-02"]))
+        baker.make("library.Loan", 2)
+        with django_assert_max_num_queries(5):
+            r = admin_client.get("/api/books/stats/")
+        assert r.json() == {"count": 3, "most_borrowed": {"book__id": book.id, "book__title": "Мы", "c": 3}}
+        assert admin_client.get("/api/loans/stats/").json() == {
+            "count": 5, "topReader": {"member__first_name": "Анна", "c": 3}
+        }
+        assert admin_client.get("/api/genres/stats/").json()["count"] == 3
+        assert admin_client.get("/api/libraries/stats/").json()["top"] == book.library.name
+
+    def test_rebuild_command(self):
+        baker.make("library.Loan", 2)
+        StatCounter.objects.all().delete()
+        call_command("rebuild_stats")
+        assert counter_snapshot()[stats.LOAN_COUNT, 0] == 2
+
+
+@pytest.mark.django_db
+class TestDashboard:
+    def test_matches_stats_endpoints_within_query_budget(self, admin_client, django_assert_max_num_queries):
+        baker.make("library.Loan", 4)
+        baker.make("library.Genre")
+        # session + user lookups, the cache key's versions, then one statement over users and one over the counters
+        with django_assert_max_num_queries(5):
+            r = admin_client.get("/api/dashboard/")
+        assert r.status_code == 200
+        dashboard = r.json()
+        for section in ["genres", "libraries", "books", "loans", "members"]:
+            assert dashboard[section] == admin_client.get(f"/api/{section}/stats/").json()
+        assert dashboard["members"] == {"count_users": 1, "count_admins": 1}
+
+    # The async views query on pool threads, with their own connections: the data must be committed.
+    @pytest.mark.django_db(transaction=True)
+    def test_async_views_match_sync_ones(self, admin_client, client):
+        baker.make("library.Loan", 3)
+        dashboard = admin_client.get("/api/async/dashboard/").json()
+        assert dashboard == admin_client.get("/api/dashboard/").json()
+        for section in ["genres", "libraries", "books", "loans", "members"]:
+            assert admin_client.get(f"/api/async/{section}/stats/").json() == dashboard[section]
+        assert admin_client.get("/api/async/nothing/stats/").status_code == 404
+        assert client.get("/api/async/dashboard/").status_code == 403
+
+    @pytest.mark.django_db(transaction=True)
+    def test_concurrent_async_misses_compute_once(self, admin_user, async_client, monkeypatch):
+        import asyncio
+        import time
+
+        calls = []
+
+        def slow():
+            calls.append(1)
+            time.sleep(0.2)
+            return {"count": 0}
+
+        monkeypatch.setitem(stats.SECTIONS, "books", slow)
+        async_client.force_login(admin_user)
+
+        async def burst():
+            return await asyncio.gather(*(async_client.get("/api/async/books/stats/") for _ in range(3)))
+
+        assert [r.json() for r in asyncio.run(burst())] == [{"count": 0}] * 3
+        assert calls == [1]
+
+    @pytest.mark.django_db(transaction=True)
+    def test_async_views_share_the_response_cache(self, admin_client):
+        from library import metrics
+
+        hits = 'library_response_cache_requests_total{view="async-stats",result="hit"}'
+        before = metrics.REGISTRY.collect().get(hits, 0)
+        baker.make("library.Book", 2)
+        assert admin_client.get("/api/books/stats/").json()["count"] == 2
+        assert admin_client.get("/api/async/books/stats/").json()["count"] == 2
+        assert metrics.REGISTRY.collect().get(hits, 0) == before + 1
+        # A write moves the versions in the key, so the cached body is not served again.
+        baker.make("library.Book")
+        assert admin_client.get("/api/async/books/stats/").json()["count"] == 3
+        assert admin_client.get("/api/books/stats/").json()["count"] == 3
+
+
+@pytest.mark.django_db
+class TestBulkLoans:
+    def test_bulk_checkout(self, admin_client, django_assert_max_num_queries):
+        books = baker.make("library.Book", 20)
+        member = baker.make("library.Member")
+        items = [{"book": b.id, "member": member.id} for b in books]
+        with django_assert_max_num_queries(25):
+            r = admin_client.post("/api/loans/bulk/", {"items": items}, content_type="application/json")
+        assert r.status_code == 201
+        results = r.json()["results"]
+        assert [x["loan"]["book_title"] for x in results] == [b.title for b in books]
+        assert Loan.objects.filter(member=member, return_date__isnull=True).count() == 20
+        assert admin_client.get("/api/loans/stats/").json()["count"] == 20
+
+    def test_bulk_checkout_is_all_or_nothing(self, admin_client):
+        book, loaned = baker.make("library.Book", 2)
+        baker.make("library.Loan", book=loaned, return_date=None)
+        member = baker.make("library.Member")
+        items = [
+            {"book": book.id, "member": member.id},
+            {"book": loaned.id, "member": member.id},
+            {"book": book.id, "member": 0},
+        ]
+        r = admin_client.post("/api/loans/bulk/", {"items": items}, content_type="application/json")
+        assert r.status_code == 400
+        assert [x["status"] for x in r.json()["results"]] == ["valid", "error", "error"]
+        assert r.json()["results"][2]["errors"] == {"book": ["Книга уже выдана."], "member": ["Читатель не найден."]}
+        assert Loan.objects.count() == 1
+
+    def test_bulk_return(self, admin_client, django_assert_max_num_queries):
+        open_loans = baker.make("library.Loan", 3, return_date=None)
+        closed = baker.make("library.Loan", return_date="2024-10-01")
+        ids = [l.id for l in open_loans] + [closed.id, 0]
+        with django_assert_max_num_queries(9):
+            r = admin_client.post("/api/loans/bulk-return/", {"ids": ids}, content_type="application/json")
+        assert [x["status"] for x in r.json()["results"]] == ["returned"] * 3 + ["already_returned", "not_found"]
+        assert not Loan.objects.filter(return_date__isnull=True).exists()
+
+
+@pytest.mark.django_db
+class TestCheckout:
+    def test_conflicts(self, admin_client):
+        book, other = baker.make("library.Book", 2)
+        member = baker.make("library.Member")
+        item = {"book": book.id, "member": member.id, "loan_date": "2024-10-01"}
+        r = admin_client.post("/api/loans/", item, content_type="application/json")
+        assert r.status_code == 201
+        loan_id = r.json()["id"]
+        r = admin_client.post("/api/loans/", item, content_type="application/json")
+        assert r.status_code == 409 and r.json() == {"detail": "Книга уже выдана."}
+        moved = baker.make("library.Loan", book=other, return_date=None)
+        r = admin_client.patch(f"/api/loans/{moved.id}/", {"book": book.id}, content_type="application/json")
+        assert r.status_code == 409
+
+        assert admin_client.post(f"/api/loans/{loan_id}/return/").json()["return_date"] is not None
+        assert admin_client.post(f"/api/loans/{loan_id}/return/").status_code == 409
+        assert admin_client.post("/api/loans/", item, content_type="application/json").status_code == 201
+        assert Loan.objects.filter(book=book, return_date__isnull=True).count() == 1
+
+    def test_concurrent_desks(self, settings):
+        # The in-memory test database fails concurrent writers instead of queueing them,
+        # so the stress run gets its own process and a file database.
+        import subprocess
+        import sys
+
+        result = subprocess.run(
+            [sys.executable, "manage.py", "benchmark_checkout", "--threads", "8", "--attempts", "25", "--books", "3"],
+            cwd=settings.BASE_DIR, capture_output=True, text=True, timeout=300,
+        )
+        assert result.returncode == 0, result.stderr
+        assert "books with several open loans: 0" in result.stdout
+
+
+@pytest.mark.django_db
+class TestCatalogImport:
+    def test_csv_upload(self, admin_client):
+        genre = baker.make("library.Genre", name="Фантастика")
+        content = "Title,Genre,Library\nМы,фантастика,Центральная\n,Фантастика,Центральная\n1984,Антиутопия,Центральная\n"
+        upload = SimpleUploadedFile("books.csv", content.encode())
+        r = admin_client.post("/api/books/import/", {"file": upload})
+        assert r.status_code == 200
+        assert r.json() == {
+            "created": 2, "errors_total": 1, "errors": [{"row": 3, "errors": {"title": ["Обязательное поле."]}}]
+        }
+        assert Book.objects.get(title="Мы").genre == genre
+        assert Book.objects.get(title="1984").genre.name == "Антиутопия"
+        assert admin_client.get("/api/books/stats/").json()["count"] == 2
+
+    def test_unreadable_uploads(self, admin_client):
+        for name, content in [("books.xlsx", b"not a zip"), ("books.csv", "Title,Genre,Library\nМы,Проза,Центр\n".encode("cp1251"))]:
+            r = admin_client.post("/api/books/import/", {"file": SimpleUploadedFile(name, content)})
+            assert r.status_code == 400
+            assert r.json()["file"][0].startswith("Не удалось прочитать файл")
+
+    def test_unreadable_tail_imports_nothing(self):
+        from library.importers import ImportFormatError, import_books, read_rows
+        from library.models import Genre
+
+        content = "Title,Genre,Library\n" + "Мы,Проза,Центр\n" * 2000
+        upload = io.BytesIO(content.encode() + "Мы,Проза,Центр\n".encode("cp1251"))
+        with pytest.raises(ImportFormatError):
+            import_books(read_rows(upload, "books.csv"), batch_size=2)
+        assert not Book.objects.exists() and not Genre.objects.exists()
+
+    def test_xlsx_command(self, tmp_path):
+        workbook = Workbook()
+        workbook.active.append(["Название", "Жанр", "Библиотека", "Адрес"])
+        for i in range(5):
+            workbook.active.append([f"Книга {i}", "Проза", "Детская", "ул. Ленина, 23"])
+        path = tmp_path / "books.xlsx"
+        workbook.save(path)
+        call_command("import_catalog", str(path), "--batch-size", "2")
+        assert Book.objects.count() == 5
+        assert Book.objects.first().library.address == "ул. Ленина, 23"
+
+    def test_missing_columns(self, admin_client):
+        upload = SimpleUploadedFile("books.csv", b"Title,Genre\n")
+        r = admin_client.post("/api/books/import/", {"file": upload})
+        assert r.status_code == 400
+
+
+@pytest.mark.django_db
+class TestGenerateData:
+    def test_scale_and_seed(self):
+        call_command("generate_data", "--scale", "0.5", "--seed", "7", "--batch-size", "100")
+        assert (Book.objects.count(), Loan.objects.count()) == (400, 500)
+        open_loans = Loan.objects.filter(return_date__isnull=True)
+        assert open_loans.count() == open_loans.values("book").distinct().count()
+        assert counter_snapshot()[stats.LOAN_COUNT, 0] == 500
+
+        first = list(Loan.objects.values_list("book__title", "loan_date", "return_date").order_by("id"))
+        Loan.objects.all().delete()
+        Book.objects.all().delete()
+        Member.objects.all().delete()
+        call_command("generate_data", "--scale", "0.5", "--seed", "7")
+        assert list(Loan.objects.values_list("book__title", "loan_date", "return_date").order_by("id")) == first
+
+
+@pytest.mark.django_db
+class TestQueryBudgets:
+    def test_every_endpoint_within_budget(self, admin_client):
+        from app.urls import router
+        from library import benchmarks
+
+        benchmarks.seed_loans(200, seed=1)
+        budgets = benchmarks.load_budgets()
+        results = benchmarks.run_cases(admin_client, benchmarks.endpoint_cases(router), trace_memory=False, repeat=1)
+        over = [
+            f"{name}: {result['status']}, {result['queries']} > {budgets.get(name, {}).get('queries')}"
+            for name, result in results.items()
+            if result["status"] >= 400 or name not in budgets or result["queries"] > budgets[name]["queries"]
+        ]
+        assert not over
+
+
+    def test_sizes_without_budget_are_reported(self):
+        from library.benchmarks import check_budgets
+
+        results = {"book-list": {"status": 200, "queries": 2, "seconds": 0.01}}
+        budgets = {"book-list": {"queries": 4, "sizes": {"1000": {"ms": 50}}}}
+        assert check_budgets(results, budgets, 1000) == []
+        assert check_budgets(results, budgets, 1000000) == ["book-list@1000000: нет бюджета для этого размера"]
+
+@pytest.mark.django_db
+class TestServerTiming:
+    def test_header(self, admin_client, settings):
+        settings.REQUEST_TIMING_HEADERS = True
+        baker.make("library.Book", _quantity=3)
+        r = admin_client.get("/api/books/")
+        parts = dict(part.split(";", 1) for part in r["Server-Timing"].split(", "))
+        assert set(parts) == {"db", "renderer", "app", "total"}
+        assert 'desc="4 queries"' in parts["db"]
+
+    def test_disabled(self, admin_client, settings):
+        settings.REQUEST_TIMING_HEADERS = False
+        settings.REQUEST_TIMING_SAMPLE_RATE = 0.0
+        assert "Server-Timing" not in admin_client.get("/api/books/")
+
+    def test_sampled_log(self, admin_client, settings, caplog, monkeypatch):
+        settings.REQUEST_TIMING_HEADERS = False
+        settings.REQUEST_TIMING_SAMPLE_RATE = 1.0
+        monkeypatch.setattr(logging.getLogger("library.timing"), "propagate", True)
+        with caplog.at_level("INFO", logger="library.timing"):
+            admin_client.get("/api/loans/")
+        line = json.loads(caplog.records[-1].getMessage())
+        assert line["path"] == "/api/loans/" and line["status"] == 200
+        assert line["queries"] == 4 and len(line["slowest"]) == 4
+
+
+@pytest.mark.django_db
+class TestMetrics:
+    def test_requests_and_exports(self, admin_client):
+        baker.make("library.Book", _quantity=3)
+        admin_client.get("/api/books/")
+        admin_client.get("/api/books/export/?type=csv").getvalue()
+        admin_client.get("/api/books/export/?type=excel")
+        r = admin_client.get("/metrics")
         assert r.status_code == 200
-        assert r.json()["loan_date"] == "2024-12-31"
\ No newline at end of file
+        text = r.content.decode()
+        assert 'library_http_requests_total{view="book-list",method="GET",status="200"}' in text
+        assert 'library_http_request_duration_seconds_bucket{view="book-list",method="GET",le="+Inf"}' in text
+        assert 'library_export_bytes_count{resource="books",type="csv"}' in text
+        assert 'library_export_bytes_count{resource="books",type="excel"}' in text
+
+    def test_forbidden_for_regular_users(self, client, django_user_model):
+        client.force_login(django_user_model.objects.create_user("reader"))
+        assert client.get("/metrics", REMOTE_ADDR="10.0.0.1").status_code == 403
+
+    def test_counts_asgi_requests(self, async_client, settings):
+        import asyncio
+        from library import metrics
+
+        settings.REQUEST_TIMING_HEADERS = True
+        response = asyncio.run(async_client.get("/api/async/dashboard/"))
+        assert response.status_code == 403 and "total;dur=" in response["Server-Timing"]
+        # Statements are not seen under ASGI, so no false "0 queries" either.
+        assert "db;" not in response["Server-Timing"]
+        assert metrics.REGISTRY.collect()[
+            'library_http_requests_total{view="async-dashboard",method="GET",status="403"}'
+        ] >= 1
+
+    def test_multiprocess_files(self, tmp_path):
+        import threading
+        from library import metrics
+
+        registry = metrics.Registry(directory=str(tmp_path))
+        hits = metrics.Counter("hits_total", "Hits.", ["kind"], registry=registry)
+        sizes = metrics.Histogram("size", "Sizes.", buckets=(1, 10), registry=registry)
+        # Each takes its shard before any finishes, so none can take over another's.
+        barrier = threading.Barrier(4)
+
+        def work():
+            registry.shard()
+            barrier.wait()
+            for _ in range(1000):
+                hits.inc("a")
+                sizes.observe(5)
+        workers = [threading.Thread(target=work) for _ in range(4)]
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+        assert len(list(tmp_path.glob("metrics_*.db"))) == 4
+        text = metrics.render(registry)
+        assert 'hits_total{kind="a"} 4000' in text
+        assert text.index('size_bucket{le="1.0"} 0') < text.index('size_bucket{le="10.0"} 4000') \
+            < text.index('size_bucket{le="+Inf"} 4000') < text.index("size_sum 20000")
+
+    def test_shards_of_finished_threads_are_reused(self, tmp_path):
+        import threading
+        from library import metrics
+
+        registry = metrics.Registry(directory=str(tmp_path))
+        hits = metrics.Counter("hits_total", "Hits.", registry=registry)
+        for _ in range(20):
+            worker = threading.Thread(target=hits.inc)
+            worker.start()
+            worker.join()
+        assert len(list(tmp_path.glob("metrics_*.db"))) == 1
+        assert registry.collect()["hits_total"] == 20
+
+
+@pytest.mark.django_db
+class TestSearch:
+    def test_prefix_and_ranking(self, admin_client):
+        book = baker.make("library.Book", title="Мастер и Маргарита")
+        best = baker.make("library.Book", title="Мастер мастеров Маргарита")
+        member = baker.make("library.Member", first_name="Маргарита")
+        baker.make("library.Book", title="Идиот")
+        r = admin_client.get("/api/search/", {"q": "марг"})
+        assert {(item["type"], item["id"]) for item in r.json()["results"]} >= {("book", book.id), ("member", member.id)}
+        assert len(r.json()["results"]) == 3
+        r = admin_client.get("/api/search/", {"q": "мастер", "type": "book"})
+        assert [item["id"] for item in r.json()["results"]] == [best.id, book.id]
+
+    def test_case_and_diacritics(self, admin_client):
+        library = baker.make("library.Library", name="Ёлочка")
+        r = admin_client.get("/api/search/", {"q": "ЕЛОЧ"})
+        assert r.json()["results"] == [{"type": "library", "id": library.id, "text": "Ёлочка"}]
+
+    def test_index_follows_changes(self, admin_client):
+        book = baker.make("library.Book", title="Старое название")
+        Book.objects.filter(pk=book.pk).update(title="Новое название")
+        assert admin_client.get("/api/search/", {"q": "старое"}).json()["results"] == []
+        assert admin_client.get("/api/search/", {"q": "новое"}).json()["results"][0]["id"] == book.id
+        book.delete()
+        assert admin_client.get("/api/search/", {"q": "новое"}).json()["results"] == []
+
+    def test_empty_query(self, admin_client):
+        assert admin_client.get("/api/search/", {"q": ' ""* '}).json() == {"results": []}
+
+    def test_triggers_exist_after_migrate(self):
+        from django.db import connection
+        from library import search
+
+        with connection.cursor() as cursor:
+            cursor.execute("SELECT name, tbl_name, sql FROM sqlite_master WHERE type = 'trigger'")
+            triggers = {name: (table, sql) for name, table, sql in cursor.fetchall()}
+        for _, model, field in search.SOURCES.values():
+            table = model._meta.db_table
+            for event in ("insert", "update", "delete"):
+                assert triggers[f"library_search_{table}_{event}"][0] == table
+            column = model._meta.get_field(field).column
+            assert f"UPDATE OF {column} ON {table}" in triggers[f"library_search_{table}_update"][1]
+
+
+@pytest.mark.django_db
+class TestAutocomplete:
+    @pytest.fixture(autouse=True)
+    def fresh_index(self):
+        from library import autocomplete
+
+        autocomplete.reset()
+        yield
+        autocomplete.reset()
+
+    def test_prefix_lookup(self, admin_client):
+        first = baker.make("library.Book", title="Мастер и Маргарита")
+        second = baker.make("library.Book", title="Маргарита")
+        member = baker.make("library.Member", first_name="Мартин")
+        baker.make("library.Book", title="Идиот")
+        r = admin_client.get("/api/autocomplete/", {"q": "мар"})
+        assert [item["id"] for item in r.json()["results"] if item["type"] == "book"] == [second.id, first.id]
+        assert {"type": "member", "id": member.id, "text": "Мартин"} in r.json()["results"]
+        r = admin_client.get("/api/autocomplete/", {"q": "мар мас", "type": "book"})
+        assert [item["id"] for item in r.json()["results"]] == [first.id]
+
+    def test_follows_saves(self, admin_client, django_capture_on_commit_callbacks):
+        book = baker.make("library.Book", title="Старое название")
+        assert admin_client.get("/api/autocomplete/", {"q": "стар"}).json()["results"][0]["id"] == book.id
+        with django_capture_on_commit_callbacks(execute=True):
+            book.title = "Новое название"
+            book.save()
+        assert admin_client.get("/api/autocomplete/", {"q": "стар"}).json()["results"] == []
+        assert admin_client.get("/api/autocomplete/", {"q": "нов"}).json()["results"][0]["id"] == book.id
+        with django_capture_on_commit_callbacks(execute=True):
+            book.delete()
+        assert admin_client.get("/api/autocomplete/", {"q": "нов"}).json()["results"] == []
+
+    def test_memory_usage(self, admin_client):
+        baker.make("library.Book", title="Война и мир")
+        r = admin_client.get("/api/autocomplete/stats/")
+        assert r.json()["objects"] == 1 and r.json()["words"] == 3 and r.json()["bytes"] > 0
+
+    def test_first_build_does_not_block(self, settings, monkeypatch):
+        import threading
+        from library import autocomplete
+
+        settings.AUTOCOMPLETE_BUILD_IN_BACKGROUND = True
+        started, release = threading.Event(), threading.Event()
+
+        def slow_load():
+            started.set()
+            release.wait(5)
+            return autocomplete.PrefixIndex.build([(autocomplete.ref(0, 1), "Война и мир")])
+
+        monkeypatch.setattr(autocomplete, "load", slow_load)
+        monkeypatch.setattr(autocomplete.versions, "snapshot", lambda models: ([], []))
+        assert autocomplete.lookup("вой") == []
+        started.wait(5)
+        # Lookups and saves go on while the index loads; the save is replayed onto it.
+        autocomplete.update(0, 2, "Война миров")
+        assert autocomplete.lookup("вой") == []
+        release.set()
+        while autocomplete._pending is not None:
+            pass
+        assert [item["id"] for item in autocomplete.lookup("вой")] == [1, 2]
+
+    def test_rebuilds_only_for_changes_of_other_processes(self, monkeypatch, django_capture_on_commit_callbacks):
+        from library import autocomplete, versions
+
+        loads = []
+        load = autocomplete.load
+        monkeypatch.setattr(autocomplete, "load", lambda: loads.append(1) or load())
+        autocomplete.get_index()
+        with django_capture_on_commit_callbacks(execute=True):
+            baker.make("library.Book", title="Своя")
+        autocomplete._refresh()
+        assert len(loads) == 1 and autocomplete.lookup("сво")
+        # A bump whose commit this process did not see stands for another worker's save.
+        versions.bump(Book)
+        autocomplete._refresh()
+        assert len(loads) == 2
+
+    def test_index_add_remove(self):
+        from library.autocomplete import PrefixIndex
+
+        index = PrefixIndex.build([(0, "Анна Каренина"), (2, "Анна")])
+        index.add(4, "Каренин")
+        index.remove(0)
+        assert [item["id"] for item in index.lookup("карен", [0], 10)] == [2]
+        assert index.words == ["анна", "каренин"]
+
+
+@pytest.mark.django_db
+class TestListETags:
+    def test_not_modified_without_touching_tables(self, admin_client, django_assert_max_num_queries):
+        baker.make("library.Genre", _quantity=3)
+        r = admin_client.get("/api/genres/")
+        assert r.status_code == 200 and r["ETag"].startswith('"')
+        with django_assert_max_num_queries(3) as queries:
+            again = admin_client.get("/api/genres/", HTTP_IF_NONE_MATCH=r["ETag"])
+        assert again.status_code == 304 and again.content == b""
+        assert not any("library_genre" in query["sql"] for query in queries.captured_queries)
+        assert admin_client.get("/api/genres/", HTTP_IF_NONE_MATCH=f'W/{r["ETag"]}').status_code == 304
+
+    def test_changes_invalidate(self, admin_client):
+        book = baker.make("library.Book")
+        tag = admin_client.get("/api/books/")["ETag"]
+        baker.make("library.Loan", book=book)
+        assert admin_client.get("/api/books/", HTTP_IF_NONE_MATCH=tag).status_code == 200
+
+        tag = admin_client.get("/api/books/")["ETag"]
+        book.genre.name = "Другой"
+        book.genre.save()
+        assert admin_client.get("/api/books/", HTTP_IF_NONE_MATCH=tag).status_code == 200
+
+    def test_bulk_changes_invalidate(self, admin_client):
+        loan = baker.make("library.Loan")
+        tag = admin_client.get("/api/loans/")["ETag"]
+        assert admin_client.post("/api/loans/bulk-return/", {"ids": [loan.id]}, content_type="application/json").status_code == 200
+        assert admin_client.get("/api/loans/", HTTP_IF_NONE_MATCH=tag).status_code == 200
+
+    def test_tag_depends_on_query_and_user(self, admin_client, client, django_user_model):
+        tag = admin_client.get("/api/libraries/")["ETag"]
+        assert admin_client.get("/api/libraries/?format=json")["ETag"] != tag
+        client.force_login(django_user_model.objects.create_user("reader"))
+        tag = admin_client.get("/api/libraries/")["ETag"]
+        assert client.get("/api/libraries/", HTTP_IF_NONE_MATCH=tag).status_code == 200
+
+
+@pytest.mark.django_db
+class TestResponseCache:
+    def test_hits_until_models_change(self, admin_client, django_assert_max_num_queries):
+        from library import metrics
+
+        baker.make("library.Book", 3)
+        hits = 'library_response_cache_requests_total{view="book-stats",result="hit"}'
+        before = metrics.REGISTRY.collect().get(hits, 0)
+        first = admin_client.get("/api/books/stats/").json()
+        with django_assert_max_num_queries(3) as queries:
+            assert admin_client.get("/api/books/stats/").json() == first
+        assert not any("library_book" in query["sql"] for query in queries.captured_queries)
+        assert metrics.REGISTRY.collect()[hits] == before + 1
+
+        baker.make("library.Book")
+        assert admin_client.get("/api/books/stats/").json()["count"] == first["count"] + 1
+
+    def test_lists_are_cached_per_user(self, admin_client, client, django_user_model):
+        genre = baker.make("library.Genre", name="Поэзия")
+        assert admin_client.get("/api/genres/").json()[0]["name"] == "Поэзия"
+        from library import versions
+
+        # A queryset update sends no signals, so the cached body is served until a version moves.
+        type(genre).objects.update(name="Проза")
+        assert admin_client.get("/api/genres/").json()[0]["name"] == "Поэзия"
+        versions.bump(type(genre))
+        assert admin_client.get("/api/genres/").json()[0]["name"] == "Проза"
+
+    def test_stats_are_shared_by_role(self, admin_client, django_user_model):
+        from django.core.cache import caches
+
+        other = Client()
+        other.force_login(django_user_model.objects.create_superuser("other", password="x"))
+        admin_client.get("/api/dashboard/")
+        entries = len(caches["api"]._cache)
+        other.get("/api/dashboard/")
+        assert len(caches["api"]._cache) == entries
+
+    def test_backend_evicts_by_size(self):
+        from library.cache_backends import SizeBoundedLocMemCache
+
+        cache = SizeBoundedLocMemCache("size-test", {"OPTIONS": {"MAX_BYTES": 3000}})
+        cache.clear()
+        cache.set("a", "x" * 1000)
+        cache.set("b", "x" * 1000)
+        cache.get("a")
+        cache.set("c", "x" * 1000)
+        assert cache.get("b") is None and cache.get("a") and cache.get("c")
+        assert cache.size <= 3000
+
+
+class TestSingleFlight:
+    def test_threads_share_one_computation(self):
+        import threading
+        from library import metrics, singleflight
+
+        shared_key = 'library_singleflight_calls_total{result="shared"}'
+        before = metrics.REGISTRY.collect().get(shared_key, 0)
+
+        calls = []
+        started = threading.Event()
+        release = threading.Event()
+
+        def compute():
+            calls.append(1)
+            started.set()
+            release.wait(5)
+            return {"total": 42}
+
+        results = []
+        threads = [threading.Thread(target=lambda: results.append(singleflight.run("stats", compute))) for _ in range(5)]
+        threads[0].start()
+        started.wait(5)
+        for thread in threads[1:]:
+            thread.start()
+        while metrics.REGISTRY.collect().get(shared_key, 0) < before + 4:
+            pass
+        release.set()
+        for thread in threads:
+            thread.join()
+        assert calls == [1] and results == [{"total": 42}] * 5
+
+    def test_takes_result_of_other_process(self, settings):
+        import fcntl
+        import hashlib
+        import os
+        import pickle
+        import threading
+        import time
+        from library import singleflight
+
+        path = settings.SINGLEFLIGHT_DIR / hashlib.sha1(b"stats").hexdigest()
+        path.parent.mkdir(parents=True)
+        results = []
+        # A result left by an earlier flight is not taken.
+        path.write_bytes(pickle.dumps("stale"))
+        with open(f"{path}.lock", "ab") as lock:
+            # Stand in for another worker process holding the lock mid-computation.
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            waiter = threading.Thread(target=lambda: results.append(singleflight.run("stats", lambda: "own")))
+            waiter.start()
+            time.sleep(0.1)
+            path.write_bytes(pickle.dumps("shared"))
+            os.pwrite(lock.fileno(), (1).to_bytes(8, "little"), 0)
+        waiter.join(5)
+        assert results == ["shared"]
+        assert singleflight.run("stats", lambda: "own") == "own"
+
+    def test_idle_files_are_swept(self, settings):
+        import threading
+        from library import singleflight
+
+        settings.SINGLEFLIGHT_TTL = 0
+        singleflight.run("old", lambda: 1)
+        assert sorted(path.name for path in settings.SINGLEFLIGHT_DIR.iterdir()) == []
+
+        # Files of a key whose flight is still running stay.
+        started, release = threading.Event(), threading.Event()
+        running = threading.Thread(target=singleflight.run, args=("running", lambda: started.set() or release.wait(5)))
+        running.start()
+        started.wait(5)
+        singleflight.run("other", lambda: 2)
+        assert len(list(settings.SINGLEFLIGHT_DIR.glob("*.lock"))) == 1
+        release.set()
+        running.join(5)
+        singleflight.run("other", lambda: 2)
+        assert list(settings.SINGLEFLIGHT_DIR.iterdir()) == []
+
+    def test_errors_reach_waiters_and_are_not_kept(self):
+        from library import singleflight
+
+        with pytest.raises(ZeroDivisionError):
+            singleflight.run("broken", lambda: 1 / 0)
+        assert singleflight.run("broken", lambda: "fixed") == "fixed"
+
+    def test_shared_export_file(self, admin_client, settings):
+        baker.make("library.Genre", 3)
+        for query in ["", "&page=2", "&junk=1&a=b"]:
+            r = admin_client.get(f"/api/genres/export/?type=excel{query}")
+            workbook = load_workbook(io.BytesIO(b"".join(r.streaming_content)))
+            assert workbook.active.max_row == 4
+        # Unrelated query parameters do not make new keys.
+        assert len(list(settings.SINGLEFLIGHT_DIR.glob("*.lock"))) == 1
+
+
+@pytest.mark.django_db
+class TestFastLists:
+    @pytest.mark.parametrize("resource", ["books", "loans", "members"])
+    def test_same_bytes_as_model_serializers(self, admin_client, resource):
+        from rest_framework.renderers import JSONRenderer
+        from library.api import BookViewSet, LoanViewSet, MemberViewSet
+
+        viewset = {"books": BookViewSet, "loans": LoanViewSet, "members": MemberViewSet}[resource]
+        loans = baker.make("library.Loan", 3, book__title="Ёж и «заяц»")
+        loans[0].return_date = loans[0].loan_date
+        loans[0].save()
+        user = baker.make("auth.User")
+        user.profile.age = 30
+        user.profile.save()
+
+        content = admin_client.get(f"/api/{resource}/").content
+        results = viewset.serializer_class(viewset.queryset_for().order_by(*getattr(viewset, "pagination_ordering", ["id"])), many=True).data
+        expected = JSONRenderer().render({"next": None, "previous": None, "results": results})
+        assert content == expected
+
+    def test_renderer_matches_json_renderer(self):
+        from decimal import Decimal
+        from rest_framework.renderers import JSONRenderer
+        from library.renderers import ORJSONRenderer
+
+        data = {"text": "Ёлка\u2028\u2029", "when": timezone.now(), "day": timezone.now().date(), "price": Decimal("1.50"), 1: [None, True, 1.5]}
+        assert ORJSONRenderer().render(data) == JSONRenderer().render(data)
+        indented = ORJSONRenderer().render(data, "application/json; indent=2")
+        assert indented == JSONRenderer().render(data, "application/json; indent=2")
+
+
+@pytest.mark.django_db
+class TestSparseFields:
+    def test_list_selects_only_requested_columns(self, admin_client, django_assert_max_num_queries):
+        baker.make("library.Loan", 3)
+        with django_assert_max_num_queries(4) as queries:
+            r = admin_client.get("/api/books/?fields=id,title")
+        assert [set(item) for item in r.json()["results"]] == [{"id", "title"}] * 3
+        sql = [query["sql"] for query in queries.captured_queries if "FROM \"library_book\"" in query["sql"]][0]
+        assert "JOIN" not in sql and "library_loan" not in sql
+
+    def test_exclude_and_detail(self, admin_client, django_assert_max_num_queries):
+        book = baker.make("library.Book")
+        item = admin_client.get("/api/books/?exclude=is_available,library_name").json()["results"][0]
+        assert list(item) == ["id", "title", "genre", "library", "genre_name"]
+        with django_assert_max_num_queries(3) as queries:
+            detail = admin_client.get(f"/api/books/{book.id}/?fields=title,is_available").json()
+        assert detail == {"title": book.title, "is_available": True}
+        assert not any("library_genre" in query["sql"] for query in queries.captured_queries)
+
+    def test_pagination_key_is_kept(self, admin_client):
+        baker.make("library.Loan", 3)
+        first = admin_client.get("/api/loans/?fields=book_title&page_size=2").json()
+        assert list(first["results"][0]) == ["book_title"]
+        assert len(admin_client.get(first["next"]).json()["results"]) == 1
+
+    def test_unknown_field(self, admin_client):
+        r = admin_client.get("/api/members/?fields=id,password")
+        assert r.status_code == 400 and "password" in r.json()["fields"][0]
+        baker.make("library.Genre")
+        assert list(admin_client.get("/api/genres/?fields=name").json()[0]) == ["name"]
+
+
+@pytest.mark.django_db
+class TestSync:
+    @pytest.fixture(autouse=True)
+    def no_lag(self, settings):
+        settings.SYNC_LAG = 0
+
+    def poll(self, client, cursor):
+        data = client.get("/api/sync/", {"since": cursor}).json()
+        return data["cursor"], data
+
+    def test_changes_and_deletes_since_cursor(self, admin_client, django_assert_max_num_queries):
+        cursor = admin_client.get("/api/sync/").json()["cursor"]
+        loan = baker.make("library.Loan")
+        cursor, data = self.poll(admin_client, cursor)
+        assert [row["id"] for row in data["changes"]["loans"]] == [loan.id]
+        assert data["changes"]["books"][0] == {**data["changes"]["books"][0], "id": loan.book_id, "is_available": False}
+        assert data["deleted"] == [] and not data["more"]
+
+        with django_assert_max_num_queries(8):
+            cursor, data = self.poll(admin_client, cursor)
+        assert not any(data["changes"].values())
+
+        loan_id = loan.id
+        loan.delete()
+        cursor, data = self.poll(admin_client, cursor)
+        assert data["deleted"] == [{"type": "loans", "id": loan_id}]
+        assert data["changes"]["books"][0]["is_available"] is True
+
+    def test_renames_resend_dependent_rows(self, admin_client):
+        book = baker.make("library.Book")
+        cursor = admin_client.get("/api/sync/").json()["cursor"]
+        book.genre.name = "Поэзия"
+        book.genre.save()
+        cursor, data = self.poll(admin_client, cursor)
+        assert data["changes"]["books"][0]["genre_name"] == "Поэзия"
+        assert [row["name"] for row in data["changes"]["genres"]] == ["Поэзия"]
+
+    def test_pages_through_bulk_changes(self, admin_client):
+        from library import sync
+
+        loans = baker.make("library.Loan", 3)
+        cursor = sync.changes()["cursor"]
+        assert admin_client.post("/api/loans/bulk-return/", {"ids": [l.id for l in loans]}, content_type="application/json").status_code == 200
+        first = sync.changes(cursor, limit=2)
+        second = sync.changes(first["cursor"], limit=2)
+        assert first["more"] and not second["more"]
+        returned = first["changes"]["loans"] + second["changes"]["loans"]
+        assert sorted(row["id"] for row in returned) == [l.id for l in loans]
+        assert all(row["return_date"] for row in returned)
+
+    def test_bad_and_expired_cursors(self, admin_client, settings):
+        from datetime import timedelta
+        from library import sync
+
+        assert admin_client.get("/api/sync/?since=garbage").status_code == 404
+        old = timezone.now() - timedelta(days=2)
+        cursor = sync.encode_cursor({name: (old, None) for name in [*sync.SOURCES, sync.DELETED]})
+        settings.SYNC_TOMBSTONE_TTL = 24 * 60 * 60
+        assert admin_client.get("/api/sync/", {"since": cursor}).status_code == 410
+
+
+class TestEvents:
+    def test_stream_delivers_published_events(self):
+        import asyncio
+        import threading
+        from library import events
+
+        async def run():
+            stream = events.stream(heartbeat=0.05)
+            assert (await stream.__anext__()).startswith("retry:")
+            threading.Thread(target=events.publish, args=({"type": "book.availability", "book": 7, "is_available": True},)).start()
+            chunks = [await stream.__anext__() for _ in range(2)]
+            count = events.BROKER.subscriber_count()
+            await stream.aclose()
+            return chunks, count
+
+        chunks, count = asyncio.run(run())
+        event = next(chunk for chunk in chunks if chunk.startswith("id:"))
+        assert "event: book.availability\ndata: {\"book\": 7, \"is_available\": true}\n\n" in event
+        assert count == 1 and events.BROKER.subscriber_count() == 0
+
+    def test_replay_and_resync(self):
+        import asyncio
+        from library import events
+
+        broker = events.Broker()
+        first, _, _ = broker.publish({"type": "a"})
+        broker.publish({"type": "b"})
+
+        async def run():
+            replayed = broker.subscribe(last_id=f"{broker.boot}-{first}")
+            lost = broker.subscribe(last_id=f"{broker.boot}-{first + 100}")
+            # The same number from another process (or before a restart) is not ours to replay.
+            foreign = broker.subscribe(last_id=f"{events.Broker().boot}-{first}")
+            return [subscription.queue.get_nowait() for subscription in (replayed, lost, foreign)]
+
+        replayed, lost, foreign = asyncio.run(run())
+        assert replayed[1] == {"type": "b"} and lost is events._OVERFLOW and foreign is events._OVERFLOW
+        assert replayed[2].startswith(f"id: {broker.boot}-2\n")
+
+    def test_fanout_between_processes(self, settings, tmp_path):
+        import json
+        import socket
+        from library import events
+
+        settings.EVENTS_FANOUT_DIR = str(tmp_path)
+        other = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        other.bind(str(tmp_path / "events_1.sock"))
+        (tmp_path / "events_2.sock").touch()
+        events.publish({"type": "loan.deleted", "loan": 1, "book": 2})
+        assert json.loads(other.recv(events.DATAGRAM_SIZE)) == {"type": "loan.deleted", "loan": 1, "book": 2}
+        assert not (tmp_path / "events_2.sock").exists()
+        other.close()
+
+    @pytest.mark.django_db
+    def test_loan_signals(self, admin_client, django_capture_on_commit_callbacks):
+        from library import events
+
+        with django_capture_on_commit_callbacks(execute=True):
+            loan = baker.make("library.Loan")
+        with django_capture_on_commit_callbacks(execute=True):
+            admin_client.post(f"/api/loans/{loan.id}/return/")
+        loan.refresh_from_db()
+        with django_capture_on_commit_callbacks(execute=True):
+            loan.delete()
+        recent = [(event["type"], event.get("is_available")) for event in events.BROKER.recent()[-5:]]
+        assert recent == [
+            ("loan.created", None), ("book.availability", False),
+            ("loan.returned", None), ("book.availability", True),
+            ("loan.deleted", None),
+        ]
+
+    @pytest.mark.django_db
+    def test_requires_login(self, client):
+        assert client.get("/api/events/").status_code == 403
+
+    @pytest.mark.django_db
+    def test_refused_under_wsgi(self, admin_client):
+        r = admin_client.get("/api/events/")
+        assert r.status_code == 501 and "ASGI" in r.content.decode()
+
+
+@pytest.mark.django_db
+class TestAdmin:
+    def test_changelists_within_query_budget(self, admin_client, django_assert_max_num_queries):
+        baker.make("library.Loan", 30)
+        # session + user, the count from the stats counters, then one joined page
+        with django_assert_max_num_queries(4):
+            r = admin_client.get("/admin/library/loan/")
+        assert r.status_code == 200 and r.context["cl"].result_count == 30
+        with django_assert_max_num_queries(6):
+            assert admin_client.get("/admin/library/book/").status_code == 200
+
+    def test_full_text_search(self, admin_client):
+        book = baker.make("library.Book", title="Война и мир")
+        baker.make("library.Book", title="Мир полудня")
+        loan = baker.make("library.Loan", book=book)
+        baker.make("library.Loan", 2)
+        r = admin_client.get("/admin/library/loan/", {"q": "война"})
+        assert [row.pk for row in r.context["cl"].result_list] == [loan.pk]
+        r = admin_client.get("/admin/library/book/", {"q": "мир"})
+        assert r.context["cl"].result_count == 2
+        r = admin_client.get("/admin/autocomplete/", {
+            "app_label": "library", "model_name": "loan", "field_name": "book", "term": "войн"
+        })
+        assert [item["id"] for item in r.json()["results"]] == [str(book.pk)]
+
+    def test_filtered_counts_are_capped_and_cached(self, admin_client, settings, django_assert_max_num_queries):
+        settings.ADMIN_COUNT_LIMIT = 5
+        genre = baker.make("library.Genre")
+        baker.make("library.Book", 8, genre=genre)
+        baker.make("library.Book")
+        url = f"/admin/library/book/?genre__id__exact={genre.pk}"
+        r = admin_client.get(url)
+        # Capped counts are shown as a lower bound.
+        assert r.context["cl"].result_count == 5 and "5+" in r.content.decode()
+        settings.ADMIN_COUNT_LIMIT = 100
+        assert admin_client.get(url).context["cl"].result_count == 8
+        with django_assert_max_num_queries(6):
+            assert admin_client.get(url).context["cl"].result_count == 8
+        baker.make("library.Book", genre=genre)
+        assert admin_client.get(url).context["cl"].result_count == 9
+
+    def test_counts_follow_joined_models(self, admin_client, settings):
+        from library.admin import CountingPaginator
+
+        settings.ADMIN_COUNT_LIMIT = 100
+        books = baker.make("library.Book", 2, title="Мир")
+        for book in books:
+            baker.make("library.Loan", book=book)
+        searched = "/admin/library/loan/?q=война"
+        joined = Loan.objects.filter(book__title="Война").order_by("-pk")
+        assert admin_client.get(searched).context["cl"].result_count == 0
+        assert CountingPaginator(joined, 20).count == 0
+        # Renaming a book changes which loans match without touching any loan.
+        books[0].title = "Война"
+        books[0].save()
+        assert admin_client.get(searched).context["cl"].result_count == 1
+        assert CountingPaginator(joined, 20).count == 1
@@ -0,0 +1,86 @@
+import hashlib
+import json
+import threading
+from collections import Counter
+from functools import partial
+
+from django.conf import settings
+from django.db import transaction
+from django.db.models import F
+from django.utils.http import parse_etags
+
+from library.models import ModelVersion
+
+
+# label -> bumps committed by this process, to tell its own changes from other processes'
+_committed = Counter()
+_committed_lock = threading.Lock()
+
+
+def bump(*models):
+    """Increment the version of each model in the caller's transaction, so it commits with the change."""
+    labels = {model._meta.label_lower for model in models}
+    if ModelVersion.objects.filter(model__in=labels).update(version=F("version") + 1) < len(labels):
+        ModelVersion.objects.bulk_create(
+            [ModelVersion(model=label, version=1) for label in labels], ignore_conflicts=True
+        )
+    transaction.on_commit(partial(_count_committed, labels))
+
+
+def _count_committed(labels):
+    with _committed_lock:
+        _committed.update(labels)
+
+
+def snapshot(models):
+    """``current(models)`` together with how many of those bumps this process made."""
+    labels = sorted(model._meta.label_lower for model in models)
+    # Counted before reading the versions: a bump committing in between then
+    # looks foreign (one needless refresh) rather than hiding a foreign one.
+    with _committed_lock:
+        local = [_committed[label] for label in labels]
+    return current(models), local
+
+
+def changed_elsewhere(before, after):
+    """Whether another process bumped a model between two ``snapshot``s."""
+    (versions_before, local_before), (versions_after, local_after) = before, after
+    return any(
+        new - old > mine_new - mine_old
+        for (_, old), (_, new), mine_old, mine_new in zip(versions_before, versions_after, local_before, local_after)
+    )
+
+
+def current(models):
+    labels = sorted(model._meta.label_lower for model in models)
+    found = dict(ModelVersion.objects.filter(model__in=labels).values_list("model", "version"))
+    return [(label, found.get(label, 0)) for label in labels]
+
+
+def permission_scope(user):
+    """What a user-independent response may still vary by: the user's role."""
+    return ["role", user.is_authenticated, user.is_staff, user.is_superuser]
+
+
+def etag(request, models, scope=None, path=None):
+    """Strong ETag for a GET that reads ``models``: their versions plus everything that shapes the body.
+
+    ``scope`` defaults to the user's id; pass ``permission_scope(user)`` for
+    responses that are the same for every user with the same role. ``path``
+    stands in for the request's when another URL serves the same body.
+    """
+    key = [
+        settings.API_ETAG_SALT,
+        request.path if path is None else path,
+        sorted(request.GET.lists()),
+        request.META.get("HTTP_ACCEPT", ""),
+        request.user.pk if scope is None else scope,
+        current(models),
+    ]
+    return '"%s"' % hashlib.sha1(json.dumps(key).encode()).hexdigest()
+
+
+def matches(request, tag):
+    # Weak comparison (RFC 9110 13.1.2): proxies that recompress turn the tag into W/"...".
+    tags = parse_etags(request.META.get("HTTP_IF_NONE_MATCH", ""))
+    return "*" in tags or tag in (candidate.removeprefix("W/") for candidate in tags)
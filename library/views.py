@@ -1,4 +1,12 @@
+import asyncio
+from functools import partial
+
+from django.conf import settings
+from django.core.handlers.asgi import ASGIRequest
+from django.http import Http404, HttpResponse, HttpResponseForbidden, JsonResponse, StreamingHttpResponse
 from django.views.generic import TemplateView
+
+from library import events, metrics, response_cache, stats, versions
 from library.models import Library, Book, Genre, Member, Loan
 
 class ShowLibraryView(TemplateView):
@@ -12,3 +20,83 @@ class ShowLibraryView(TemplateView):
         context["members"] = Member.objects.all().select_related("user", "library")
         context["loans"] = Loan.objects.all().select_related("book", "member", "user")
         return context
+
+
+def metrics_view(request):
+    """Prometheus scrape target; open to staff and to ``METRICS_ALLOWED_IPS``."""
+    if not (request.user.is_staff or request.META.get("REMOTE_ADDR") in settings.METRICS_ALLOWED_IPS):
+        return HttpResponseForbidden()
+    return HttpResponse(metrics.render(), content_type="text/plain; version=0.0.4; charset=utf-8")
+
+
+async def events_view(request):
+    """Server-Sent Events: loans created, returned and deleted, and book availability.
+
+    Serve it with an ASGI server (``app.asgi``): each client is then a
+    suspended coroutine. Under WSGI the stream would hold a worker forever,
+    so it is refused there.
+    """
+    user = await request.auser()
+    if not user.is_authenticated:
+        return HttpResponseForbidden()
+    if not isinstance(request, ASGIRequest):
+        return HttpResponse(
+            "Поток событий доступен только под ASGI-сервером: uvicorn app.asgi:application",
+            status=501,
+            content_type="text/plain; charset=utf-8",
+        )
+    last_id = request.headers.get("Last-Event-ID") or None
+    response = StreamingHttpResponse(events.stream(last_id), content_type="text/event-stream")
+    response["Cache-Control"] = "no-cache"
+    response["X-Accel-Buffering"] = "no"
+    return response
+
+
+async def stats_view(request, section):
+    """``/api/<section>/stats/`` without holding a worker thread while the query runs (ASGI)."""
+    user = await request.auser()
+    if not user.is_authenticated:
+        return HttpResponseForbidden()
+    if section not in stats.SECTIONS:
+        raise Http404
+    models = stats.SECTION_MODELS[section]
+    return JsonResponse(await _cached(request, user, models, partial(stats.section_async, section)))
+
+
+async def dashboard_view(request):
+    """``/api/dashboard/`` with its sections queried concurrently (ASGI)."""
+    user = await request.auser()
+    if not user.is_authenticated:
+        return HttpResponseForbidden()
+    return JsonResponse(await _cached(request, user, stats.DASHBOARD_MODELS, stats.dashboard_async))
+
+
+# (event loop, response cache key) -> task computing it; concurrent misses await one task
+_flights = {}
+
+
+async def _cached(request, user, models, compute):
+    # /api/async/... answers what /api/... does and shares its cache entries. The
+    # versions query and the cache round trips run on the stats pool, so neither
+    # the loop nor Django's one thread for sync code waits on them.
+    (key, data), = await stats.gather(partial(_lookup, request, user, models))
+    if data is not response_cache.MISSING:
+        return data
+    name = (asyncio.get_running_loop(), key)
+    flight = _flights.get(name)
+    if flight is None:
+        flight = _flights[name] = asyncio.ensure_future(_compute(key, compute))
+        flight.add_done_callback(lambda _: _flights.pop(name, None))
+    return await asyncio.shield(flight)
+
+
+def _lookup(request, user, models):
+    path = request.path.replace("/api/async/", "/api/", 1)
+    key = response_cache.KEY_PREFIX + versions.etag(request, models, versions.permission_scope(user), path)
+    return key, response_cache.lookup(request, key)
+
+
+async def _compute(key, compute):
+    data = await compute()
+    await stats.gather(partial(response_cache.store, key, data))
+    return data